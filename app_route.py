@@ -1,27 +1,424 @@
-from flask import request, make_response
+from flask import request, make_response, Response, stream_with_context, g
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from datetime import datetime
 from datetime import timezone
 from icecream import ic
 from os import getenv
 
+import json
+
 from optimization.performance import *
+from optimization.cache import *
+from optimization.market_data import *
+from optimization.singleflight import *
+from optimization.circuit import *
+from optimization.deadline import *
+from optimization.admission import *
+from optimization.bulkhead import *
+from optimization.webhooks import *
 from feedback.message import *
 from validator_api.coinmarketcap import *
 from validator_api.coinbase import *
 from validator_api.plaid import *
 from support.score import *
+from support.shadow import *
+from support.percentile import *
+from support.drift import *
+from feedback.whatif import *
+from oracle.ledger import *
+from oracle.publisher import *
+from oracle.attestation import *
+from oracle.keplr import *
 from app import *
 
 load_dotenv()
 
+# identical score requests within the TTL are served from cache
+score_cache = cache_namespace('scores', 600)
+# metrics of previously scored data, keyed by content fingerprint
+feature_cache = cache_namespace('features', 86400)
+# per-client rate limit and global concurrency limit of the scoring endpoints, in this worker
+admission = AdmissionControl(float(getenv('ADMISSION_RATE', 1)), float(getenv('ADMISSION_BURST', 10)),
+                             int(getenv('ADMISSION_CONCURRENCY', 8)), int(
+                                 getenv('ADMISSION_QUEUE', 16)),
+                             float(getenv('ADMISSION_MAX_WAIT', 2)))
+
+
+def plaid_fetch(plaid_token, plaid_client_id, plaid_client_secret, deadline=None):
+    '''
+    Description:
+        connect to Plaid and fetch the user's accounts and completed transactions.
+        When several access tokens are given, all items are fetched in parallel and merged into one deduplicated dataset
+
+    Parameters:
+        plaid_token (str or list): Plaid access token(s), one per linked bank
+        plaid_client_id (str): client API key
+        plaid_client_secret (str): client API secret key
+        deadline (Deadline): deadline of the incoming request, if any
+
+    Returns:
+        client (plaid.api.plaid_api.PlaidApi): Plaid client
+        plaid_txn (dict): accounts, item, and non-pending transactions
+    '''
+    # client connection
+    client = plaid_client(
+        getenv('ENV'), plaid_client_id, plaid_client_secret)
+    ic(client)
+
+    # data fetching and formatting
+    tokens = plaid_token if isinstance(plaid_token, list) else [plaid_token]
+    if not tokens:
+        raise Exception('no plaid_token provided')
+    with ThreadPoolExecutor(max_workers=min(len(tokens), 8)) as executor:
+        items = list(executor.map(
+            lambda t: plaid_transactions(t, client, 360, deadline), tokens))
+
+    for i, plaid_txn in enumerate(items):
+        if 'error' in plaid_txn:
+            raise Exception(plaid_txn['error']['message'])
+
+        plaid_txn = {k: v for k, v in plaid_txn.items(
+        ) if k in ['accounts', 'item', 'transactions']}
+        plaid_txn['transactions'] = [
+            t for t in plaid_txn['transactions'] if not t['pending']]
+        items[i] = plaid_txn
+
+    if len(items) == 1:
+        plaid_txn = items[0]
+    else:
+        plaid_txn = plaid_merge_items(items)
+
+    return client, plaid_txn
+
+
+def coinbase_fetch(coinbase_access_token, coinbase_refresh_token, coinmarketcap_key, top_coins=None, deadline=None):
+    '''
+    Description:
+        connect to Coinbase and fetch the user's accounts and completed transactions in trusted currencies
+
+    Parameters:
+        coinbase_access_token (str): Coinbase OAuth access token
+        coinbase_refresh_token (str): Coinbase OAuth refresh token
+        coinmarketcap_key (str): bearer token to authenticate into coinmarketcap API
+        top_coins (dict): ticker-value pairs for top coinmarketcap cryptos. If None, they are fetched from coinmarketcap
+        deadline (Deadline): deadline of the incoming request, if any. The Coinbase client has no per-call timeout, so the deadline is checked between calls
+
+    Returns:
+        coinbase_acc (list): non-zero balance accounts in trusted currencies
+        coinbase_txn (list): completed transactions of the above accounts
+    '''
+    # client connection
+    client = coinbase_client(
+        coinbase_access_token, coinbase_refresh_token)
+    ic(client)
+
+    # coinmarketcap
+    # fetch top X cryptos from coinmarketcap API
+    if top_coins is None:
+        top_coins = market_coins(coinmarketcap_key, deadline)
+    if not isinstance(top_coins, dict):
+        raise CoinmarketcapUnavailable(
+            'coinmarketcap unavailable: {}'.format(top_coins))
+    top_coins = dict(top_coins)
+    ic(top_coins)
+    if deadline:
+        deadline.check('fetching Coinbase currencies')
+    currencies = market_field(
+        'currencies', market_data_max_age()) or coinbase_currencies(client)
+    ic(currencies)
+    if 'error' in currencies:
+        raise Exception(currencies['error']['message'])
+
+    odd_fiats = ['BHD', 'BIF', 'BYR', 'CLP', 'DJF', 'GNF', 'HUF', 'IQD', 'ISK', 'JOD', 'JPY', 'KMF', 'KRW',
+                 'KWD', 'LYD', 'MGA', 'MRO', 'OMR', 'PYG', 'RWF', 'TND', 'UGX', 'VND', 'VUV', 'XAF', 'XOF', 'XPF']
+    currencies = {k: 1 for (k, v) in currencies.items()
+                  if v == 0.01 or k in odd_fiats}
+    top_coins.update(currencies)
+    coins = list(top_coins.keys())
+
+    # change coinbase native currency to USD
+    if deadline:
+        deadline.check('fetching Coinbase accounts')
+    native = coinbase_native_currency(client)
+    ic(native)
+    if 'error' in native:
+        raise Exception(native['error']['message'])
+    if native != 'USD':
+        set_native = coinbase_set_native_currency(client, 'USD')
+        ic(set_native)
+
+    # fetch and format data from user's Coinbase account
+    coinbase_acc = coinbase_accounts(client)
+    if 'error' in coinbase_acc:
+        raise Exception(coinbase_acc['error']['message'])
+    coinbase_acc = [n for n in coinbase_acc if n['currency'] in coins]
+
+    coinbase_txn = list()
+    for n in coinbase_acc:
+        if deadline:
+            deadline.check('fetching Coinbase transactions')
+        coinbase_txn.append(coinbase_transactions(client, n['id']))
+    coinbase_txn = [x for n in coinbase_txn for x in n]
+
+    # keep only certain transaction types
+    txn_types = ['fiat_deposit', 'request', 'buy',
+                 'fiat_withdrawal', 'vault_withdrawal', 'sell', 'send']
+    coinbase_txn = [n for n in coinbase_txn if n['status']
+                    == 'completed' and n['type'] in txn_types]
+    for d in coinbase_txn:
+        # If the txn is of 'send' type and is a credit, then relabel its type to 'send_credit'
+        if d['type'] == 'send' and np.sign(float(d['amount']['amount'])) == 1:
+            d['type'] = 'send_credit'
+        # If the txn is of 'send' type and is a debit, then relabel its type to 'send_debit'
+        elif d['type'] == 'send' and np.sign(float(d['amount']['amount'])) == -1:
+            d['type'] = 'send_debit'
+
+    # reset native currency
+    set_native = coinbase_set_native_currency(client, native)
+    ic(set_native)
+
+    return coinbase_acc, coinbase_txn
+
+
+def fetch_market_data(previous):
+    '''
+    Description:
+        fetch the market data shared by all workers, using the server's own API keys.
+        A field that fails to refresh is left out, and keeps its previous value in the snapshot
+
+    Parameters:
+        previous (dict): last published snapshot
+
+    Returns:
+        data (dict): top coinmarketcap cryptos, USD to SCRT rate, and Coinbase currencies, as far as they were refreshed
+    '''
+    data = dict()
+
+    coins = coinmarketcap_coins(getenv('COINMARKETCAP_KEY'), 25)
+    if isinstance(coins, dict):
+        data['coins'] = coins
+
+    rate = coinmarketcap_rate(getenv('COINMARKETCAP_KEY'), 'USD', 'SCRT')
+    if isinstance(rate, (int, float)):
+        data['rate'] = rate
+
+    if getenv('COINBASE_CLIENT_ID'):
+        client = coinbase_api_client(
+            getenv('COINBASE_CLIENT_ID'), getenv('COINBASE_CLIENT_SECRET'))
+        currencies = coinbase_currencies(client)
+        if 'error' not in currencies:
+            data['currencies'] = currencies
+
+    return data
+
+
+def market_data_max_age():
+    '''age in seconds beyond which a field of the shared market data is stale: three refresh intervals'''
+    return 3*float(getenv('MARKET_DATA_REFRESH', 300))
+
+
+def market_coins(coinmarketcap_key, deadline=None):
+    '''top 25 coinmarketcap cryptos, from the shared market data if fresh'''
+    return market_field('coins', market_data_max_age()) or coinmarketcap_coins(coinmarketcap_key, 25, deadline)
+
+
+def market_rate(coinmarketcap_key, deadline=None):
+    '''USD to SCRT rate, from the shared market data if fresh. The rate is optional: it is skipped when the deadline is nearly spent'''
+    rate = market_field('rate', market_data_max_age())
+    if rate is None:
+        if deadline is not None and not deadline.allows():
+            return 'not enough time left to fetch the SCRT rate'
+        try:
+            rate = coinmarketcap_rate(
+                coinmarketcap_key, 'USD', 'SCRT', None if deadline is None else deadline.optional())
+        except DeadlineExceeded:
+            return 'ran out of time fetching the SCRT rate'
+    return rate
+
+
+# one worker refreshes the market data for all workers
+if getenv('COINMARKETCAP_KEY') and float(getenv('MARKET_DATA_REFRESH', 300)) > 0:
+    start_market_data(fetch_market_data, getenv('MARKET_DATA_PATH', '/tmp/scrtsibyl_market_data'),
+                      float(getenv('MARKET_DATA_REFRESH', 300)))
+
+
+def request_as_of(as_of):
+    '''The date a request is scored as of: the 'as_of' field of its body (YYYY-MM-DD), or today (UTC)'''
+    today = datetime.now(timezone.utc).date()
+    if not as_of:
+        return today
+    as_of = datetime.strptime(as_of, '%Y-%m-%d').date()
+    if as_of > today:
+        raise Exception('as_of cannot be a future date')
+    return as_of
+
+
+def score_cache_key(endpoint, as_of, *credentials):
+    '''Key a score response by endpoint, all the credentials of the request, as_of date, and model version.
+    Credentials are hashed, never stored: a request is only served from cache with the exact credentials that were checked upstream'''
+    return hash_key(endpoint, as_of.isoformat(), model_version, *credentials)
+
+
+def issue_score(address, provider, score, feedback, as_of):
+    '''Store a score issued to a verified wallet in the ledger, queue it for publication to the chain, and return its signed attestation, if any'''
+    if not address:
+        return None
+    issued_at = datetime.now(timezone.utc)
+    ledger_record(address, provider, model_version,
+                  score, feedback, as_of, issued_at)
+    publish_score(address, provider, model_version, score, issued_at)
+    return attest_score(address, provider, model_version, score, issued_at)
+
+
+def plaid_pipeline(client, plaid_txn, coinmarketcap_key, as_of, endpoint, deadline=None):
+    '''
+    Description:
+        score the fetched data of a Plaid user, and interpret the score
+
+    Parameters:
+        client (plaid.api.plaid_api.PlaidApi): Plaid client, for the bank name
+        plaid_txn (dict): accounts, item, and non-pending transactions
+        coinmarketcap_key (str): bearer token to authenticate into coinmarketcap API
+        as_of (date): scoring date
+        endpoint (str): endpoint the score is computed for
+        deadline (Deadline): deadline of the incoming request, if any
+
+    Returns:
+        score (float): score in range [300, 900]
+        feedback (dict): interpreted score feedback
+        percentile (dict): percentile ranks of the score, or None
+        message (str): qualitative feedback
+    '''
+    feedback = create_feedback_plaid()
+    feedback = plaid_bank_name(
+        client, plaid_txn['item']['institution_id'], feedback, deadline)
+    if deadline:
+        deadline.check('scoring')
+    metrics = dict()
+    score, feedback = plaid_score(
+        plaid_txn, feedback, feature_cache, as_of, metrics)
+    shadow_score('plaid', score, metrics, as_of, endpoint)
+    drift_record('plaid', score, feedback)
+    percentile = score_percentiles('plaid', score, metrics)
+    message = qualitative_feedback_plaid(
+        score, feedback, coinmarketcap_key, market_rate(coinmarketcap_key, deadline))
+    feedback = interpret_score_plaid(
+        score, feedback, what_if_plaid(score, feedback, metrics))
+    return score, feedback, percentile, message
+
+
+def plaid_item_client(registration):
+    '''the Plaid client of an item registered for webhooks, rebuilt from its credentials'''
+    return plaid_client(getenv('ENV'), registration['plaid_client_id'], registration['plaid_client_secret'])
+
+
+def plaid_item_fetch(registration, days):
+    '''the data of a Plaid item registered for webhooks, over its last `days` days'''
+    plaid_txn = plaid_transactions(
+        registration['plaid_token'], registration['client'], days)
+    if 'error' in plaid_txn:
+        raise Exception(plaid_txn['error']['message'])
+    return {k: v for k, v in plaid_txn.items() if k in ['accounts', 'item', 'transactions']}
+
+
+def plaid_rescore(registration, plaid_txn):
+    '''Re-score a Plaid item whose transactions changed, store the score, and precompute the response of /credit_score/plaid'''
+    as_of = datetime.now(timezone.utc).date()
+    score, feedback, percentile, message = plaid_pipeline(
+        registration['client'], plaid_txn, registration['coinmarketcap_key'], as_of, '/webhooks/plaid')
+    output = {
+        'endpoint': '/credit_score/plaid',
+        'title': 'Credit Score',
+        'status_code': 200,
+        'status': 'success',
+        'timestamp': datetime.now(timezone.utc).strftime('%m-%d-%Y %H:%M:%S GMT'),
+        'score': int(score),
+        'percentile': percentile,
+        'feedback': feedback,
+        'message': message
+    }
+    attestation = issue_score(
+        registration['address'], 'plaid', score, feedback, as_of)
+    if attestation:
+        output['attestation'] = attestation
+    cache_key = score_cache_key('/credit_score/plaid', as_of, registration['plaid_token'], registration['plaid_client_id'],
+                                registration['plaid_client_secret'], registration['keplr_claim'])
+    score_cache.set(cache_key, output, float(
+        getenv('PLAID_WEBHOOK_TTL', 3600)))
+    return output
+
+
+# scored Plaid items, re-scored in the background when Plaid reports new transactions
+plaid_webhooks = PlaidWebhooks(plaid_item_fetch, plaid_rescore, plaid_item_client,
+                               overlap=int(getenv('PLAID_WEBHOOK_OVERLAP', 7)))
 
-def create_feedback_plaid():
-    return {'fetch': {}, 'credit': {}, 'velocity': {}, 'stability': {}, 'diversity': {}}
 
+def error_status(e, deadline):
+    '''Status code of a failed score: 504 if the request ran out of time, 503 if a provider is saturated, 401 if the wallet is not verified, 400 otherwise'''
+    if deadline.expired() or isinstance(e, DeadlineExceeded):
+        return 504
+    if isinstance(e, BulkheadFull):
+        return 503
+    if isinstance(e, KeplrError):
+        return 401
+    return 400
 
-def create_feedback_coinbase():
-    return {'kyc': {}, 'history': {}, 'liquidity': {}, 'activity': {}}
+
+def sse_event(event, data):
+    '''Format a Server-Sent Event carrying a json payload'''
+    payload = json.dumps(data, default=lambda x: x.item()
+                         if isinstance(x, np.generic) else str(x))
+    return 'event: {}\ndata: {}\n\n'.format(event, payload)
+
+
+def sse_response(stream):
+    '''Wrap an SSE generator into an unbuffered streaming response'''
+    return Response(stream_with_context(stream), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+
+def client_id():
+    '''Identify the caller for rate limiting: X-API-Key header, else keplr_token, else IP address. Hashed, never stored'''
+    body = request.get_json(silent=True)
+    body = body if isinstance(body, dict) else {}
+    return hash_key(request.headers.get('X-API-Key') or body.get('keplr_token') or request.remote_addr)
+
+
+@app.before_request
+def admit_request():
+    '''Start the request deadline and, for the scoring endpoints, shed the requests that cannot start in time'''
+    g.deadline = request_deadline(request.headers)
+    if request.method != 'POST' or not request.path.startswith('/credit_score/'):
+        return None
+
+    status_code, retry_after = admission.admit(client_id(), g.deadline)
+    if status_code != 200:
+        timestamp = datetime.now(timezone.utc).strftime(
+            '%m-%d-%Y %H:%M:%S GMT')
+        output = {
+            'endpoint': request.path,
+            'title': 'Credit Score',
+            'status_code': status_code,
+            'status': 'error',
+            'timestamp': timestamp,
+            'message': 'Too many requests, retry in {} seconds.'.format(retry_after) if status_code == 429
+            else 'SCRTsibyl is overloaded, retry in {} seconds.'.format(retry_after)
+        }
+        ic(output)
+        response = make_response(output, output['status_code'])
+        response.headers['Retry-After'] = str(retry_after)
+        return response
+    g.admitted = True
+
+
+@app.teardown_request
+def release_request(error=None):
+    '''Free the concurrency slot of an admitted request. Streaming requests keep it until their stream ends'''
+    if g.pop('admitted', False):
+        admission.release()
 
 
 # @measure_time_and_memory
@@ -29,12 +426,17 @@ def create_feedback_coinbase():
 def credit_score_plaid():
 
     if request.method == 'POST':
+        deadline = g.deadline
         try:
             keplr_token = request.json.get('keplr_token', None)
             plaid_token = request.json.get('plaid_token', None)
             plaid_client_id = request.json.get('plaid_client_id', None)
             plaid_client_secret = request.json.get('plaid_client_secret', None)
             coinmarketcap_key = request.json.get('coinmarketcap_key', None)
+            as_of = request_as_of(request.json.get('as_of', None))
+            # the wallet signature, bound to this request, is checked while the user's data is fetched
+            verification = verify_keplr_async(
+                keplr_token, request_binding(request.path, plaid_token))
         except Exception as e:
             timestamp = datetime.now(timezone.utc).strftime(
                 '%m-%d-%Y %H:%M:%S GMT')
@@ -49,39 +451,37 @@ def credit_score_plaid():
             ic(output)
             return make_response(output, output['status_code'])
 
-        try:
-            # client connection
-            client = plaid_client(
-                getenv('ENV'), plaid_client_id, plaid_client_secret)
-            ic(client)
+        # serve identical requests from the score cache
+        cache_key = score_cache_key(
+            '/credit_score/plaid', as_of, plaid_token, plaid_client_id, plaid_client_secret, keplr_claim(keplr_token))
+        output = score_cache.get(cache_key)
+        if output and verification.exception() is None:
+            ic(output)
+            return make_response(output, output['status_code'])
 
+        try:
             # data fetching and formatting
-            plaid_txn = plaid_transactions(plaid_token, client, 360)
-            if 'error' in plaid_txn:
-                raise Exception(plaid_txn['error']['message'])
-
-            plaid_txn = {k: v for k, v in plaid_txn.items(
-            ) if k in ['accounts', 'item', 'transactions']}
-            plaid_txn['transactions'] = [
-                t for t in plaid_txn['transactions'] if not t['pending']]
+            client, plaid_txn = plaid_fetch(
+                plaid_token, plaid_client_id, plaid_client_secret, deadline)
+            address = verification.result()
 
             # compute score
-            feedback = create_feedback_plaid()
-            feedback = plaid_bank_name(
-                client, plaid_txn['item']['institution_id'], feedback)
-            score, feedback = plaid_score(plaid_txn, feedback)
-            message = qualitative_feedback_plaid(
-                score, feedback, coinmarketcap_key)
-            feedback = interpret_score_plaid(score, feedback)
+            score, feedback, percentile, message = plaid_pipeline(
+                client, plaid_txn, coinmarketcap_key, as_of, '/credit_score/plaid', deadline)
+            if isinstance(plaid_token, str):
+                plaid_webhooks.register(plaid_txn['item'].get('item_id'), {
+                    'plaid_token': plaid_token, 'plaid_client_id': plaid_client_id, 'plaid_client_secret': plaid_client_secret,
+                    'coinmarketcap_key': coinmarketcap_key, 'keplr_claim': keplr_claim(keplr_token), 'address': address}, plaid_txn)
 
             status_code = 200
             status = 'success'
 
         except Exception as e:
-            status_code = 400
+            status_code = error_status(e, deadline)
             status = 'error'
             score = 0
             feedback = {}
+            percentile = None
             message = str(e)
 
         finally:
@@ -94,12 +494,20 @@ def credit_score_plaid():
                 'status': status,
                 'timestamp': timestamp,
                 'score': int(score),
+                'percentile': percentile,
                 'feedback': feedback,
                 'message': message
             }
             if score == 0:
                 output.pop('score', None)
+                output.pop('percentile', None)
                 output.pop('feedback', None)
+            if status_code == 200:
+                attestation = issue_score(address, output['endpoint'].split('/')[-1],
+                                          score, feedback, as_of)
+                if attestation:
+                    output['attestation'] = attestation
+                score_cache.set(cache_key, output)
             ic(output)
             return make_response(output, output['status_code'])
 
@@ -109,6 +517,7 @@ def credit_score_plaid():
 def credit_score_coinbase():
 
     if request.method == 'POST':
+        deadline = g.deadline
         try:
             keplr_token = request.json.get('keplr_token', None)
             coinbase_access_token = request.json.get(
@@ -116,6 +525,10 @@ def credit_score_coinbase():
             coinbase_refresh_token = request.json.get(
                 'coinbase_refresh_token', None)
             coinmarketcap_key = request.json.get('coinmarketcap_key', None)
+            as_of = request_as_of(request.json.get('as_of', None))
+            # the wallet signature, bound to this request, is checked while the user's data is fetched
+            verification = verify_keplr_async(
+                keplr_token, request_binding(request.path, coinbase_access_token))
         except Exception as e:
             timestamp = datetime.now(timezone.utc).strftime(
                 '%m-%d-%Y %H:%M:%S GMT')
@@ -130,80 +543,44 @@ def credit_score_coinbase():
             ic(output)
             return make_response(output, output['status_code'])
 
-        try:
-            # client connection
-            client = coinbase_client(
-                coinbase_access_token, coinbase_refresh_token)
-            ic(client)
-
-            # coinmarketcap
-            # fetch top X cryptos from coinmarketcap API
-            top_coins = coinmarketcap_coins(coinmarketcap_key, 25)
-            ic(top_coins)
-            currencies = coinbase_currencies(client)
-            ic(currencies)
-            if 'error' in currencies:
-                raise Exception(currencies['error']['message'])
-
-            odd_fiats = ['BHD', 'BIF', 'BYR', 'CLP', 'DJF', 'GNF', 'HUF', 'IQD', 'ISK', 'JOD', 'JPY', 'KMF', 'KRW',
-                         'KWD', 'LYD', 'MGA', 'MRO', 'OMR', 'PYG', 'RWF', 'TND', 'UGX', 'VND', 'VUV', 'XAF', 'XOF', 'XPF']
-            currencies = {k: 1 for (k, v) in currencies.items()
-                          if v == 0.01 or k in odd_fiats}
-            top_coins.update(currencies)
-            coins = list(top_coins.keys())
-
-            # change coinbase native currency to USD
-            native = coinbase_native_currency(client)
-            ic(native)
-            if 'error' in native:
-                raise Exception(native['error']['message'])
-            if native != 'USD':
-                set_native = coinbase_set_native_currency(client, 'USD')
-                ic(set_native)
+        # serve identical requests from the score cache
+        cache_key = score_cache_key(
+            '/credit_score/coinbase', as_of, coinbase_access_token, coinbase_refresh_token, keplr_claim(keplr_token))
+        output = score_cache.get(cache_key)
+        if output and verification.exception() is None:
+            ic(output)
+            return make_response(output, output['status_code'])
 
+        try:
             # fetch and format data from user's Coinbase account
-            coinbase_acc = coinbase_accounts(client)
-            if 'error' in coinbase_acc:
-                raise Exception(coinbase_acc['error']['message'])
-            coinbase_acc = [n for n in coinbase_acc if n['currency'] in coins]
-
-            coinbase_txn = [coinbase_transactions(
-                client, n['id']) for n in coinbase_acc]
-            coinbase_txn = [x for n in coinbase_txn for x in n]
-
-            # keep only certain transaction types
-            txn_types = ['fiat_deposit', 'request', 'buy',
-                         'fiat_withdrawal', 'vault_withdrawal', 'sell', 'send']
-            coinbase_txn = [n for n in coinbase_txn if n['status']
-                            == 'completed' and n['type'] in txn_types]
-            for d in coinbase_txn:
-                # If the txn is of 'send' type and is a credit, then relabel its type to 'send_credit'
-                if d['type'] == 'send' and np.sign(float(d['amount']['amount'])) == 1:
-                    d['type'] = 'send_credit'
-                # If the txn is of 'send' type and is a debit, then relabel its type to 'send_debit'
-                elif d['type'] == 'send' and np.sign(float(d['amount']['amount'])) == -1:
-                    d['type'] = 'send_debit'
-
-            # reset native currency
-            set_native = coinbase_set_native_currency(client, native)
-            ic(set_native)
+            coinbase_acc, coinbase_txn = coinbase_fetch(
+                coinbase_access_token, coinbase_refresh_token, coinmarketcap_key, deadline=deadline)
+            address = verification.result()
 
             # compute score
             feedback = create_feedback_coinbase()
+            deadline.check('scoring')
+            metrics = dict()
             score, feedback = coinbase_score(
-                coinbase_acc, coinbase_txn, feedback)
+                coinbase_acc, coinbase_txn, feedback, feature_cache, as_of, metrics)
+            shadow_score('coinbase', score, metrics,
+                         as_of, '/credit_score/coinbase')
+            drift_record('coinbase', score, feedback)
+            percentile = score_percentiles('coinbase', score, metrics)
             message = qualitative_feedback_coinbase(
-                score, feedback, coinmarketcap_key)
-            feedback = interpret_score_coinbase(score, feedback)
+                score, feedback, coinmarketcap_key, market_rate(coinmarketcap_key, deadline))
+            feedback = interpret_score_coinbase(
+                score, feedback, what_if_coinbase(score, feedback, metrics))
 
             status_code = 200
             status = 'success'
 
         except Exception as e:
-            status_code = 400
+            status_code = error_status(e, deadline)
             status = 'error'
             score = 0
             feedback = {}
+            percentile = None
             message = str(e)
 
         finally:
@@ -216,11 +593,469 @@ def credit_score_coinbase():
                 'status': status,
                 'timestamp': timestamp,
                 'score': int(score),
+                'percentile': percentile,
                 'feedback': feedback,
                 'message': message
             }
             if score == 0:
                 output.pop('score', None)
+                output.pop('percentile', None)
                 output.pop('feedback', None)
+            if status_code == 200:
+                attestation = issue_score(address, output['endpoint'].split('/')[-1],
+                                          score, feedback, as_of)
+                if attestation:
+                    output['attestation'] = attestation
+                score_cache.set(cache_key, output)
+            ic(output)
+            return make_response(output, output['status_code'])
+
+
+@app.route('/credit_score/plaid/stream', methods=['POST'])
+def credit_score_plaid_stream():
+
+    if request.method == 'POST':
+        deadline = g.deadline
+        try:
+            keplr_token = request.json.get('keplr_token', None)
+            plaid_token = request.json.get('plaid_token', None)
+            plaid_client_id = request.json.get('plaid_client_id', None)
+            plaid_client_secret = request.json.get('plaid_client_secret', None)
+            coinmarketcap_key = request.json.get('coinmarketcap_key', None)
+            as_of = request_as_of(request.json.get('as_of', None))
+            # the wallet signature, bound to this request, is checked while the user's data is fetched
+            verification = verify_keplr_async(
+                keplr_token, request_binding(request.path, plaid_token))
+        except Exception as e:
+            timestamp = datetime.now(timezone.utc).strftime(
+                '%m-%d-%Y %H:%M:%S GMT')
+            output = {
+                'endpoint': '/credit_score/plaid/stream',
+                'title': 'Credit Score',
+                'status_code': 400,
+                'status': 'error',
+                'timestamp': timestamp,
+                'message': str(e)
+            }
             ic(output)
             return make_response(output, output['status_code'])
+
+        def stream():
+            # the SCRT rate is only needed by the final message: fetch it while the score is computed
+            executor = ThreadPoolExecutor(max_workers=1)
+            rate = executor.submit(market_rate, coinmarketcap_key, deadline)
+            try:
+                timestamp = datetime.now(timezone.utc).strftime(
+                    '%m-%d-%Y %H:%M:%S GMT')
+                yield sse_event('start', {'endpoint': '/credit_score/plaid/stream', 'timestamp': timestamp})
+
+                # data fetching and formatting
+                client, plaid_txn = plaid_fetch(
+                    plaid_token, plaid_client_id, plaid_client_secret, deadline)
+                yield sse_event('fetch', {'accounts': len(plaid_txn['accounts']), 'transactions': len(plaid_txn['transactions'])})
+                address = verification.result()
+
+                # compute score, one pillar at a time
+                feedback = create_feedback_plaid()
+                feedback = plaid_bank_name(
+                    client, plaid_txn['item']['institution_id'], feedback, deadline)
+                deadline.check('scoring')
+                metrics = dict()
+                for stage, score, feedback in plaid_score_stages_cached(plaid_txn, feedback, feature_cache, as_of, metrics):
+                    if stage != 'score':
+                        yield sse_event(stage, {'score': round(score, 2)})
+                interpret = interpret_score_plaid(
+                    score, feedback, what_if_plaid(score, feedback, metrics))
+                attestation = issue_score(
+                    address, 'plaid', score, interpret, as_of)
+                yield sse_event('score', {'score': int(score), 'percentile': score_percentiles('plaid', score, metrics), 'feedback': interpret, 'attestation': attestation})
+                shadow_score('plaid', score, metrics, as_of,
+                             '/credit_score/plaid/stream')
+                drift_record('plaid', score, feedback)
+
+                message = qualitative_feedback_plaid(
+                    score, feedback, coinmarketcap_key, rate.result())
+                yield sse_event('message', {'message': message})
+
+            except Exception as e:
+                yield sse_event('error', {'status_code': error_status(e, deadline), 'message': str(e)})
+
+            finally:
+                executor.shutdown(wait=False)
+
+        return sse_response(stream())
+
+
+@app.route('/credit_score/coinbase/stream', methods=['POST'])
+def credit_score_coinbase_stream():
+
+    if request.method == 'POST':
+        deadline = g.deadline
+        try:
+            keplr_token = request.json.get('keplr_token', None)
+            coinbase_access_token = request.json.get(
+                'coinbase_access_token', None)
+            coinbase_refresh_token = request.json.get(
+                'coinbase_refresh_token', None)
+            coinmarketcap_key = request.json.get('coinmarketcap_key', None)
+            as_of = request_as_of(request.json.get('as_of', None))
+            # the wallet signature, bound to this request, is checked while the user's data is fetched
+            verification = verify_keplr_async(
+                keplr_token, request_binding(request.path, coinbase_access_token))
+        except Exception as e:
+            timestamp = datetime.now(timezone.utc).strftime(
+                '%m-%d-%Y %H:%M:%S GMT')
+            output = {
+                'endpoint': '/credit_score/coinbase/stream',
+                'title': 'Credit Score',
+                'status_code': 400,
+                'status': 'error',
+                'timestamp': timestamp,
+                'message': str(e)
+            }
+            ic(output)
+            return make_response(output, output['status_code'])
+
+        def stream():
+            # the SCRT rate is only needed by the final message: fetch it while the score is computed
+            executor = ThreadPoolExecutor(max_workers=1)
+            rate = executor.submit(market_rate, coinmarketcap_key, deadline)
+            try:
+                timestamp = datetime.now(timezone.utc).strftime(
+                    '%m-%d-%Y %H:%M:%S GMT')
+                yield sse_event('start', {'endpoint': '/credit_score/coinbase/stream', 'timestamp': timestamp})
+
+                # fetch and format data from user's Coinbase account
+                coinbase_acc, coinbase_txn = coinbase_fetch(
+                    coinbase_access_token, coinbase_refresh_token, coinmarketcap_key, deadline=deadline)
+                yield sse_event('fetch', {'accounts': len(coinbase_acc), 'transactions': len(coinbase_txn)})
+                address = verification.result()
+
+                # compute score, one pillar at a time
+                feedback = create_feedback_coinbase()
+                deadline.check('scoring')
+                metrics = dict()
+                for stage, score, feedback in coinbase_score_stages_cached(coinbase_acc, coinbase_txn, feedback, feature_cache, as_of, metrics):
+                    if stage != 'score':
+                        yield sse_event(stage, {'score': round(score, 2)})
+                interpret = interpret_score_coinbase(
+                    score, feedback, what_if_coinbase(score, feedback, metrics))
+                attestation = issue_score(
+                    address, 'coinbase', score, interpret, as_of)
+                yield sse_event('score', {'score': int(score), 'percentile': score_percentiles('coinbase', score, metrics), 'feedback': interpret, 'attestation': attestation})
+                shadow_score('coinbase', score, metrics, as_of,
+                             '/credit_score/coinbase/stream')
+                drift_record('coinbase', score, feedback)
+
+                message = qualitative_feedback_coinbase(
+                    score, feedback, coinmarketcap_key, rate.result())
+                yield sse_event('message', {'message': message})
+
+            except Exception as e:
+                yield sse_event('error', {'status_code': error_status(e, deadline), 'message': str(e)})
+
+            finally:
+                executor.shutdown(wait=False)
+
+        return sse_response(stream())
+
+
+@app.route('/credit_score/combined', methods=['POST'])
+def credit_score_combined():
+
+    if request.method == 'POST':
+        deadline = g.deadline
+        try:
+            keplr_token = request.json.get('keplr_token', None)
+            plaid_token = request.json.get('plaid_token', None)
+            plaid_client_id = request.json.get('plaid_client_id', None)
+            plaid_client_secret = request.json.get('plaid_client_secret', None)
+            coinbase_access_token = request.json.get(
+                'coinbase_access_token', None)
+            coinbase_refresh_token = request.json.get(
+                'coinbase_refresh_token', None)
+            coinmarketcap_key = request.json.get('coinmarketcap_key', None)
+            as_of = request_as_of(request.json.get('as_of', None))
+            # the wallet signature, bound to this request, is checked while the user's data is fetched
+            verification = verify_keplr_async(
+                keplr_token, request_binding(request.path, plaid_token, coinbase_access_token))
+            blend_policy = request.json.get(
+                'blend_policy', getenv('BLEND_POLICY', 'weighted'))
+            blend_weights = request.json.get('blend_weights', None)
+        except Exception as e:
+            timestamp = datetime.now(timezone.utc).strftime(
+                '%m-%d-%Y %H:%M:%S GMT')
+            output = {
+                'endpoint': '/credit_score/combined',
+                'title': 'Credit Score',
+                'status_code': 400,
+                'status': 'error',
+                'timestamp': timestamp,
+                'message': str(e)
+            }
+            ic(output)
+            return make_response(output, output['status_code'])
+
+        def score_plaid():
+            client, plaid_txn = plaid_fetch(
+                plaid_token, plaid_client_id, plaid_client_secret, deadline)
+            verification.result()
+            feedback = create_feedback_plaid()
+            feedback = plaid_bank_name(
+                client, plaid_txn['item']['institution_id'], feedback, deadline)
+            deadline.check('scoring')
+            metrics = dict()
+            score, feedback = plaid_score(
+                plaid_txn, feedback, feature_cache, as_of, metrics)
+            shadow_score('plaid', score, metrics,
+                         as_of, '/credit_score/combined')
+            drift_record('plaid', score, feedback)
+            return score, feedback, score_percentiles('plaid', score, metrics)
+
+        def score_coinbase(top_coins):
+            coinbase_acc, coinbase_txn = coinbase_fetch(
+                coinbase_access_token, coinbase_refresh_token, coinmarketcap_key, top_coins.result(), deadline)
+            verification.result()
+            feedback = create_feedback_coinbase()
+            deadline.check('scoring')
+            metrics = dict()
+            score, feedback = coinbase_score(
+                coinbase_acc, coinbase_txn, feedback, feature_cache, as_of, metrics)
+            shadow_score('coinbase', score, metrics,
+                         as_of, '/credit_score/combined')
+            drift_record('coinbase', score, feedback)
+            return score, feedback, score_percentiles('coinbase', score, metrics)
+
+        try:
+            # fetch both validators concurrently, sharing one coinmarketcap snapshot
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                rate = executor.submit(market_rate, coinmarketcap_key, deadline)
+                jobs = {}
+                if plaid_token:
+                    jobs['plaid'] = executor.submit(score_plaid)
+                if coinbase_access_token:
+                    top_coins = executor.submit(
+                        market_coins, coinmarketcap_key, deadline)
+                    jobs['coinbase'] = executor.submit(
+                        score_coinbase, top_coins)
+
+                scores, feedbacks, percentile, errors = {}, {}, {}, {}
+                for k, job in jobs.items():
+                    try:
+                        scores[k], feedbacks[k], percentile[k] = job.result()
+                    except Exception as e:
+                        errors[k] = str(e)
+                rate = rate.result()
+
+            address = verification.result()
+            if not scores:
+                raise Exception(' '.join(['{}: {}'.format(k.capitalize(), v) for k, v in errors.items()])
+                                or 'no plaid_token nor coinbase_access_token provided')
+
+            # blend scores and merge feedback
+            score = blend_score(scores, blend_policy, blend_weights)
+            messages, interprets = {}, {}
+            if 'plaid' in scores:
+                messages['plaid'] = qualitative_feedback_plaid(
+                    scores['plaid'], feedbacks['plaid'], coinmarketcap_key, rate)
+                interprets['plaid'] = interpret_score_plaid(
+                    scores['plaid'], feedbacks['plaid'])
+            if 'coinbase' in scores:
+                messages['coinbase'] = qualitative_feedback_coinbase(
+                    scores['coinbase'], feedbacks['coinbase'], coinmarketcap_key, rate)
+                interprets['coinbase'] = interpret_score_coinbase(
+                    scores['coinbase'], feedbacks['coinbase'])
+            for k, v in errors.items():
+                interprets[k] = {'error': v}
+            message = qualitative_feedback_combined(
+                score, messages, coinmarketcap_key, rate, errors)
+            feedback = interpret_score_combined(score, interprets)
+
+            status_code = 200
+            status = 'success'
+
+        except Exception as e:
+            status_code = error_status(e, deadline)
+            status = 'error'
+            score = 0
+            feedback = {}
+            percentile = None
+            message = str(e)
+
+        finally:
+            timestamp = datetime.now(timezone.utc).strftime(
+                '%m-%d-%Y %H:%M:%S GMT')
+            output = {
+                'endpoint': '/credit_score/combined',
+                'title': 'Credit Score',
+                'status_code': status_code,
+                'status': status,
+                'timestamp': timestamp,
+                'score': int(score),
+                'percentile': percentile,
+                'feedback': feedback,
+                'message': message
+            }
+            if score == 0:
+                output.pop('score', None)
+                output.pop('percentile', None)
+                output.pop('feedback', None)
+            if status_code == 200:
+                attestation = issue_score(
+                    address, 'combined', score, feedback, as_of)
+                if attestation:
+                    output['attestation'] = attestation
+            ic(output)
+            return make_response(output, output['status_code'])
+
+
+@app.route('/credit_score/<address>', methods=['GET'])
+def credit_score_ledger(address):
+
+    try:
+        provider = request.args.get('provider', None)
+        if provider not in [None, 'plaid', 'coinbase', 'combined']:
+            raise Exception('unknown provider: {}'.format(provider))
+        limit = min(int(request.args.get('limit', 1)), 100)
+        if limit < 1:
+            raise Exception('limit must be a positive integer')
+
+        # a single indexed read: the user's data is not fetched again
+        scores = score_ledger().history(address, provider, limit)
+        if scores:
+            status_code = 200
+            status = 'success'
+            message = None
+        else:
+            status_code = 404
+            status = 'error'
+            message = 'no score issued to this address'
+
+    except Exception as e:
+        status_code = 400
+        status = 'error'
+        scores = []
+        message = str(e)
+
+    finally:
+        timestamp = datetime.now(timezone.utc).strftime(
+            '%m-%d-%Y %H:%M:%S GMT')
+        output = {
+            'endpoint': '/credit_score/<address>',
+            'title': 'Credit Score',
+            'status_code': status_code,
+            'status': status,
+            'timestamp': timestamp,
+            'address': address,
+            'scores': scores,
+            'message': message
+        }
+        if status_code != 200:
+            output.pop('scores', None)
+        else:
+            output.pop('message', None)
+        ic(output)
+        return make_response(output, output['status_code'])
+
+
+@app.route('/attestation/key', methods=['GET'])
+def attestation_key():
+
+    timestamp = datetime.now(timezone.utc).strftime('%m-%d-%Y %H:%M:%S GMT')
+    a = attestor()
+    output = {
+        'endpoint': '/attestation/key',
+        'title': 'Attestation Key',
+        'status_code': 200 if a else 404,
+        'status': 'success' if a else 'error',
+        'timestamp': timestamp
+    }
+    if a:
+        output['key_id'] = a.key_id
+        output['public_key'] = a.key.public_key().export_key(format='PEM')
+    else:
+        output['message'] = 'attestation is disabled'
+    return make_response(output, output['status_code'])
+
+
+@app.route('/attestation/<leaf>', methods=['GET'])
+def attestation_lookup(leaf):
+
+    timestamp = datetime.now(timezone.utc).strftime('%m-%d-%Y %H:%M:%S GMT')
+    a = attestor()
+    attestation = a.lookup(leaf) if a else None
+    output = {
+        'endpoint': '/attestation/<leaf>',
+        'title': 'Attestation',
+        'status_code': 200 if attestation else 404,
+        'status': 'success' if attestation else 'error',
+        'timestamp': timestamp
+    }
+    if attestation:
+        output['attestation'] = attestation
+    else:
+        output['message'] = 'no attestation of this leaf'
+    return make_response(output, output['status_code'])
+
+
+@app.route('/webhooks/plaid', methods=['POST'])
+def plaid_webhook():
+
+    event = request.get_json(silent=True)
+    event = event if isinstance(event, dict) else {}
+    status_code, message = plaid_webhooks.notify(
+        event, request.get_data(), request.headers.get('Plaid-Verification'))
+    timestamp = datetime.now(timezone.utc).strftime('%m-%d-%Y %H:%M:%S GMT')
+    output = {
+        'endpoint': '/webhooks/plaid',
+        'title': 'Plaid Webhook',
+        'status_code': status_code,
+        'status': 'success' if status_code == 200 else 'error',
+        'timestamp': timestamp,
+        'message': message
+    }
+    ic(output)
+    return make_response(output, output['status_code'])
+
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_statistics():
+
+    timestamp = datetime.now(timezone.utc).strftime('%m-%d-%Y %H:%M:%S GMT')
+    output = {
+        'endpoint': '/cache/stats',
+        'title': 'Cache Statistics',
+        'status_code': 200,
+        'status': 'success',
+        'timestamp': timestamp,
+        'backend': getenv('CACHE_BACKEND', 'memory'),
+        'namespaces': cache_stats(),
+        'single_flight': single_flight_stats(),
+        'circuit_breakers': circuit_stats(),
+        'admission': admission.stats(),
+        'bulkheads': bulkhead_stats(),
+        'shadow': shadow_stats(),
+        'score_index': score_index_stats(),
+        'ledger': ledger_stats(),
+        'publication': publish_stats(),
+        'attestation': attest_stats(),
+        'keplr': keplr_stats(),
+        'plaid_webhooks': plaid_webhooks.snapshot()
+    }
+    return make_response(output, output['status_code'])
+
+
+@app.route('/drift/stats', methods=['GET'])
+def drift_statistics():
+
+    timestamp = datetime.now(timezone.utc).strftime('%m-%d-%Y %H:%M:%S GMT')
+    output = {
+        'endpoint': '/drift/stats',
+        'title': 'Drift Statistics',
+        'status_code': 200,
+        'status': 'success',
+        'timestamp': timestamp,
+        'model_version': model_version,
+        **drift_report()
+    }
+    return make_response(output, output['status_code'])
@@ -23,6 +23,13 @@ def comma_separated_list(l):
     return msg
 
 
+def loan_amount_text(loan_amount, rate):
+    '''Formats a loan amount in USD, and in SCRT when a conversion rate is available. A rate that failed to fetch is left out'''
+    if isinstance(rate, (int, float)) and not isinstance(rate, bool):
+        return '${:,.0f} USD ({:,.0f} SCRT)'.format(loan_amount, loan_amount*rate)
+    return '${:,.0f} USD'.format(loan_amount)
+
+
 # -------------------------------------------------------------------------- #
 #                                   Plaid                                    #
 # -------------------------------------------------------------------------- #
@@ -50,12 +57,13 @@ def create_interpret_plaid():
                 'credit_error': False,
                 'velocity_error': False,
                 'stability_error': False,
-                'diversity_error': False
+                'diversity_error': False,
+                'what_if': None
             }
             }
 
 
-def interpret_score_plaid(score, feedback):
+def interpret_score_plaid(score, feedback, what_if=None):
     '''
     Description:
         returns a dict explaining the meaning of the numerical score
@@ -63,6 +71,7 @@ def interpret_score_plaid(score, feedback):
     Parameters:
         score (float): user's SCRTsibyl numerical score
         feedback (dict): score feedback, reporting stats on main Plaid metrics
+        what_if (list): cheapest changes that move the user into the next score tier, see feedback/whatif.py
 
     Returns:
         interpret (dict): dictionaries with the major contributing score metrics 
@@ -103,6 +112,7 @@ def interpret_score_plaid(score, feedback):
                 interpret['advice']['stability_error'] = True
             if 'error' in list(feedback['diversity'].keys()):
                 interpret['advice']['diversity_error'] = True
+            interpret['advice']['what_if'] = what_if
 
     except Exception as e:
         interpret = str(e)
@@ -111,7 +121,7 @@ def interpret_score_plaid(score, feedback):
         return interpret
 
 
-def qualitative_feedback_plaid(score, feedback, coinmarketcap_key):
+def qualitative_feedback_plaid(score, feedback, coinmarketcap_key, rate=None):
     '''
     Description:
         A function to format and return a qualitative description of the numerical score obtained by the user
@@ -119,12 +129,15 @@ def qualitative_feedback_plaid(score, feedback, coinmarketcap_key):
     Parameters:
         score (float): user's SCRTsibyl numerical score
         feedback (dict): score feedback, reporting stats on main Plaid metrics
+        coinmarketcap_key (str): bearer token to authenticate into coinmarketcap API
+        rate (float): USD to SCRT conversion rate. If None, it is fetched from coinmarketcap
 
     Returns:
         msg (str): qualitative message explaining the numerical score to the user. Return this message to the user in the front end of the Dapp
     '''
     # Secret Rate
-    rate = coinmarketcap_rate(coinmarketcap_key, 'USD', 'SCRT')
+    if rate is None:
+        rate = coinmarketcap_rate(coinmarketcap_key, 'USD', 'SCRT')
 
     # SCORE
 
@@ -143,8 +156,8 @@ def qualitative_feedback_plaid(score, feedback, coinmarketcap_key):
             loan_bins[np.digitize(score, score_bins, right=False)])
 
         # Communicate the score
-        msg = 'Your SCRTsibyl score is {} - {} points. This score qualifies you for a short term loan of up to ${:,.0f} USD ({:,.0f} SCRT)'\
-            .format(quality.upper(), points, loan_amount, loan_amount*rate)
+        msg = 'Your SCRTsibyl score is {} - {} points. This score qualifies you for a short term loan of up to {}'\
+            .format(quality.upper(), points, loan_amount_text(loan_amount, rate))
         if ('loan_duedate' in list(feedback['stability'].keys())):
             msg = msg + ' over a recommended pay back period of {0} monthly installments.'.format(
                 feedback['stability']['loan_duedate'])
@@ -163,8 +176,13 @@ def qualitative_feedback_plaid(score, feedback, coinmarketcap_key):
 
         # Tot balance now
         if 'cumulative_current_balance' in all_keys:
-            msg = msg + ' Your total current balance is ${:,.0f} USD across all accounts held with {}.'.format(
-                feedback['stability']['cumulative_current_balance'], feedback['diversity']['bank_name'])
+            msg = msg + ' Your total current balance is ${:,.0f} USD across all accounts'.format(
+                feedback['stability']['cumulative_current_balance'])
+            # the bank name is left out when it could not be fetched
+            if feedback['diversity'].get('bank_name'):
+                msg = msg + ' held with {}'.format(
+                    feedback['diversity']['bank_name'])
+            msg = msg + '.'
 
         # ADVICE
 
@@ -210,12 +228,13 @@ def create_interpret_coinbase():
                 'kyc_error': False,
                 'history_error': False,
                 'liquidity_error': False,
-                'activity_error': False
+                'activity_error': False,
+                'what_if': None
             }
             }
 
 
-def interpret_score_coinbase(score, feedback):
+def interpret_score_coinbase(score, feedback, what_if=None):
     '''
     Description:
         returns a dict explaining the meaning of the numerical score
@@ -223,6 +242,7 @@ def interpret_score_coinbase(score, feedback):
     Parameters:
         score (float): user's SCRTsibyl numerical score
         feedback (dict): score feedback, reporting stats on main Coinbase metrics
+        what_if (list): cheapest changes that move the user into the next score tier, see feedback/whatif.py
 
     Returns:
         interpret (dict): dictionaries with the major contributing score metrics 
@@ -257,6 +277,7 @@ def interpret_score_coinbase(score, feedback):
                 interpret['advice']['liquidity_error'] = True
             if 'error' in list(feedback['activity'].keys()):
                 interpret['advice']['activity_error'] = True
+            interpret['advice']['what_if'] = what_if
 
     except Exception as e:
         interpret = str(e)
@@ -265,7 +286,7 @@ def interpret_score_coinbase(score, feedback):
         return interpret
 
 
-def qualitative_feedback_coinbase(score, feedback, coinmarketcap_key):
+def qualitative_feedback_coinbase(score, feedback, coinmarketcap_key, rate=None):
     '''
     Description:
         A function to format and return a qualitative description of the numerical score obtained by the user
@@ -273,13 +294,16 @@ def qualitative_feedback_coinbase(score, feedback, coinmarketcap_key):
     Parameters:
         score (float): user's SCRTsibyl numerical score
         feedback (dict): score feedback, reporting stats on main Coinbase metrics
+        coinmarketcap_key (str): bearer token to authenticate into coinmarketcap API
+        rate (float): USD to SCRT conversion rate. If None, it is fetched from coinmarketcap
 
     Returns:
         msg (str): qualitative message explaining the numerical score to the user. Return this message to the user in the front end of the Dapp
     '''
 
     # Secret Rate
-    rate = coinmarketcap_rate(coinmarketcap_key, 'USD', 'SCRT')
+    if rate is None:
+        rate = coinmarketcap_rate(coinmarketcap_key, 'USD', 'SCRT')
 
     # SCORE
 
@@ -298,8 +322,8 @@ def qualitative_feedback_coinbase(score, feedback, coinmarketcap_key):
             loan_bins[np.digitize(score, score_bins, right=False)])
 
         # Communicate the score
-        msg = 'Congratulations your Coinbase KYC status is successful! Your SCRTsibyl score is {} - {} points. This qualifies you for a short term loan of up to ${:,.0f} USD ({:,.0f} SCRT)'\
-            .format(quality.upper(), points, loan_amount, loan_amount*rate)
+        msg = 'Congratulations your Coinbase KYC status is successful! Your SCRTsibyl score is {} - {} points. This qualifies you for a short term loan of up to {}'\
+            .format(quality.upper(), points, loan_amount_text(loan_amount, rate))
         if ('loan_duedate' in list(feedback['liquidity'].keys())):
             msg = msg + ' over a recommended pay back period of {0} monthly installments.'.format(
                 feedback['liquidity']['loan_duedate'])
@@ -333,3 +357,71 @@ def qualitative_feedback_coinbase(score, feedback, coinmarketcap_key):
                 comma_separated_list(metrics_w_errors))
 
     return msg
+
+
+# -------------------------------------------------------------------------- #
+#                              Plaid + Coinbase                              #
+# -------------------------------------------------------------------------- #
+
+def interpret_score_combined(score, interprets):
+    '''
+    Description:
+        returns a dict explaining the meaning of a score blended across several validators
+
+    Parameters:
+        score (float): user's blended SCRTsibyl numerical score
+        interprets (dict): validator-interpret pairs, as returned by interpret_score_plaid and interpret_score_coinbase
+
+    Returns:
+        interpret (dict): blended score summary, followed by the interpretation of each validator's score
+    '''
+    try:
+        interpret = {'score': {
+            'score_exist': True,
+            'points': int(score),
+            'quality': score_quality[np.digitize(score, score_bins, right=False)],
+            'loan_amount': int(loan_bins[np.digitize(score, score_bins, right=False)])
+        }}
+        interpret.update(interprets)
+
+    except Exception as e:
+        interpret = str(e)
+
+    finally:
+        return interpret
+
+
+def qualitative_feedback_combined(score, messages, coinmarketcap_key, rate=None, errors=None):
+    '''
+    Description:
+        A function to format and return a qualitative description of a score blended across several validators
+
+    Parameters:
+        score (float): user's blended SCRTsibyl numerical score
+        messages (dict): validator-message pairs, as returned by qualitative_feedback_plaid and qualitative_feedback_coinbase,
+            for the validators the score is blended from
+        coinmarketcap_key (str): bearer token to authenticate into coinmarketcap API
+        rate (float): USD to SCRT conversion rate. If None, it is fetched from coinmarketcap
+        errors (dict): validator-error pairs, for the validators that failed and were left out of the blend
+
+    Returns:
+        msg (str): qualitative message explaining the blended score, followed by the message of each validator
+    '''
+    # Secret Rate
+    if rate is None:
+        rate = coinmarketcap_rate(coinmarketcap_key, 'USD', 'SCRT')
+
+    quality = score_quality[np.digitize(score, score_bins, right=False)]
+    points = int(score)
+    loan_amount = int(loan_bins[np.digitize(score, score_bins, right=False)])
+
+    msg = 'Your combined SCRTsibyl score is {} - {} points, based on {}. This score qualifies you for a short term loan of up to {}.'\
+        .format(quality.upper(), points, comma_separated_list([k.capitalize() for k in messages.keys()]), loan_amount_text(loan_amount, rate))
+
+    for k, v in messages.items():
+        msg = msg + ' {}: {}'.format(k.capitalize(), v)
+
+    for k, v in (errors or {}).items():
+        msg = msg + ' {} was left out: {}'.format(k.capitalize(), v)
+
+    return msg
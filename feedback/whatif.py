@@ -0,0 +1,301 @@
+from feedback.message import score_bins, score_quality, loan_bins
+from support import metrics_plaid, metrics_coinbase
+from support.score import *
+
+from os import getenv
+import numpy as np
+
+
+# -------------------------------------------------------------------------- #
+#                                   Levers                                   #
+# -------------------------------------------------------------------------- #
+# A lever is a change the user can make. Each lever has levels, from no change to the largest change considered.
+# The cost of a set of changes is the number of levers pulled, then the sum of the level ranks:
+# the cheapest changes are the fewest and smallest ones
+
+# USD added to the cumulative credit limit
+credit_limit_levels = np.array([0, 500, 1000, 2000, 5000, 10000])
+# USD added to the cumulative balance
+balance_levels = np.array([0, 500, 1000, 2000, 5000, 10000])
+# credit utilization ratio to lower to
+utilization_levels = np.array([0.5, 0.3, 0.2, 0.1, 0])
+# months of additional history
+history_levels = np.array([0, 1, 3, 6, 12])
+
+
+def lever_grid(levels):
+    '''
+    Description:
+        every combination of the levels of the levers, flattened
+
+    Parameters:
+        levels (dict): lever-levels pairs. The first level of each lever is no change
+
+    Returns:
+        grid (dict): lever-values pairs, one value per combination
+        cost (np.ndarray): number of levers pulled and sum of level ranks of each combination
+    '''
+    ranks = np.meshgrid(*[np.arange(len(v)) for v in levels.values()],
+                        indexing='ij')
+    ranks = [r.ravel() for r in ranks]
+    grid = {k: v[r] for (k, v), r in zip(levels.items(), ranks)}
+    pulled = sum([(r > 0).astype(int) for r in ranks])
+    return grid, np.stack([pulled, sum(ranks)])
+
+
+def cheapest_changes(score, levels, scores):
+    '''
+    Description:
+        the cheapest combinations of changes that move a score into the next tier of score_bins
+
+    Parameters:
+        score (float): current score
+        levels (dict): lever-levels pairs
+        scores (function): takes the grid of lever values and returns the score of each combination
+
+    Returns:
+        changes (list): at most WHAT_IF_MAX (default 3) combinations, cheapest first, each with the levers to pull,
+            the new score, and its quality and loan amount. Empty if the user is in the top tier or no combination is enough
+    '''
+    tier = np.digitize(score, score_bins, right=False)
+    if tier == len(score_bins):
+        return []
+
+    grid, cost = lever_grid(levels)
+    new = scores(grid)
+    reach = np.flatnonzero(new >= score_bins[tier])
+    # cheapest first, and the highest score among equally cheap changes
+    best = reach[np.lexsort((-new[reach], cost[1][reach], cost[0][reach]))]
+
+    changes = list()
+    for i in best[:int(getenv('WHAT_IF_MAX', 3))]:
+        t = np.digitize(new[i], score_bins, right=False)
+        changes.append({
+            'changes': {k: v[i].item() for k, v in grid.items() if v[i] != levels[k][0]},
+            'score': int(new[i]),
+            'quality': score_quality[t],
+            'loan_amount': int(loan_bins[t])
+        })
+    return changes
+
+
+def pillar_sum(pillars, weights):
+    '''weighted sum of pillar scores, each an array over the combinations of changes'''
+    return sum([w*pillars[p] for p, w in weights.items()])
+
+
+def running_balance_score(grid, bins, volume, m, base, added):
+    '''
+    Description:
+        a running balance metric after money is added now: every running balance, and so their weighted average,
+        rises by the amount added. The overdraft penalty of the current metric is kept
+
+    Parameters:
+        grid (np.ndarray): scoring grid of the metric, indexed by [m, volume bin]
+        bins (np.ndarray): volume bins
+        volume (float): current weighted average running balance
+        m (int): row of the grid (duration bin)
+        base (float): current metric score
+        added (np.ndarray): USD added, one value per combination of changes
+
+    Returns:
+        score (np.ndarray): metric score of each combination
+    '''
+    penalty = grid[m][np.digitize(volume, bins, right=True)] - base
+    return grid[m][np.digitize(volume + added, bins, right=True)] - penalty
+
+
+# -------------------------------------------------------------------------- #
+#                                   Plaid                                    #
+# -------------------------------------------------------------------------- #
+
+def plaid_levels(feedback, metrics):
+    '''
+    Description:
+        the levers of a Plaid user: only those of the metrics the user is scored on, and whose inputs are known
+
+    Parameters:
+        feedback (dict): score feedback
+        metrics (dict): branch and metric scores of each pillar, as filled by plaid_score(..., metrics=metrics)
+
+    Returns:
+        levels (dict): lever-levels pairs. The first level of each lever is no change
+    '''
+    credit = feedback['credit']
+    known = metrics['branch'] == 'credit' and all([k in credit for k in [
+        'credit_limit', 'credit_limit_duration_(days)', 'utilization_ratio', 'utilization_months', 'credit_duration_(days)']])
+    utilization = credit.get('utilization_ratio', 0)
+    return {
+        'credit_limit': credit_limit_levels if known else credit_limit_levels[:1],
+        'balance': balance_levels,
+        'utilization': np.concatenate([[utilization], utilization_levels[utilization_levels < utilization]])
+        if known else np.array([utilization]),
+        'history': history_levels if known else history_levels[:1]
+    }
+
+
+def plaid_scores(feedback, metrics, grid):
+    '''
+    Description:
+        the score of a Plaid user after each combination of changes. Only the metrics moved by a change are looked up
+        in the scoring grids again, the others keep their live scores:
+            - credit_limit: USD added to the limit of the credit cards. It also lowers the utilization ratio
+            - balance: USD added now to a checking account. It raises the balance now and the running balances
+            - utilization: credit utilization ratio, lowered to the given value
+            - history: months of additional credit history
+
+    Parameters:
+        feedback (dict): score feedback
+        metrics (dict): branch and metric scores of each pillar, as filled by plaid_score(..., metrics=metrics)
+        grid (dict): lever-values pairs, one value per combination, as returned by lever_grid()
+
+    Returns:
+        scores (np.ndarray): score of each combination
+    '''
+    g = metrics_plaid
+    credit, stability = feedback['credit'], feedback['stability']
+    days = 30*grid['history']
+    m = {p: {k: np.full(len(days), float(v)) for k, v in metrics[p].items()}
+         for p in plaid_pillar_weights[metrics['branch']]}
+
+    if 'credit' in m:
+        limit = credit.get('credit_limit', 0)
+        moved = (grid['credit_limit'] > 0) | (days > 0)
+        if moved.any():
+            s = g.m7x7_03_17[np.digitize(credit['credit_limit_duration_(days)'] + days, g.duration, right=True),
+                             np.digitize(limit + grid['credit_limit'], g.volume_cred_limit, right=True)]
+            m['credit']['limit'] = np.where(moved, s, m['credit']['limit'])
+
+        utilization = np.minimum(grid['utilization'], credit.get(
+            'utilization_ratio', 0)*limit/np.maximum(limit + grid['credit_limit'], 1))
+        moved = (grid['utilization'] != credit.get('utilization_ratio', 0)) | (
+            grid['credit_limit'] > 0) | (days > 0)
+        if moved.any():
+            s = g.m7x7_85_55[np.digitize((credit['utilization_months'] + grid['history'])*30, g.duration, right=True),
+                             np.digitize(utilization, g.percent_cred_util, right=True)]
+            m['credit']['util_ratio'] = np.where(
+                moved, s, m['credit']['util_ratio'])
+
+        if (days > 0).any():
+            s = g.fico_medians[np.digitize(
+                credit['credit_duration_(days)'] + days, g.duration, right=True)]
+            m['credit']['length'] = np.where(
+                days > 0, s, m['credit']['length'])
+
+    added = grid['balance']
+    if (added > 0).any():
+        balance = stability.get('cumulative_current_balance', 0) + added
+        s = np.where(balance > 0, g.fico_medians[np.digitize(
+            balance, g.volume_balance_now, right=True)], 0)
+        m['stability']['balance'] = np.where(
+            added > 0, s, m['stability']['balance'])
+
+        if 'min_running_balance' in stability and 'error' not in stability:
+            s = running_balance_score(g.m7x7_85_55, g.volume_min_run, stability['min_running_balance'],
+                                      np.digitize(stability['min_running_timeframe'], g.duration, right=True), m['stability']['run_balance'], added)
+            m['stability']['run_balance'] = np.where(
+                added > 0, s.round(2), m['stability']['run_balance'])
+
+    pillars = {p: pillar_sum(m[p], plaid_weights[p]) for p in m}
+    return 300 + 600*pillar_sum(pillars, plaid_pillar_weights[metrics['branch']])
+
+
+def what_if_plaid(score, feedback, metrics):
+    '''
+    Description:
+        the cheapest changes that move a Plaid user into the next score tier, among a higher credit limit,
+        a higher balance, a lower credit utilization, and more months of credit history.
+        All combinations are scored in one vectorized pass over the scoring grids, from the metrics of the live score
+
+    Parameters:
+        score (float): user's score
+        feedback (dict): score feedback
+        metrics (dict): branch and metric scores of each pillar, as filled by plaid_score(..., metrics=metrics)
+
+    Returns:
+        changes (list): see cheapest_changes()
+    '''
+    try:
+        return cheapest_changes(score, plaid_levels(feedback, metrics), lambda grid: plaid_scores(feedback, metrics, grid))
+    except Exception:
+        return []
+
+
+# -------------------------------------------------------------------------- #
+#                                  Coinbase                                  #
+# -------------------------------------------------------------------------- #
+
+def coinbase_levels(feedback, metrics):
+    '''the levers of a Coinbase user: a higher balance, and more months of history if the wallet age is known'''
+    return {
+        'balance': balance_levels,
+        'history': history_levels if 'wallet_age(days)' in feedback['history'] else history_levels[:1]
+    }
+
+
+def coinbase_scores(feedback, metrics, grid):
+    '''
+    Description:
+        the score of a Coinbase user after each combination of changes:
+            - balance: USD added now to the wallets. It raises the balance now and the running balances
+            - history: months of additional wallet history
+
+    Parameters:
+        feedback (dict): score feedback
+        metrics (dict): branch and metric scores of each pillar, as filled by coinbase_score(..., metrics=metrics)
+        grid (dict): lever-values pairs, one value per combination, as returned by lever_grid()
+
+    Returns:
+        scores (np.ndarray): score of each combination
+    '''
+    g = metrics_coinbase
+    history, liquidity = feedback['history'], feedback['liquidity']
+    days = 30*grid['history']
+    m = {p: {k: np.full(len(days), float(v)) for k, v in metrics[p].items()}
+         for p in coinbase_pillar_weights}
+
+    if (days > 0).any():
+        s = g.fico_medians[np.digitize(
+            history['wallet_age(days)'] + days, g.duration, right=True)]
+        m['history']['longevity'] = np.where(
+            days > 0, s, m['history']['longevity'])
+
+    added = grid['balance']
+    if (added > 0).any():
+        balance = liquidity.get('current_balance', 0) + added
+        s = np.where(balance < 500, 0.01, g.fico_medians[np.digitize(
+            balance, g.volume_balance_now, right=True)])
+        m['liquidity']['balance'] = np.where(
+            added > 0, s, m['liquidity']['balance'])
+
+        # the overdraft penalty is only known when the running balance already scored on the grid
+        if liquidity.get('avg_running_balance', 0) >= 500:
+            n = np.digitize(
+                liquidity['balance_timeframe(months)']*30, g.duration, right=True)
+            s = running_balance_score(g.m7x7_85_55.T, g.volume_balance_now, liquidity['avg_running_balance'],
+                                      n, m['liquidity']['run_balance'], added)
+            m['liquidity']['run_balance'] = np.where(
+                added > 0, s, m['liquidity']['run_balance'])
+
+    pillars = {p: pillar_sum(m[p], coinbase_weights[p]) for p in m}
+    return 300 + 600*pillar_sum(pillars, coinbase_pillar_weights)
+
+
+def what_if_coinbase(score, feedback, metrics):
+    '''
+    Description:
+        the cheapest changes that move a Coinbase user into the next score tier, among a higher balance
+        and more months of wallet history, scored in one vectorized pass over the scoring grids
+
+    Parameters:
+        score (float): user's score
+        feedback (dict): score feedback
+        metrics (dict): branch and metric scores of each pillar, as filled by coinbase_score(..., metrics=metrics)
+
+    Returns:
+        changes (list): see cheapest_changes()
+    '''
+    try:
+        return cheapest_changes(score, coinbase_levels(feedback, metrics), lambda grid: coinbase_scores(feedback, metrics, grid))
+    except Exception:
+        return []
@@ -0,0 +1,131 @@
+from collections import OrderedDict
+
+import threading
+import time
+
+
+class TokenBucket:
+    '''A token bucket: `rate` requests per second on average, with bursts of up to `burst` requests'''
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        '''take a token. Returns 0 if one was available, or else the seconds until the next token'''
+        t = time.monotonic()
+        self.tokens = min(self.burst, self.tokens +
+                          (t - self.updated)*self.rate)
+        self.updated = t
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens)/self.rate
+
+
+class RateLimiter:
+    '''One token bucket per client. The least recently seen clients are forgotten beyond max_clients'''
+
+    def __init__(self, rate, burst, max_clients=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.rejected = 0
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, client):
+        with self._lock:
+            bucket = self._buckets.pop(client, None) or TokenBucket(
+                self.rate, self.burst)
+            self._buckets[client] = bucket
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+            wait = bucket.take()
+            if wait:
+                self.rejected += 1
+            return wait
+
+
+class ConcurrencyLimiter:
+    '''
+    At most `limit` requests run at once. Up to `queue` more wait for a slot,
+    and the others are rejected right away rather than piling up
+    '''
+
+    def __init__(self, limit, queue):
+        self.limit = limit
+        self.queue = queue
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout):
+        '''take a slot, waiting at most timeout seconds. Returns False if the request should be shed'''
+        with self._cond:
+            if self.active < self.limit:
+                self.active += 1
+                return True
+            if self.waiting >= self.queue or timeout <= 0:
+                self.rejected += 1
+                return False
+
+            self.waiting += 1
+            try:
+                if self._cond.wait_for(lambda: self.active < self.limit, timeout):
+                    self.active += 1
+                    return True
+                self.timed_out += 1
+                return False
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    def stats(self):
+        return {'active': self.active, 'waiting': self.waiting, 'rejected': self.rejected, 'timed_out': self.timed_out}
+
+
+class AdmissionControl:
+    '''
+    Admission control in front of the scoring endpoints: a per-client rate limit, then a global concurrency limit.
+    Under overload, requests are shed right away with a Retry-After hint instead of queueing until they time out
+    '''
+
+    def __init__(self, rate, burst, limit, queue, max_wait):
+        self.clients = RateLimiter(rate, burst)
+        self.slots = ConcurrencyLimiter(limit, queue)
+        self.max_wait = max_wait
+
+    def admit(self, client, deadline):
+        '''
+        Description:
+            admit a request, or tell why it is shed
+
+        Parameters:
+            client (str): client identifier, e.g. a hashed API key or keplr_token
+            deadline (Deadline): deadline of the request. A request never waits for a slot beyond its deadline
+
+        Returns:
+            status_code (int): 200 if admitted, 429 if the client is over its rate, 503 if the server is saturated
+            retry_after (int): seconds the client should wait before retrying
+        '''
+        wait = self.clients.take(client)
+        if wait:
+            return 429, max(1, int(wait + 0.999))
+        if not self.slots.acquire(min(self.max_wait, deadline.remaining())):
+            return 503, 1
+        return 200, 0
+
+    def release(self):
+        self.slots.release()
+
+    def stats(self):
+        return {**self.slots.stats(), 'rate_limited': self.clients.rejected}
@@ -0,0 +1,138 @@
+from optimization.deadline import DeadlineExceeded
+from contextlib import contextmanager
+from functools import wraps
+from os import getenv
+
+import inspect
+import threading
+import time
+
+
+class BulkheadFull(Exception):
+    '''raised instead of calling a provider whose bulkhead has no free slot'''
+
+
+class Bulkhead:
+    '''
+    A bounded pool of concurrent calls to one provider, so that a slow provider can only tie up its own slots,
+    and never all the threads of the worker.
+    A call waits at most max_wait seconds for a free slot, and is rejected with BulkheadFull otherwise.
+    A call with a deadline never waits beyond it, and fails with DeadlineExceeded once it runs out.
+    The size of the pool is set per deployment with the BULKHEAD_<NAME> environment variable
+
+    Use it as a context manager or as a decorator, which waits within the `deadline` argument of the function, if any:
+        @bulkhead('coinbase')
+        def coinbase_accounts(client):
+
+        with bulkhead('plaid').slot(deadline):
+    '''
+
+    def __init__(self, name, limit=4, max_wait=None):
+        self.name = name
+        self.default_limit = limit
+        self.max_wait = max_wait
+        self.active = 0
+        self.calls = 0
+        self.rejected = 0
+        self.queue_time = 0.0
+        self.max_queue_time = 0.0
+        self._cond = threading.Condition()
+
+    @property
+    def limit(self):
+        return int(getenv('BULKHEAD_' + self.name.upper(), self.default_limit))
+
+    def acquire(self, deadline=None):
+        max_wait = float(getenv('BULKHEAD_MAX_WAIT', 1)
+                         ) if self.max_wait is None else self.max_wait
+        # the caller's deadline cuts the wait short: the request ran out of time, the provider is not to blame
+        capped = deadline is not None and deadline.caps(max_wait)
+        if deadline is not None:
+            max_wait = max(deadline.timeout(max_wait), 0)
+        t0 = time.monotonic()
+        with self._cond:
+            admitted = self._cond.wait_for(
+                lambda: self.active < self.limit, max_wait)
+            waited = time.monotonic() - t0
+            self.queue_time += waited
+            self.max_queue_time = max(self.max_queue_time, waited)
+            if not admitted:
+                self.rejected += 1
+                if capped:
+                    raise DeadlineExceeded(
+                        'Request deadline exceeded waiting for a {} slot'.format(self.name.capitalize()))
+                raise BulkheadFull(
+                    '{} is saturated, retry later'.format(self.name.capitalize()))
+            self.active += 1
+            self.calls += 1
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    @contextmanager
+    def slot(self, deadline=None):
+        '''hold a slot for the duration of a with block, waiting for it within the deadline, if any'''
+        self.acquire(deadline)
+        try:
+            yield self
+        finally:
+            self.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, kind, e, traceback):
+        self.release()
+        return False
+
+    def __call__(self, func):
+        signature = inspect.signature(func)
+
+        @wraps(func)
+        def bounded(*args, **kwargs):
+            deadline = signature.bind(*args, **kwargs).arguments.get(
+                'deadline') if 'deadline' in signature.parameters else None
+            with self.slot(deadline):
+                return func(*args, **kwargs)
+        return bounded
+
+    def stats(self):
+        waits = self.calls + self.rejected
+        return {
+            'limit': self.limit,
+            'active': self.active,
+            'calls': self.calls,
+            'rejected': self.rejected,
+            'mean_queue_time': self.queue_time/waits if waits else 0,
+            'max_queue_time': self.max_queue_time
+        }
+
+
+_bulkheads = dict()
+_lock = threading.Lock()
+
+
+def bulkhead(name, limit=4):
+    '''
+    Description:
+        returns the bulkhead of a provider, creating it on first use
+
+    Parameters:
+        name (str): provider name, e.g. 'plaid', 'coinbase', 'coinmarketcap'
+        limit (int): default max number of concurrent calls to the provider, per worker
+
+    Returns:
+        bulkhead (Bulkhead)
+    '''
+    with _lock:
+        if name not in _bulkheads:
+            _bulkheads[name] = Bulkhead(name, limit)
+    return _bulkheads[name]
+
+
+def bulkhead_stats():
+    '''slots, calls, rejections, and queue times of the bulkhead of each provider called by this worker'''
+    return {k: v.stats() for k, v in _bulkheads.items()}
@@ -0,0 +1,457 @@
+from collections import OrderedDict
+from collections import Counter
+from Crypto.Cipher import AES
+from urllib.parse import urlparse
+from os import getenv
+
+import threading
+import sqlite3
+import hashlib
+import pickle
+import socket
+import hmac
+import time
+import os
+
+# per-process fallback used when no CACHE_SECRET is configured
+_process_secret = os.urandom(32)
+
+
+def hash_key(*parts):
+    '''
+    Description:
+        derive a cache key from values that may contain secrets (e.g. access tokens).
+        The key is an HMAC-SHA256 digest so that secrets are never stored in clear, nor recoverable from the key
+
+    Parameters:
+        parts (str): values identifying the cached entry
+
+    Returns:
+        key (str): hex digest
+    '''
+    message = '\x1f'.join([str(p) for p in parts]).encode()
+    return hmac.new(_cache_secret(), message, hashlib.sha256).hexdigest()
+
+
+def _cache_secret():
+    secret = getenv('CACHE_SECRET')
+    return secret.encode() if secret else _process_secret
+
+
+def seal_value(value, purpose):
+    '''
+    Description:
+        encrypt and authenticate a value (AES-256-GCM) with a key derived from CACHE_SECRET, so that values holding
+        secrets (e.g. access tokens) can be kept in a shared cache. Workers only share sealed values if they share CACHE_SECRET
+
+    Parameters:
+        value (object): any picklable value
+        purpose (str): what the value is sealed for. A value sealed for one purpose cannot be unsealed for another
+
+    Returns:
+        sealed (bytes): nonce, tag, and ciphertext
+    '''
+    key = hmac.new(_cache_secret(), purpose.encode(), hashlib.sha256).digest()
+    cipher = AES.new(key, AES.MODE_GCM)
+    ciphertext, tag = cipher.encrypt_and_digest(pickle.dumps(value))
+    return cipher.nonce + tag + ciphertext
+
+
+def unseal_value(sealed, purpose):
+    '''the value sealed by seal_value() for the same purpose, or None if it was sealed with another secret or tampered with'''
+    key = hmac.new(_cache_secret(), purpose.encode(), hashlib.sha256).digest()
+    try:
+        cipher = AES.new(key, AES.MODE_GCM, nonce=sealed[:16])
+        return pickle.loads(cipher.decrypt_and_verify(sealed[32:], sealed[16:32]))
+    except (ValueError, TypeError):
+        return None
+
+
+# -------------------------------------------------------------------------- #
+#                                  Backends                                  #
+# -------------------------------------------------------------------------- #
+# A backend stores bytes under 'namespace:key' strings, with a time to live in seconds.
+# Pick the backend that matches the sharing level of the deployment:
+#   - memory: one cache per worker process
+#   - sqlite: one cache per machine, shared by all workers through a local file
+#   - redis: one cache for the whole fleet, through any Redis-protocol server
+
+
+class CacheBackend:
+    '''Interface shared by all cache backends'''
+
+    def __init__(self):
+        # expired or evicted entries, by namespace
+        self.evictions = Counter()
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self, prefix=''):
+        raise NotImplementedError
+
+    def evicted(self, key):
+        self.evictions[key.split(':', 1)[0]] += 1
+
+
+class MemoryBackend(CacheBackend):
+    '''
+    A thread-safe in-process LRU cache. The least recently used entries are evicted
+    once the cache holds more than max_bytes of values or more than max_entries entries.
+    '''
+
+    def __init__(self, max_bytes=64 << 20, max_entries=None):
+        super().__init__()
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.size = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                self._pop(key)
+                self.evicted(key)
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._pop(key)
+            self._data[key] = (time.monotonic() + ttl, value)
+            self.size += len(value)
+            while (self.size > self.max_bytes or (self.max_entries and len(self._data) > self.max_entries)) and len(self._data) > 1:
+                oldest = next(iter(self._data))
+                self._pop(oldest)
+                self.evicted(oldest)
+
+    def delete(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def clear(self, prefix=''):
+        with self._lock:
+            for key in [k for k in self._data if k.startswith(prefix)]:
+                self._pop(key)
+
+    def _pop(self, key):
+        entry = self._data.pop(key, None)
+        if entry:
+            self.size -= len(entry[1])
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteBackend(CacheBackend):
+    '''
+    A cache in a local SQLite file, shared by all the worker processes of a machine.
+    Every `purge_every` writes of a process, the expired entries are deleted, so that the file does not grow without bound
+    '''
+
+    def __init__(self, path, purge_every=1000):
+        super().__init__()
+        self.path = path
+        self.purge_every = purge_every
+        self.writes = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._connect().execute(
+            'CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, expires REAL)')
+
+    def _connect(self):
+        if not hasattr(self._local, 'db'):
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return self._local.db
+
+    def get(self, key):
+        row = self._connect().execute(
+            'SELECT value, expires FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        if row[1] < time.time():
+            self.delete(key)
+            self.evicted(key)
+            return None
+        return row[0]
+
+    def set(self, key, value, ttl):
+        self._connect().execute('INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)',
+                                (key, value, time.time() + ttl))
+        with self._lock:
+            self.writes += 1
+            purge = self.writes % self.purge_every == 0
+        if purge:
+            self.purge()
+
+    def delete(self, key):
+        self._connect().execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def clear(self, prefix=''):
+        self._connect().execute(
+            'DELETE FROM cache WHERE substr(key, 1, ?) = ?', (len(prefix), prefix))
+
+    def purge(self):
+        '''delete all expired entries, and return how many were deleted'''
+        return self._connect().execute(
+            'DELETE FROM cache WHERE expires < ?', (time.time(),)).rowcount
+
+
+class RedisBackend(CacheBackend):
+    '''
+    A cache on any server speaking the Redis protocol (RESP), shared by the whole fleet.
+    Connections are kept open, one per thread. Expiry and eviction are left to the server.
+    '''
+
+    def __init__(self, url, timeout=1.0):
+        super().__init__()
+        url = urlparse(url)
+        self.host = url.hostname or 'localhost'
+        self.port = url.port or 6379
+        self.password = url.password
+        self.db = int(url.path.strip('/') or 0)
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        if getattr(self._local, 'sock', None) is None:
+            sock = socket.create_connection(
+                (self.host, self.port), timeout=self.timeout)
+            self._local.sock = sock
+            self._local.reader = sock.makefile('rb')
+            if self.password:
+                self._command('AUTH', self.password)
+            if self.db:
+                self._command('SELECT', self.db)
+        return self._local.sock
+
+    def _command(self, *args):
+        sock = self._connect()
+        request = [b'*%d\r\n' % len(args)]
+        for a in args:
+            a = a if isinstance(a, bytes) else str(a).encode()
+            request.append(b'$%d\r\n%s\r\n' % (len(a), a))
+        try:
+            sock.sendall(b''.join(request))
+            return self._reply()
+        except (OSError, ConnectionError):
+            # close the broken connection, the next command reconnects
+            self.close()
+            raise
+
+    def close(self):
+        '''close the connection of this thread, if any'''
+        sock, reader = getattr(self._local, 'sock', None), getattr(self._local, 'reader', None)
+        self._local.sock = self._local.reader = None
+        for f in [reader, sock]:
+            if f is not None:
+                try:
+                    f.close()
+                except OSError:
+                    pass
+
+    def _reply(self):
+        line = self._local.reader.readline()
+        if not line:
+            raise ConnectionError('connection closed by the cache server')
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest
+        if kind == b'-':
+            raise Exception(rest.decode())
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            if int(rest) < 0:
+                return None
+            data = self._local.reader.read(int(rest) + 2)
+            return data[:-2]
+        if kind == b'*':
+            return [self._reply() for _ in range(int(rest))] if int(rest) >= 0 else None
+        raise Exception('unexpected reply from the cache server')
+
+    def get(self, key):
+        return self._command('GET', key)
+
+    def set(self, key, value, ttl):
+        self._command('SET', key, value, 'PX', max(1, int(ttl*1000)))
+
+    def delete(self, key):
+        self._command('DEL', key)
+
+    def clear(self, prefix=''):
+        cursor = b'0'
+        while True:
+            cursor, keys = self._command(
+                'SCAN', cursor, 'MATCH', prefix + '*', 'COUNT', 1000)
+            if keys:
+                self._command('DEL', *keys)
+            if cursor == b'0':
+                break
+
+
+# -------------------------------------------------------------------------- #
+#                                 Namespaces                                 #
+# -------------------------------------------------------------------------- #
+
+class Cache:
+    '''
+    A namespace of a cache backend, with its own time to live and hit/miss counters.
+    Values are pickled, so callers always get their own copy of a cached value. Each value is stored with an HMAC
+    of its key and payload (keyed by CACHE_SECRET), and only unpickled if the HMAC matches: whoever can write to a shared
+    backend cannot make a worker unpickle their own payload.
+    If the backend fails, or holds a value it was not given by a worker sharing CACHE_SECRET, the cache behaves as a miss and never fails the request.
+    '''
+
+    def __init__(self, namespace, ttl, backend=None):
+        self.namespace = namespace
+        self.default_ttl = ttl
+        self._backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    @property
+    def ttl(self):
+        return float(getenv('CACHE_TTL_' + self.namespace.upper(), self.default_ttl))
+
+    @property
+    def backend(self):
+        return self._backend if self._backend is not None else default_backend()
+
+    def key(self, key):
+        if isinstance(key, (tuple, list)):
+            key = '\x1f'.join([str(k) for k in key])
+        return '{}:{}'.format(self.namespace, key)
+
+    def sign(self, key, payload):
+        '''HMAC-SHA256 of a stored key and its pickled value'''
+        return hmac.new(_cache_secret(), key.encode() + b'\x1f' + payload, hashlib.sha256).digest()
+
+    def get(self, key, default=None):
+        key = self.key(key)
+        try:
+            value = self.backend.get(key)
+        except Exception:
+            self.errors += 1
+            value = None
+        if value is not None and not hmac.compare_digest(value[:32], self.sign(key, value[32:])):
+            self.errors += 1
+            value = None
+        if value is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return pickle.loads(value[32:])
+
+    def set(self, key, value, ttl=None):
+        key = self.key(key)
+        try:
+            payload = pickle.dumps(value)
+            self.backend.set(key, self.sign(key, payload) + payload,
+                             self.ttl if ttl is None else ttl)
+        except Exception:
+            self.errors += 1
+
+    def delete(self, key):
+        try:
+            self.backend.delete(self.key(key))
+        except Exception:
+            self.errors += 1
+
+    def clear(self):
+        self.backend.clear(self.namespace + ':')
+
+    def stats(self):
+        return {
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'errors': self.errors,
+            'evictions': self.backend.evictions[self.namespace]
+        }
+
+
+class TTLCache(Cache):
+    '''A private in-process cache, not shared through the configured backend'''
+
+    def __init__(self, ttl, maxsize=1024, max_bytes=64 << 20):
+        super().__init__('ttl', ttl, MemoryBackend(max_bytes, maxsize))
+
+    def __len__(self):
+        return len(self._backend)
+
+
+_backend = {}
+_namespaces = {}
+_lock = threading.Lock()
+
+
+def create_backend(kind, url=None):
+    '''
+    Description:
+        create a cache backend
+
+    Parameters:
+        kind (str): accepts 'memory', 'sqlite', or 'redis'
+        url (str): max bytes for 'memory', file path for 'sqlite', redis://[:password@]host:port/db for 'redis'
+
+    Returns:
+        backend (CacheBackend)
+    '''
+    if kind == 'memory':
+        return MemoryBackend(int(url or 64 << 20))
+    if kind == 'sqlite':
+        return SQLiteBackend(url or '/tmp/scrtsibyl_cache.sqlite')
+    if kind == 'redis':
+        return RedisBackend(url or 'redis://localhost:6379/0')
+    raise Exception('unknown cache backend: {}'.format(kind))
+
+
+def default_backend():
+    '''the backend selected for this deployment by the CACHE_BACKEND and CACHE_URL environment variables'''
+    if 'default' not in _backend:
+        with _lock:
+            if 'default' not in _backend:
+                _backend['default'] = create_backend(
+                    getenv('CACHE_BACKEND', 'memory'), getenv('CACHE_URL'))
+    return _backend['default']
+
+
+def cache_namespace(namespace, ttl):
+    '''
+    Description:
+        returns the cache namespace of the given name, creating it on first use.
+        Its time to live can be overridden per deployment with the CACHE_TTL_<NAMESPACE> environment variable
+
+    Parameters:
+        namespace (str): e.g. 'scores', 'features', 'institutions'
+        ttl (float): default time to live in seconds
+
+    Returns:
+        cache (Cache)
+    '''
+    with _lock:
+        if namespace not in _namespaces:
+            _namespaces[namespace] = Cache(namespace, ttl)
+    return _namespaces[namespace]
+
+
+def cache_stats():
+    '''hit, miss, error, and eviction counters of all cache namespaces of this worker'''
+    return {k: v.stats() for k, v in _namespaces.items()}
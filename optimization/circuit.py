@@ -0,0 +1,135 @@
+from optimization.deadline import DeadlineExceeded
+from os import getenv
+
+import threading
+import time
+
+
+class CircuitOpen(Exception):
+    '''raised instead of calling a dependency whose circuit is open'''
+
+
+def is_failure(e):
+    '''
+    Description:
+        whether an exception shows the dependency is unhealthy. Client errors (e.g. an invalid key or id) do not,
+        since the dependency answered correctly, nor does running out of the request's own deadline
+
+    Parameters:
+        e (Exception): exception raised by the call. Plaid errors report a 'status', Coinbase errors a 'status_code'
+
+    Returns:
+        failure (bool)
+    '''
+    if isinstance(e, DeadlineExceeded):
+        return False
+    status = getattr(e, 'status', None) or getattr(e, 'status_code', None)
+    if isinstance(status, int):
+        return status >= 500 or status == 429
+    return True
+
+
+class CircuitBreaker:
+    '''
+    A circuit breaker guarding the calls to one dependency:
+        - closed: calls go through. After `failures` consecutive failures, the circuit opens
+        - open: calls fail fast with CircuitOpen, without waiting on the dependency. After `reset` seconds, the circuit half-opens
+        - half-open: a single trial call goes through. It closes the circuit if it succeeds, and opens it again if it fails.
+          A trial that ends with an exception that is not a failure (e.g. a client error, or the caller's own deadline)
+          proves nothing: the circuit stays half-open, and the next call is the trial
+
+    Use it as a context manager around the call:
+        with circuit_breaker('coinmarketcap'):
+            r = http_get(url)
+    '''
+
+    def __init__(self, name, failures=5, reset=30):
+        self.name = name
+        self.failures = failures
+        self.reset = reset
+        self.consecutive = 0
+        self.opened_at = None
+        self.trial = False
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return
+            if state == 'half-open' and not self.trial:
+                self.trial = True
+                return
+            self.rejected += 1
+        raise CircuitOpen('{} is unavailable, retry later'.format(self.name))
+
+    def succeeded(self):
+        with self._lock:
+            self.consecutive = 0
+            self.opened_at = None
+            self.trial = False
+
+    def inconclusive(self):
+        '''a call ended with an exception that is not a failure: release the trial, if it was one, and leave the state as is'''
+        with self._lock:
+            self.trial = False
+
+    def failed(self):
+        with self._lock:
+            self.consecutive += 1
+            if self.trial or self.consecutive >= self.failures:
+                self.opened_at = time.monotonic()
+            self.trial = False
+
+    def __enter__(self):
+        self.allow()
+        return self
+
+    def __exit__(self, kind, e, traceback):
+        if e is None:
+            self.succeeded()
+        elif is_failure(e):
+            self.failed()
+        else:
+            self.inconclusive()
+        return False
+
+    def stats(self):
+        return {'state': self.state, 'consecutive_failures': self.consecutive, 'rejected': self.rejected}
+
+
+_breakers = dict()
+_lock = threading.Lock()
+
+
+def circuit_breaker(name):
+    '''
+    Description:
+        returns the circuit breaker of a dependency, creating it on first use.
+        Thresholds are set per deployment with the CIRCUIT_FAILURES and CIRCUIT_RESET environment variables
+
+    Parameters:
+        name (str): dependency name, e.g. 'coinmarketcap', 'plaid_institutions'
+
+    Returns:
+        breaker (CircuitBreaker)
+    '''
+    with _lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name, int(getenv('CIRCUIT_FAILURES', 5)),
+                                             float(getenv('CIRCUIT_RESET', 30)))
+    return _breakers[name]
+
+
+def circuit_stats():
+    '''state of the circuit breaker of each dependency called by this worker'''
+    return {k: v.stats() for k, v in _breakers.items()}
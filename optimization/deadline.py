@@ -0,0 +1,68 @@
+from os import getenv
+
+import time
+
+
+class DeadlineExceeded(Exception):
+    '''raised when a request runs out of time before one of its required stages'''
+
+
+class Deadline:
+    '''
+    The time budget of one request, passed down to every stage and upstream call.
+    Each call derives its timeout from the remaining budget, and optional stages are skipped once the budget is nearly spent
+    '''
+
+    def __init__(self, seconds, reserve=None):
+        self.expires = time.monotonic() + seconds
+        # seconds kept for the required stages that follow an optional one
+        self.reserve = float(getenv('DEADLINE_RESERVE', 1)
+                             ) if reserve is None else reserve
+
+    def remaining(self):
+        return max(0, self.expires - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def check(self, stage):
+        '''raise DeadlineExceeded if no time is left to run the given required stage'''
+        if self.expired():
+            raise DeadlineExceeded(
+                'Request deadline exceeded before {}'.format(stage))
+
+    def timeout(self, seconds):
+        '''the timeout of an upstream call: its own timeout, capped by the remaining budget'''
+        return min(seconds, self.remaining())
+
+    def caps(self, seconds):
+        '''whether the remaining budget is shorter than the timeout of a call: the call then times out because of this deadline, not because the upstream is slow'''
+        return self.remaining() < seconds
+
+    def allows(self):
+        '''whether there is time left to run an optional stage, and still run the required ones'''
+        return self.remaining() > self.reserve
+
+    def optional(self):
+        '''the deadline of an optional stage: the remaining budget, minus the reserve of the required stages'''
+        return Deadline(max(0, self.remaining() - self.reserve), reserve=0)
+
+
+def request_deadline(headers):
+    '''
+    Description:
+        the deadline of an incoming request: the caller's X-Request-Timeout header (seconds) if any,
+        capped by REQUEST_TIMEOUT_MAX, or REQUEST_TIMEOUT by default
+
+    Parameters:
+        headers (dict): request headers
+
+    Returns:
+        deadline (Deadline)
+    '''
+    seconds = float(getenv('REQUEST_TIMEOUT', 30))
+    try:
+        seconds = float(headers.get('X-Request-Timeout', seconds))
+    except (TypeError, ValueError):
+        pass
+    return Deadline(max(0, min(seconds, float(getenv('REQUEST_TIMEOUT_MAX', 60)))))
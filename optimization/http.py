@@ -0,0 +1,107 @@
+from requests.adapters import HTTPAdapter
+from optimization.deadline import DeadlineExceeded
+from os import getenv
+
+import threading
+import requests
+import random
+import time
+
+# responses worth retrying: rate limited, or the upstream is temporarily unavailable
+retry_status = {429, 500, 502, 503, 504}
+
+_local = threading.local()
+
+
+def http_session():
+    '''
+    Description:
+        returns this thread's keep-alive HTTP session, so that consecutive calls to the same host reuse their connection
+        (no new TCP and TLS handshake per call)
+
+    Returns:
+        session (requests.Session)
+    '''
+    if getattr(_local, 'session', None) is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=int(
+            getenv('HTTP_POOL_SIZE', 10)), max_retries=0)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _local.session = session
+    return _local.session
+
+
+def backoff(attempt, base=0.1, cap=2.0):
+    '''seconds to wait before the given retry: exponential backoff with full jitter, so that retrying clients do not synchronize'''
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+def retry_after(response):
+    '''seconds requested by the upstream in its Retry-After header, if any'''
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return 0
+
+
+def http_get(url, headers=None, params=None, timeout=None, retries=None, budget=None, deadline=None):
+    '''
+    Description:
+        GET a url through the shared session, with bounded waits and bounded retries.
+        Connection errors, timeouts, and retry_status responses are retried with jittered backoff,
+        as long as the retry budget (total seconds spent on this request, across attempts) is not exhausted
+
+    Parameters:
+        url (str): url to fetch
+        headers (dict): request headers
+        params (dict): query string parameters
+        timeout (tuple): connect and read timeouts in seconds. Defaults to HTTP_CONNECT_TIMEOUT and HTTP_READ_TIMEOUT
+        retries (int): max number of retries. Defaults to HTTP_RETRIES
+        budget (float): max seconds spent on this request. Defaults to HTTP_RETRY_BUDGET
+        deadline (Deadline): deadline of the incoming request. The budget is capped by its remaining time
+
+    Returns:
+        response (requests.Response): the first non-retryable response, or the last response once retries are exhausted.
+            Raises the last connection error or timeout if no response was received, or DeadlineExceeded
+            if an attempt timed out because the deadline cut its timeout short
+    '''
+    connect, read = timeout or (float(getenv('HTTP_CONNECT_TIMEOUT', 3.05)),
+                                float(getenv('HTTP_READ_TIMEOUT', 10)))
+    retries = int(getenv('HTTP_RETRIES', 2)) if retries is None else retries
+    budget = float(getenv('HTTP_RETRY_BUDGET', 10)
+                   ) if budget is None else budget
+    capped = False
+    if deadline is not None:
+        deadline.check('GET ' + url)
+        capped = deadline.caps(budget)
+        budget = deadline.timeout(budget)
+    expires = time.monotonic() + budget
+
+    attempt = 0
+    while True:
+        remaining = expires - time.monotonic()
+        response = None
+        try:
+            response = http_session().get(url, headers=headers, params=params,
+                                          timeout=(min(connect, remaining), min(read, remaining)))
+            if response.status_code not in retry_status:
+                return response
+            error = None
+
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+            # the caller's deadline set the timeout of this attempt: the upstream is not to blame
+            if capped and isinstance(e, requests.Timeout) and \
+                    remaining < (connect if isinstance(e, requests.ConnectTimeout) else read):
+                raise DeadlineExceeded(
+                    'Request deadline exceeded during GET {}'.format(url)) from e
+
+        attempt += 1
+        delay = max(backoff(attempt), retry_after(response)
+                    if response is not None else 0)
+        if attempt > retries or time.monotonic() + delay >= expires:
+            if error is not None:
+                raise error
+            return response
+        time.sleep(delay)
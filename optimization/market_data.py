@@ -0,0 +1,150 @@
+'''Market data (coinmarketcap listings, SCRT rate, Coinbase currencies) shared by all workers through a memory-mapped file.
+
+One process at a time, elected through a file lock, refreshes the data and publishes it as an immutable snapshot.
+Every worker polls the snapshot version in the background and swaps its local copy when the version changes,
+so that request handlers only ever read local memory. Each field records when it was last refreshed, so that readers
+can tell a stale field (e.g. from a refresher that keeps failing, or a snapshot file left over from a previous run) from a fresh one.'''
+
+from icecream import ic
+
+import threading
+import struct
+import fcntl
+import mmap
+import json
+import time
+import os
+
+# header: version (even when the snapshot is consistent, odd while it is being written) and payload length
+header = struct.Struct('QQ')
+
+
+class SharedSnapshot:
+    '''
+    A json snapshot in a memory-mapped file, guarded by a sequence counter (seqlock).
+    A single writer publishes new versions. Readers never lock: they retry if the version changed while they copied the payload.
+    '''
+
+    def __init__(self, path, capacity=1 << 20):
+        self.path = path
+        self.capacity = capacity
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size < header.size + capacity:
+                os.ftruncate(fd, header.size + capacity)
+            self._mm = mmap.mmap(fd, header.size + capacity)
+        finally:
+            os.close(fd)
+
+    def version(self):
+        return header.unpack_from(self._mm, 0)[0]
+
+    def publish(self, data):
+        payload = json.dumps(data).encode()
+        if len(payload) > self.capacity:
+            raise Exception('market data snapshot exceeds {} bytes'.format(
+                self.capacity))
+
+        version = self.version()
+        version += version % 2  # recover from a writer that died mid-write
+        struct.pack_into('Q', self._mm, 0, version + 1)
+        self._mm[header.size:header.size + len(payload)] = payload
+        struct.pack_into('Q', self._mm, 8, len(payload))
+        struct.pack_into('Q', self._mm, 0, version + 2)
+        return version + 2
+
+    def read(self, retries=10):
+        for _ in range(retries):
+            version, length = header.unpack_from(self._mm, 0)
+            if version == 0:
+                return None
+            if version % 2 == 0 and length <= self.capacity:
+                payload = bytes(self._mm[header.size:header.size + length])
+                if self.version() == version:
+                    return version, json.loads(payload)
+            time.sleep(0.001)
+        return None
+
+
+# local copy of the latest snapshot, read by request handlers
+_local = {'version': 0, 'snapshot': None}
+
+
+def market_snapshot():
+    '''returns the latest market data snapshot published to this worker, or None if there is none yet'''
+    return _local['snapshot']
+
+
+def market_field(name, max_age):
+    '''returns a field of the latest market data snapshot, or None if there is none or it was last refreshed more than max_age seconds ago'''
+    snapshot = market_snapshot() or {}
+    refreshed = snapshot.get('refreshed', {}).get(name)
+    if refreshed is None or time.time() - refreshed > max_age:
+        return None
+    return snapshot.get(name)
+
+
+def poll_market_data(shared):
+    '''swap the local snapshot if a newer version was published. Cheap when nothing changed: one 8-byte read'''
+    if shared.version() != _local['version']:
+        r = shared.read()
+        if r:
+            _local['snapshot'] = r[1]
+            _local['version'] = r[0]
+    return _local['snapshot']
+
+
+def refresh_market_data(shared, fetch):
+    '''fetch fresh market data, keeping the last good value and refresh time of any field that failed to refresh, and publish it'''
+    previous = shared.read()
+    previous = previous[1] if previous else {}
+    fresh = fetch(previous)
+    now = time.time()
+    data = dict(previous, **fresh)
+    data['refreshed'] = dict(previous.get('refreshed', {}), **{k: now for k in fresh})
+    data['updated_at'] = now
+    return shared.publish(data)
+
+
+def start_market_data(fetch, path, interval):
+    '''
+    Description:
+        start the daemon thread that keeps this worker's market data snapshot up to date.
+        The first worker to lock the snapshot file also becomes the refresher. If it dies, another worker takes over
+
+    Parameters:
+        fetch (function): takes the previous snapshot (dict) and returns the fields that were refreshed
+        path (str): memory-mapped file shared by all workers
+        interval (float): seconds between two refreshes
+
+    Returns:
+        thread (threading.Thread): the daemon thread
+    '''
+    shared = SharedSnapshot(path)
+    lock = open(path + '.lock', 'a')
+
+    def run():
+        leader = False
+        refreshed = 0
+        while True:
+            try:
+                if not leader:
+                    try:
+                        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        leader = True
+                    except OSError:
+                        pass
+                if leader and time.time() - refreshed >= interval:
+                    refreshed = time.time()
+                    ic(refresh_market_data(shared, fetch))
+                poll_market_data(shared)
+
+            except Exception as e:
+                ic(e)
+
+            time.sleep(1)
+
+    thread = threading.Thread(
+        target=run, name='market-data', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,114 @@
+from optimization.deadline import DeadlineExceeded
+from functools import wraps
+
+import threading
+import inspect
+import copy
+
+
+class Flight:
+    '''one in-flight call, awaited by the callers that arrived while it was running'''
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+
+class SingleFlight:
+    '''
+    Coalesce concurrent identical calls: the first caller (the leader) runs the call,
+    and the callers that arrive with the same key before it returns wait for it and share its result or error.
+    Shared results are deep copied, so that no caller can alter what another one reads.
+    A follower waits at most until its own deadline, and does not inherit the DeadlineExceeded of a leader with a shorter one.
+    If `share` is given, a result is only shared if share(result) is True: otherwise each follower makes its own call,
+    e.g. so that the error a leader got for its own credentials is not handed to the other callers
+    '''
+
+    def __init__(self, share=None):
+        self.share = share
+        self._flights = dict()
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        return self.run(key, None, fn, *args, **kwargs)
+
+    def run(self, key, deadline, fn, *args, **kwargs):
+        '''same as do(), for a caller with a deadline (None if it has none)'''
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+                self.calls += 1
+            else:
+                flight.followers += 1
+                self.shared += 1
+
+        if not leader:
+            if not flight.done.wait(None if deadline is None else deadline.remaining()):
+                raise DeadlineExceeded(
+                    'Request deadline exceeded while waiting for a shared call')
+            if isinstance(flight.error, DeadlineExceeded):
+                return self.run(key, deadline, fn, *args, **kwargs)
+            if flight.error is not None:
+                raise flight.error
+            if self.share is not None and not self.share(flight.result):
+                return fn(*args, **kwargs)
+            return copy.deepcopy(flight.result)
+
+        try:
+            flight.result = fn(*args, **kwargs)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            # forget the call before waking up the followers: late callers start a new flight
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+        # the original result stays untouched until every follower has copied it
+        return copy.deepcopy(flight.result) if flight.followers else flight.result
+
+    def stats(self):
+        return {'calls': self.calls, 'shared': self.shared, 'in_flight': len(self._flights)}
+
+
+_groups = dict()
+
+
+def single_flight(key, share=None):
+    '''
+    Description:
+        decorator sharing one in-flight call among the concurrent callers of a function with the same key
+
+    Parameters:
+        key (function): takes the arguments of the decorated function and returns a hashable key.
+            Leave out the arguments that do not change the result (e.g. an API client).
+            If the decorated function takes a `deadline` argument, callers wait for a shared call at most until their deadline
+        share (function): takes a result and returns whether it can be shared. Defaults to sharing every result
+
+    Returns:
+        decorator (function)
+    '''
+    def decorator(func):
+        group = _groups.setdefault(func.__module__ + '.' + func.__name__, SingleFlight(share))
+        signature = inspect.signature(func)
+
+        @wraps(func)
+        def coalesced(*args, **kwargs):
+            deadline = signature.bind(*args, **kwargs).arguments.get(
+                'deadline') if 'deadline' in signature.parameters else None
+            return group.run(key(*args, **kwargs), deadline, func, *args, **kwargs)
+        coalesced.flights = group
+        return coalesced
+    return decorator
+
+
+def single_flight_stats():
+    '''calls made and calls shared by each coalesced function of this worker'''
+    return {k: v.stats() for k, v in _groups.items()}
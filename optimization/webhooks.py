@@ -0,0 +1,230 @@
+'''Background re-scoring of Plaid items, driven by Plaid webhooks.
+
+When PLAID_WEBHOOKS is 1, every Plaid item scored by /credit_score/plaid is registered in the cache backend, with its data,
+so that its webhooks are handled by any worker. When Plaid reports new or removed transactions (TRANSACTIONS webhooks),
+the item is refreshed in the background: only the last few days are fetched again and merged into the stored data,
+the item is re-scored, and the response of /credit_score/plaid is precomputed, so that the user's next request
+is served without waiting for a fetch. Events of the same item are coalesced until its refresh starts.'''
+
+from datetime import datetime, timedelta, timezone
+from collections import OrderedDict
+from icecream import ic
+from os import getenv
+
+from validator_api.plaid import plaid_update_item, plaid_verify_webhook
+from optimization.cache import cache_namespace, seal_value, unseal_value
+
+import threading
+import copy
+
+
+# webhook codes of the TRANSACTIONS webhooks that change the data of an item
+update_codes = ['DEFAULT_UPDATE']
+remove_codes = ['TRANSACTIONS_REMOVED']
+
+
+def _today():
+    return datetime.now(timezone.utc).date()
+
+
+# -------------------------------------------------------------------------- #
+#                                 Local Plaid                                #
+# -------------------------------------------------------------------------- #
+
+class LocalPlaid:
+    '''
+    A local stand-in for Plaid, holding the data of each item in memory. It serves incremental fetches,
+    and builds the webhooks Plaid would send when transactions are added or removed
+    '''
+
+    def __init__(self):
+        self.items = dict()
+        self.fetches = list()
+
+    def link(self, item_id, data):
+        '''link an item, and return its data as the first fetch would'''
+        self.items[item_id] = copy.deepcopy(data)
+        return copy.deepcopy(data)
+
+    def add(self, item_id, transactions):
+        '''add transactions to an item, and return the DEFAULT_UPDATE webhook'''
+        self.items[item_id]['transactions'] = transactions + \
+            self.items[item_id]['transactions']
+        return {'webhook_type': 'TRANSACTIONS', 'webhook_code': 'DEFAULT_UPDATE',
+                'item_id': item_id, 'new_transactions': len(transactions)}
+
+    def remove(self, item_id, transaction_ids):
+        '''remove transactions from an item, and return the TRANSACTIONS_REMOVED webhook'''
+        self.items[item_id]['transactions'] = [t for t in self.items[item_id]['transactions']
+                                               if t['transaction_id'] not in transaction_ids]
+        return {'webhook_type': 'TRANSACTIONS', 'webhook_code': 'TRANSACTIONS_REMOVED',
+                'item_id': item_id, 'removed_transactions': list(transaction_ids)}
+
+    def fetch(self, registration, days):
+        '''the data of a registered item over its last `days` days'''
+        self.fetches.append((registration['item_id'], days))
+        data = copy.deepcopy(self.items[registration['item_id']])
+        since = _today() - timedelta(days=days)
+        data['transactions'] = [
+            t for t in data['transactions'] if t['date'] >= since]
+        return data
+
+
+# -------------------------------------------------------------------------- #
+#                                  Webhooks                                  #
+# -------------------------------------------------------------------------- #
+
+class PlaidWebhooks:
+    '''
+    Registry of the scored Plaid items, refreshed and re-scored by a background thread of the worker that receives
+    the webhook when Plaid reports that their transactions changed. Items are kept in `store`, by default the
+    'plaid_items' namespace of the configured cache backend, so that every worker sharing the backend knows them.
+    Entries hold the credentials and transactions of the item, so they are stored sealed with CACHE_SECRET.
+
+    fetch(registration, days) returns the 'Transactions' product of an item over its last `days` days,
+    rescore(registration, data) scores the refreshed data of an item, and client(registration) returns the Plaid client
+    of an item, passed to both as registration['client'] and used to verify its webhooks
+    '''
+
+    def __init__(self, fetch, rescore, client=None, store=None, overlap=7, timeframe=360):
+        self.fetch = fetch
+        self.rescore = rescore
+        self.client = client or (lambda registration: registration.get('client'))
+        self.store = store if store is not None else cache_namespace(
+            'plaid_items', 30*86400)
+        self.overlap = overlap
+        self.timeframe = timeframe
+        self.pending = OrderedDict()
+        self.running = 0
+        self.stats = {'registered': 0, 'events': 0, 'ignored': 0, 'rejected': 0,
+                      'rescored': 0, 'failures': 0}
+        self._cond = threading.Condition()
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return getenv('PLAID_WEBHOOKS', '0') == '1'
+
+    def register(self, item_id, registration, data, fetched=None):
+        '''
+        Description:
+            remember a scored item and its data, so that it can be re-scored when Plaid reports changes.
+            Does nothing unless PLAID_WEBHOOKS is 1
+
+        Parameters:
+            item_id (str): Plaid item id
+            registration (dict): what the item is re-scored with: Plaid credentials and wallet address. Must be picklable
+            data (dict): 'Transactions' product of the item, as scored
+            fetched (date): date the data was fetched. Defaults to today
+        '''
+        if not self.enabled or not item_id:
+            return False
+        self.save(item_id, {'registration': dict(registration, item_id=item_id),
+                            'data': data, 'fetched': fetched or _today()})
+        with self._cond:
+            self.stats['registered'] += 1
+        return True
+
+    def load(self, item_id):
+        '''the stored registration, data, and fetch date of an item, or None if it is unknown'''
+        sealed = self.store.get(item_id) if item_id else None
+        return None if sealed is None else unseal_value(sealed, 'plaid_items')
+
+    def save(self, item_id, item):
+        self.store.set(item_id, seal_value(item, 'plaid_items'))
+
+    def notify(self, event, body=b'', token=None):
+        '''
+        Description:
+            receive a Plaid webhook, and queue the refresh of its item if the item's transactions changed
+
+        Parameters:
+            event (dict): webhook payload
+            body (bytes): raw request body, for verification
+            token (str): Plaid-Verification header, for verification. Unsigned webhooks are only accepted
+                when PLAID_WEBHOOK_VERIFY is 0
+
+        Returns:
+            status_code (int): 404 if webhooks are disabled, 401 if the webhook is not from Plaid, 200 otherwise.
+                A webhook of an unknown item cannot be verified, so it is rejected like a forged one
+            status (str): 'queued', or why the webhook was ignored
+        '''
+        if not self.enabled:
+            return 404, 'Plaid webhooks are disabled'
+        code = event.get('webhook_code')
+        if event.get('webhook_type') != 'TRANSACTIONS' or code not in update_codes + remove_codes:
+            with self._cond:
+                self.stats['ignored'] += 1
+            return 200, 'ignored'
+        item = self.load(event.get('item_id'))
+        # the signature is checked before the item is looked at, so that item ids cannot be probed
+        if getenv('PLAID_WEBHOOK_VERIFY', '1') != '0' and (item is None or not plaid_verify_webhook(
+                self.client(item['registration']), body, token or '')):
+            with self._cond:
+                self.stats['rejected'] += 1
+            return 401, 'invalid Plaid-Verification'
+        if item is None:
+            with self._cond:
+                self.stats['ignored'] += 1
+            return 200, 'unknown item'
+
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='plaid-webhooks', daemon=True)
+                self._thread.start()
+            job = self.pending.setdefault(
+                event['item_id'], {'update': False, 'removed': set()})
+            job['update'] = job['update'] or code in update_codes
+            job['removed'].update(event.get('removed_transactions') or [])
+            self.stats['events'] += 1
+            self._cond.notify_all()
+        return 200, 'queued'
+
+    def refresh(self, item_id, job):
+        '''fetch the last days of an item again, merge them into its data, re-score it, and store the merged data'''
+        item = self.load(item_id)
+        if item is None:
+            return None
+        registration = dict(item['registration'],
+                            client=self.client(item['registration']))
+        since = item['fetched'] - timedelta(days=self.overlap)
+        update = self.fetch(registration, (_today() - since).days) if job['update'] else None
+        data = plaid_update_item(item['data'], update, since, job['removed'],
+                                 _today() - timedelta(days=self.timeframe))
+        output = self.rescore(registration, data)
+        item['data'] = data
+        if update is not None:
+            item['fetched'] = _today()
+        self.save(item_id, item)
+        return output
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self.pending:
+                    self._cond.wait()
+                item_id, job = self.pending.popitem(last=False)
+                self.running += 1
+            try:
+                self.refresh(item_id, job)
+                with self._cond:
+                    self.stats['rescored'] += 1
+            except Exception as e:
+                ic(e)
+                with self._cond:
+                    self.stats['failures'] += 1
+            finally:
+                with self._cond:
+                    self.running -= 1
+                    self._cond.notify_all()
+
+    def drain(self, timeout=None):
+        '''wait until the queued refreshes are done. Returns False if they are not done within `timeout` seconds'''
+        with self._cond:
+            return self._cond.wait_for(lambda: not self.pending and not self.running, timeout)
+
+    def snapshot(self):
+        '''number of items registered and queued by this worker, webhooks received, and items re-scored'''
+        with self._cond:
+            return {**self.stats, 'pending': len(self.pending)}
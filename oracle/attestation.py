@@ -0,0 +1,285 @@
+'''Signed attestations of the issued scores, batched in Merkle trees.
+
+Scores issued within ATTEST_WINDOW_MS (default 50) are collected into a Merkle tree by a background thread,
+which signs only the root (ECDSA P-256). Each response carries its score, the inclusion proof of its leaf, the root,
+and the signature of the root. Anyone holding the public key can verify a score in O(log n) hashes and one signature check,
+and the cost of signing is shared by all the scores of a window. Signed attestations are stored in the score ledger,
+so that GET /attestation/<leaf> is served by any worker.'''
+
+from collections import OrderedDict
+from Crypto.PublicKey import ECC
+from Crypto.Signature import DSS
+from Crypto.Hash import SHA256
+from icecream import ic
+from os import getenv
+
+from oracle.ledger import score_ledger
+
+import threading
+import sqlite3
+import hashlib
+import json
+import time
+
+
+# -------------------------------------------------------------------------- #
+#                                Merkle Tree                                 #
+# -------------------------------------------------------------------------- #
+# Leaves and inner nodes are hashed with different prefixes, so that an inner node cannot pass for a leaf.
+# The last node of a level with an odd number of nodes moves up the tree as is.
+
+def leaf_hash(record):
+    '''hash of a score record: address, provider, model_version, score, and issued_at'''
+    payload = json.dumps(record, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(b'\x00' + payload.encode()).hexdigest()
+
+
+def node_hash(left, right):
+    return hashlib.sha256(b'\x01' + bytes.fromhex(left) + bytes.fromhex(right)).hexdigest()
+
+
+def merkle_tree(leaves):
+    '''
+    Description:
+        the levels of the Merkle tree of a list of leaf hashes, from the leaves up to the root
+
+    Parameters:
+        leaves (list): leaf hashes (hex)
+
+    Returns:
+        levels (list): one list of hashes per level. The last level holds the root only
+    '''
+    levels = [list(leaves)]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        levels.append([node_hash(level[i], level[i + 1])
+                       for i in range(0, len(level) - 1, 2)] + level[len(level) - len(level) % 2:])
+    return levels
+
+
+def merkle_proof(levels, i):
+    '''the inclusion proof of the i-th leaf: the sibling of each node on the path to the root, and its side'''
+    proof = list()
+    for level in levels[:-1]:
+        sibling = i + 1 if i % 2 == 0 else i - 1
+        if sibling < len(level):
+            proof.append({'side': 'right' if i % 2 == 0 else 'left',
+                          'hash': level[sibling]})
+        i //= 2
+    return proof
+
+
+def merkle_root(leaf, proof):
+    '''the root reached from a leaf through its inclusion proof'''
+    node = leaf
+    for step in proof:
+        node = node_hash(node, step['hash']) if step['side'] == 'right' else node_hash(
+            step['hash'], node)
+    return node
+
+
+# -------------------------------------------------------------------------- #
+#                                 Signatures                                 #
+# -------------------------------------------------------------------------- #
+
+def key_id(public_key):
+    '''short identifier of a public key: hash of its DER encoding'''
+    return hashlib.sha256(public_key.export_key(format='DER')).hexdigest()[:16]
+
+
+def sign_root(key, root):
+    return DSS.new(key, 'deterministic-rfc6979').sign(SHA256.new(bytes.fromhex(root))).hex()
+
+
+def verify_attestation(public_key, attestation):
+    '''
+    Description:
+        verify that a score was attested: its record hashes to the leaf, the leaf is in the tree,
+        and the root of the tree was signed by the key
+
+    Parameters:
+        public_key (EccKey): public key of the oracle, see GET /attestation/key
+        attestation (dict): attestation returned with the score
+
+    Returns:
+        valid (bool): True if the attestation is valid
+    '''
+    try:
+        if leaf_hash(attestation['record']) != attestation['leaf']:
+            return False
+        if merkle_root(attestation['leaf'], attestation['proof']) != attestation['root']:
+            return False
+        DSS.new(public_key, 'deterministic-rfc6979').verify(SHA256.new(bytes.fromhex(attestation['root'])),
+                                                            bytes.fromhex(attestation['signature']))
+        return True
+    except (KeyError, ValueError, TypeError):
+        return False
+
+
+# -------------------------------------------------------------------------- #
+#                                  Attestor                                  #
+# -------------------------------------------------------------------------- #
+
+class Attestor:
+    '''
+    Collects the score records of a window, and seals them from a background thread: one Merkle tree and one signature
+    per window, at most max_batch records each. The last `keep` attestations stay available by leaf hash in memory.
+    If `ledger` is given, it returns the ScoreLedger every signed attestation is also stored in, before it is handed out,
+    so that attestations sealed by other workers are found there
+    '''
+
+    def __init__(self, key, window=0.05, max_batch=4096, keep=10000, ledger=None):
+        self.key = key
+        self.key_id = key_id(key.public_key())
+        self.window = window
+        self.max_batch = max_batch
+        self.keep = keep
+        self.ledger = ledger
+        self.batch = list()
+        self.recent = OrderedDict()
+        self.stats = {'records': 0, 'batches': 0,
+                      'late': 0, 'sign_ms': 0.0, 'unstored': 0}
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def submit(self, record):
+        '''queue a score record for the next tree, and return the ticket to wait on'''
+        ticket = {'record': record, 'leaf': leaf_hash(record),
+                  'done': threading.Event(), 'attestation': None}
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='attestor', daemon=True)
+                self._thread.start()
+            self.batch.append(ticket)
+            self.stats['records'] += 1
+            self._cond.notify()
+        return ticket
+
+    def attest(self, record, timeout):
+        '''
+        Description:
+            attest a score record, waiting at most `timeout` seconds for its window to be sealed
+
+        Returns:
+            attestation (dict): record, leaf, proof, root, signature, and key_id.
+                If the window was not sealed in time, only the record, leaf, and status 'pending':
+                the full attestation is then served by GET /attestation/<leaf>
+        '''
+        ticket = self.submit(record)
+        if ticket['done'].wait(timeout):
+            return ticket['attestation']
+        with self._cond:
+            self.stats['late'] += 1
+        return {'record': record, 'leaf': ticket['leaf'], 'status': 'pending'}
+
+    def seal(self):
+        '''build the tree of the records queued so far, sign its root, and hand each record its attestation'''
+        with self._cond:
+            batch, self.batch = self.batch[:self.max_batch], self.batch[self.max_batch:]
+        if not batch:
+            return 0
+
+        t0 = time.perf_counter()
+        levels = merkle_tree([t['leaf'] for t in batch])
+        root = levels[-1][0]
+        signature = sign_root(self.key, root)
+        cost = time.perf_counter() - t0
+
+        for i, t in enumerate(batch):
+            t['attestation'] = {'record': t['record'], 'leaf': t['leaf'], 'proof': merkle_proof(levels, i),
+                                'root': root, 'signature': signature, 'key_id': self.key_id, 'status': 'signed'}
+        with self._cond:
+            for t in batch:
+                self.recent[t['leaf']] = t['attestation']
+            while len(self.recent) > self.keep:
+                self.recent.popitem(last=False)
+            self.stats['batches'] += 1
+            self.stats['sign_ms'] += 1000*cost
+        if self.ledger is not None:
+            try:
+                self.ledger().record_attestations(
+                    [t['attestation'] for t in batch])
+            except sqlite3.Error as e:
+                ic(e)
+                with self._cond:
+                    self.stats['unstored'] += len(batch)
+        for t in batch:
+            t['done'].set()
+        return len(batch)
+
+    def lookup(self, leaf):
+        '''the attestation of a leaf, sealed recently by this worker or stored in the ledger, or None'''
+        with self._cond:
+            attestation = self.recent.get(leaf)
+        if attestation is None and self.ledger is not None:
+            try:
+                attestation = self.ledger().attestation(leaf)
+            except sqlite3.Error as e:
+                ic(e)
+        return attestation
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self.batch:
+                    self._cond.wait()
+            # let the window fill up, unless the batch is already full
+            deadline = time.time() + self.window
+            with self._cond:
+                while len(self.batch) < self.max_batch and time.time() < deadline:
+                    self._cond.wait(deadline - time.time())
+            try:
+                self.seal()
+            except Exception as e:
+                ic(e)
+
+    def snapshot(self):
+        '''number of records and batches attested, late and unstored attestations, and mean signing time per batch'''
+        with self._cond:
+            batches = self.stats['batches']
+            return {'records': self.stats['records'], 'batches': batches, 'late': self.stats['late'],
+                    'unstored': self.stats['unstored'],
+                    'mean_sign_ms': self.stats['sign_ms']/batches if batches else 0, 'key_id': self.key_id}
+
+
+_attestor = {'attestor': None}
+_attestor_lock = threading.Lock()
+
+
+def attestor():
+    '''the attestor of this worker, signing with the PEM private key at ATTEST_KEY. None if attestation is disabled'''
+    with _attestor_lock:
+        if _attestor['attestor'] is None and getenv('ATTEST_KEY'):
+            with open(getenv('ATTEST_KEY')) as f:
+                key = ECC.import_key(f.read())
+            _attestor['attestor'] = Attestor(key, float(getenv('ATTEST_WINDOW_MS', 50))/1000,
+                                             int(getenv('ATTEST_MAX_BATCH', 4096)), ledger=score_ledger)
+        return _attestor['attestor']
+
+
+def attest_score(address, provider, model_version, score, issued_at):
+    '''
+    Description:
+        attest a score issued to a wallet, waiting at most ATTEST_WAIT_MS (default 200) for its window to be signed.
+        Never raises
+
+    Returns:
+        attestation (dict): see Attestor.attest(), or None if attestation is disabled or the wallet address is unknown
+    '''
+    try:
+        a = attestor()
+        if a is None or not address:
+            return None
+        record = {'address': address, 'provider': provider, 'model_version': model_version,
+                  'score': int(score), 'issued_at': issued_at.isoformat()}
+        return a.attest(record, float(getenv('ATTEST_WAIT_MS', 200))/1000)
+    except Exception as e:
+        ic(e)
+        return None
+
+
+def attest_stats():
+    '''attestation counters of this worker, or None if attestation is disabled'''
+    a = _attestor['attestor']
+    return a.snapshot() if a else None
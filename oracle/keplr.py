@@ -0,0 +1,317 @@
+'''Verification of keplr_token: proof that the caller controls the Keplr wallet a score is issued to.
+
+A keplr_token is the output of Keplr's signArbitrary() over "<nonce>|<binding>", with the address that signed it:
+    {"address": "secret1...", "pub_key": {"type": "tendermint/PubKeySecp256k1", "value": "<base64>"},
+     "signature": "<base64>", "nonce": "<unix time>:<random>"}
+The signature is an ADR-36 secp256k1 signature. The nonce starts with the time it was made, and expires
+KEPLR_NONCE_TTL seconds (default 300) later. The binding ties the token to one request: it hashes the endpoint and
+the provider tokens of the request (see request_binding()), so that a captured token cannot score another request.
+Verified (address, nonce) pairs are kept in a bounded LRU cache, so that an identical retry of a request skips
+the signature check, and a nonce can never be bound to another signature or another request.'''
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from Crypto.Hash import RIPEMD160
+from os import getenv
+
+import threading
+import hashlib
+import base64
+import json
+import time
+
+
+class KeplrError(Exception):
+    '''the keplr_token does not prove that the caller controls the wallet'''
+
+
+# -------------------------------------------------------------------------- #
+#                                 secp256k1                                  #
+# -------------------------------------------------------------------------- #
+# Points are kept in Jacobian coordinates (X, Y, Z), standing for (X/Z^2, Y/Z^3), to avoid a modular inverse per addition
+
+P = 2**256 - 2**32 - 977
+N = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+G = (0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798,
+     0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8)
+
+
+def _double(p):
+    x, y, z = p
+    if not y:
+        return (0, 0, 0)
+    s = 4*x*y*y % P
+    m = 3*x*x % P
+    x2 = (m*m - 2*s) % P
+    return (x2, (m*(s - x2) - 8*pow(y, 4, P)) % P, 2*y*z % P)
+
+
+def _add(p, q):
+    if not p[2]:
+        return q
+    if not q[2]:
+        return p
+    z1, z2 = p[2]*p[2] % P, q[2]*q[2] % P
+    u1, u2 = p[0]*z2 % P, q[0]*z1 % P
+    s1, s2 = p[1]*z2*q[2] % P, q[1]*z1*p[2] % P
+    if u1 == u2:
+        return _double(p) if s1 == s2 else (0, 0, 0)
+    h, r = u2 - u1, s2 - s1
+    h2 = h*h % P
+    h3 = h*h2 % P
+    x3 = (r*r - h3 - 2*u1*h2) % P
+    return (x3, (r*(u1*h2 - x3) - s1*h3) % P, h*p[2]*q[2] % P)
+
+
+def point_mul(k, point):
+    '''k times an affine point, as an affine point (None at infinity)'''
+    result, addend = (0, 0, 0), (point[0], point[1], 1)
+    while k:
+        if k & 1:
+            result = _add(result, addend)
+        addend = _double(addend)
+        k >>= 1
+    return _affine(result)
+
+
+def _affine(p):
+    if not p[2]:
+        return None
+    z = pow(p[2], P - 2, P)
+    return (p[0]*z*z % P, p[1]*z*z*z % P)
+
+
+def decompress(pub_key):
+    '''the point of a 33-byte compressed public key'''
+    if len(pub_key) != 33 or pub_key[0] not in (2, 3):
+        raise KeplrError('invalid public key')
+    x = int.from_bytes(pub_key[1:], 'big')
+    y = pow((pow(x, 3, P) + 7) % P, (P + 1)//4, P)
+    if (y*y - x**3 - 7) % P:
+        raise KeplrError('invalid public key')
+    return (x, y if y % 2 == pub_key[0] % 2 else P - y)
+
+
+def verify_secp256k1(pub_key, digest, signature):
+    '''ECDSA verification of a 64-byte (r, s) signature of a 32-byte digest'''
+    if len(signature) != 64:
+        return False
+    r, s = int.from_bytes(signature[:32], 'big'), int.from_bytes(
+        signature[32:], 'big')
+    if not (0 < r < N and 0 < s < N):
+        return False
+    point = decompress(pub_key)
+    w = pow(s, N - 2, N)
+    e = int.from_bytes(digest, 'big')
+    a, b = point_mul(e*w % N, G), point_mul(r*w % N, point)
+    q = _affine(_add((a[0], a[1], 1) if a else (0, 0, 0),
+                     (b[0], b[1], 1) if b else (0, 0, 0)))
+    return q is not None and q[0] % N == r
+
+
+# -------------------------------------------------------------------------- #
+#                                  Addresses                                 #
+# -------------------------------------------------------------------------- #
+
+bech32_charset = 'qpzry9x8gf2tvdw0s3jn54khce6mua7l'
+
+
+def _bech32_polymod(values):
+    generator = [0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3]
+    chk = 1
+    for v in values:
+        top = chk >> 25
+        chk = (chk & 0x1ffffff) << 5 ^ v
+        for i in range(5):
+            chk ^= generator[i] if (top >> i) & 1 else 0
+    return chk
+
+
+def bech32_encode(hrp, data):
+    '''bech32 encoding of bytes under a human readable prefix'''
+    acc, bits, words = 0, 0, []
+    for byte in data:
+        acc = (acc << 8) | byte
+        bits += 8
+        while bits >= 5:
+            bits -= 5
+            words.append((acc >> bits) & 31)
+    if bits:
+        words.append((acc << (5 - bits)) & 31)
+    values = [ord(c) >> 5 for c in hrp] + [0] + [ord(c) & 31 for c in hrp]
+    polymod = _bech32_polymod(values + words + [0]*6) ^ 1
+    checksum = [(polymod >> 5*(5 - i)) & 31 for i in range(6)]
+    return hrp + '1' + ''.join([bech32_charset[w] for w in words + checksum])
+
+
+def wallet_address(pub_key, prefix='secret'):
+    '''the bech32 address of a compressed secp256k1 public key'''
+    sha = hashlib.sha256(pub_key).digest()
+    return bech32_encode(prefix, RIPEMD160.new(sha).digest())
+
+
+def request_binding(endpoint, *credentials):
+    '''the binding of a request: sha256 hex digest of the compact json array of its endpoint and provider tokens,
+    as JSON.stringify([endpoint, ...credentials]) encodes it'''
+    payload = json.dumps([endpoint, *credentials],
+                         separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def signed_data(nonce, binding):
+    '''the data a keplr_token signs: its nonce and the binding of the request it was made for'''
+    return '{}|{}'.format(nonce, binding)
+
+
+def sign_doc(address, data):
+    '''the ADR-36 amino sign doc signed by Keplr's signArbitrary(), as canonical json bytes'''
+    doc = {'account_number': '0', 'chain_id': '', 'fee': {'amount': [], 'gas': '0'}, 'memo': '',
+           'msgs': [{'type': 'sign/MsgSignData', 'value': {'data': base64.b64encode(data.encode()).decode(), 'signer': address}}],
+           'sequence': '0'}
+    return json.dumps(doc, sort_keys=True, separators=(',', ':')).encode()
+
+
+# -------------------------------------------------------------------------- #
+#                                  Verifier                                  #
+# -------------------------------------------------------------------------- #
+
+def parse_token(keplr_token):
+    '''the address, public key, signature, and nonce of a keplr_token, given as a dict or a json string'''
+    try:
+        token = json.loads(keplr_token) if isinstance(
+            keplr_token, str) else keplr_token
+        pub_key = token['pub_key']
+        pub_key = pub_key['value'] if isinstance(pub_key, dict) else pub_key
+        return token['address'], base64.b64decode(pub_key), base64.b64decode(token['signature']), str(token['nonce'])
+    except (KeyError, TypeError, ValueError):
+        raise KeplrError('invalid keplr_token')
+
+
+class KeplrVerifier:
+    '''
+    Verifies keplr_tokens, keeping the last `size` verified (address, nonce) pairs and the signature and binding each was verified with
+    '''
+
+    def __init__(self, size=10000, ttl=300, prefix='secret'):
+        self.size = size
+        self.ttl = ttl
+        self.prefix = prefix
+        self.verified = OrderedDict()
+        self.stats = {'verified': 0, 'hits': 0,
+                      'rejected': 0, 'unsigned': 0}
+        self._lock = threading.Lock()
+
+    def verify(self, keplr_token, binding, now=None):
+        '''
+        Description:
+            verify that a keplr_token was signed by the wallet it names, over a fresh nonce and the request it comes with
+
+        Parameters:
+            keplr_token (dict or str): see the module docstring
+            binding (str): binding of the request, see request_binding()
+            now (float): current unix time. Defaults to now
+
+        Returns:
+            address (str): the verified wallet address
+
+        Raises:
+            KeplrError: if the token is malformed, expired, replayed with another signature or request, or not signed by the wallet
+        '''
+        now = time.time() if now is None else now
+        try:
+            address, pub_key, signature, nonce = parse_token(keplr_token)
+            try:
+                made = float(nonce.split(':')[0])
+            except ValueError:
+                raise KeplrError('invalid nonce')
+            if not now - self.ttl <= made <= now + 30:
+                raise KeplrError('expired nonce')
+
+            key = (address, nonce)
+            with self._lock:
+                hit = self.verified.get(key)
+                if hit is not None:
+                    # only an identical retry of the same request skips the signature check
+                    if hit != (signature, binding):
+                        raise KeplrError('nonce already used')
+                    self.verified.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return address
+
+            if wallet_address(pub_key, self.prefix) != address:
+                raise KeplrError('public key does not match the address')
+            digest = hashlib.sha256(
+                sign_doc(address, signed_data(nonce, binding))).digest()
+            if not verify_secp256k1(pub_key, digest, signature):
+                raise KeplrError('invalid signature')
+
+            with self._lock:
+                if self.verified.setdefault(key, (signature, binding)) != (signature, binding):
+                    raise KeplrError('nonce already used')
+                while len(self.verified) > self.size:
+                    self.verified.popitem(last=False)
+                self.stats['verified'] += 1
+            return address
+
+        except KeplrError:
+            with self._lock:
+                self.stats['rejected'] += 1
+            raise
+
+    def snapshot(self):
+        with self._lock:
+            return {**self.stats, 'cached': len(self.verified)}
+
+
+keplr_verifier = KeplrVerifier(int(getenv('KEPLR_CACHE_SIZE', 10000)), float(getenv('KEPLR_NONCE_TTL', 300)),
+                               getenv('KEPLR_PREFIX', 'secret'))
+_keplr_executor = ThreadPoolExecutor(
+    max_workers=int(getenv('KEPLR_WORKERS', 2)), thread_name_prefix='keplr')
+
+
+def keplr_address(keplr_token, binding):
+    '''
+    Description:
+        the verified wallet address a request is scored for. Signed tokens are required, unless KEPLR_VERIFY is 0:
+        plain addresses are then accepted, but never verified, so they mean no address. No token means no address
+
+    Parameters:
+        keplr_token (dict or str): signed token, or plain wallet address
+        binding (str): binding of the request, see request_binding()
+
+    Returns:
+        address (str): verified wallet address, or None
+
+    Raises:
+        KeplrError: if the token does not prove that the caller controls the wallet
+    '''
+    if not keplr_token:
+        return None
+    if isinstance(keplr_token, str) and not keplr_token.lstrip().startswith('{'):
+        if getenv('KEPLR_VERIFY', '1') == '1':
+            raise KeplrError('keplr_token must be signed')
+        # the score is still returned, but not issued to a wallet the caller did not prove they control
+        with keplr_verifier._lock:
+            keplr_verifier.stats['unsigned'] += 1
+        return None
+    return keplr_verifier.verify(keplr_token, binding)
+
+
+def verify_keplr_async(keplr_token, binding):
+    '''start verifying a keplr_token on a worker thread, so that it overlaps the upstream fetch. Returns a Future of keplr_address()'''
+    return _keplr_executor.submit(keplr_address, keplr_token, binding)
+
+
+def keplr_claim(keplr_token):
+    '''the wallet address a keplr_token claims, before it is verified. Used to key caches, never trusted'''
+    if not keplr_token:
+        return None
+    try:
+        return parse_token(keplr_token)[0]
+    except KeplrError:
+        return keplr_token if isinstance(keplr_token, str) else None
+
+
+def keplr_stats():
+    '''keplr_token verifications, cache hits, rejections, and unsigned tokens accepted by this worker'''
+    return keplr_verifier.snapshot()
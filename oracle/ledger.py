@@ -0,0 +1,177 @@
+'''Ledger of the issued scores, in a local SQLite database shared by all workers.
+
+Scores are indexed by wallet address, so that the latest or past scores of a wallet are served by a single indexed read,
+without fetching the user's data from Plaid or Coinbase again. Scores are public: only a compact record of each score is kept,
+never the balances, card names, or advice of its feedback.'''
+
+from datetime import datetime, timezone
+from os import getenv
+
+import threading
+import sqlite3
+import json
+
+
+schema = [
+    '''CREATE TABLE IF NOT EXISTS scores (
+        id INTEGER PRIMARY KEY,
+        address TEXT NOT NULL,
+        provider TEXT NOT NULL,
+        model_version TEXT NOT NULL,
+        score INTEGER NOT NULL,
+        feedback TEXT NOT NULL,
+        as_of TEXT,
+        issued_at TEXT NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS scores_address ON scores (address, id)',
+    'CREATE INDEX IF NOT EXISTS scores_address_provider ON scores (address, provider, id)',
+    '''CREATE TABLE IF NOT EXISTS attestations (
+        leaf TEXT PRIMARY KEY,
+        address TEXT NOT NULL,
+        attestation TEXT NOT NULL,
+        sealed_at TEXT NOT NULL
+    )'''
+]
+columns = ['id', 'address', 'provider', 'model_version',
+           'score', 'feedback', 'as_of', 'issued_at']
+# fields of the interpreted feedback kept in the ledger
+record_fields = ['points', 'quality', 'loan_amount', 'loan_duedate']
+
+
+def score_record(feedback):
+    '''the compact record of an interpreted score feedback that the ledger keeps: its points, quality, and loan terms'''
+    score = feedback.get('score', {}) if isinstance(feedback, dict) else {}
+    return {k: score.get(k) for k in record_fields}
+
+
+class ScoreLedger:
+    '''
+    Append-only table of issued scores. Each thread opens its own connection.
+    The database runs in WAL mode, so that reads never wait on writes and several workers can append at once
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.records = 0
+        self.errors = 0
+        self._local = threading.local()
+
+    def _connection(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            with db:
+                for statement in schema:
+                    db.execute(statement)
+            self._local.db = db
+        return db
+
+    def record(self, address, provider, model_version, score, feedback, as_of=None, issued_at=None):
+        '''
+        Description:
+            append an issued score to the ledger
+
+        Parameters:
+            address (str): wallet address the score was issued to
+            provider (str): 'plaid', 'coinbase', or 'combined'
+            model_version (str): version of the model that computed the score
+            score (int): score in range [300, 900]
+            feedback (dict): interpreted score feedback, as returned to the user. Only its score_record() is stored
+            as_of (date): scoring date
+            issued_at (datetime): time the score was issued. Defaults to now
+
+        Returns:
+            id (int): row id of the score
+        '''
+        issued_at = issued_at or datetime.now(timezone.utc)
+        db = self._connection()
+        with db:
+            cursor = db.execute('INSERT INTO scores (address, provider, model_version, score, feedback, as_of, issued_at) VALUES (?, ?, ?, ?, ?, ?, ?)', (
+                address, provider, model_version, int(score),
+                json.dumps(score_record(feedback), separators=(',', ':'), default=str),
+                as_of.isoformat() if as_of else None, issued_at.isoformat()))
+        self.records += 1
+        return cursor.lastrowid
+
+    def history(self, address, provider=None, limit=1):
+        '''
+        Description:
+            the scores issued to a wallet, newest first
+
+        Parameters:
+            address (str): wallet address
+            provider (str): only the scores of this provider, if given
+            limit (int): maximum number of scores
+
+        Returns:
+            scores (list): one dict per score, with the columns of the ledger. 'feedback' holds the compact score record
+        '''
+        if provider:
+            rows = self._connection().execute('SELECT * FROM scores WHERE address = ? AND provider = ? ORDER BY id DESC LIMIT ?',
+                                              (address, provider, limit))
+        else:
+            rows = self._connection().execute('SELECT * FROM scores WHERE address = ? ORDER BY id DESC LIMIT ?',
+                                              (address, limit))
+        scores = [dict(zip(columns, r)) for r in rows]
+        for s in scores:
+            s['feedback'] = json.loads(s['feedback'])
+        return scores
+
+    def latest(self, address, provider=None):
+        '''the latest score issued to a wallet, or None if there is none'''
+        scores = self.history(address, provider, 1)
+        return scores[0] if scores else None
+
+    def record_attestations(self, attestations, sealed_at=None):
+        '''
+        Description:
+            store the signed attestations of a sealed window, in a single transaction, so that any worker can serve them
+
+        Parameters:
+            attestations (list): attestations, as returned with the scores
+            sealed_at (datetime): time the window was sealed. Defaults to now
+        '''
+        sealed_at = (sealed_at or datetime.now(timezone.utc)).isoformat()
+        db = self._connection()
+        with db:
+            db.executemany('INSERT OR REPLACE INTO attestations (leaf, address, attestation, sealed_at) VALUES (?, ?, ?, ?)', [
+                (a['leaf'], a['record']['address'], json.dumps(a, separators=(',', ':')), sealed_at) for a in attestations])
+
+    def attestation(self, leaf):
+        '''the stored attestation of a leaf hash, or None if there is none'''
+        row = self._connection().execute(
+            'SELECT attestation FROM attestations WHERE leaf = ?', (leaf,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+
+_ledger = {'ledger': None}
+_ledger_lock = threading.Lock()
+
+
+def score_ledger():
+    '''the score ledger at SCORE_LEDGER_PATH (default score_ledger.db), opened on first use'''
+    path = getenv('SCORE_LEDGER_PATH', 'score_ledger.db')
+    with _ledger_lock:
+        if _ledger['ledger'] is None or _ledger['ledger'].path != path:
+            _ledger['ledger'] = ScoreLedger(path)
+        return _ledger['ledger']
+
+
+def ledger_record(address, provider, model_version, score, feedback, as_of=None, issued_at=None):
+    '''append an issued score to the ledger, if the wallet address is known. Never raises: a score is returned even if it cannot be stored'''
+    ledger = score_ledger()
+    if not address:
+        return None
+    try:
+        return ledger.record(address, provider, model_version, score, feedback, as_of, issued_at)
+    except (sqlite3.Error, TypeError, ValueError):
+        ledger.errors += 1
+        return None
+
+
+def ledger_stats():
+    '''number of scores appended to the ledger by this worker, and number of failed appends'''
+    ledger = score_ledger()
+    return {'path': ledger.path, 'records': ledger.records, 'errors': ledger.errors}
@@ -0,0 +1,234 @@
+'''Publication of the issued scores to the chain, in batches.
+
+Scores are queued by wallet address and provider, so that only the latest score of a wallet from each provider is published, and flushed in batches
+of PUBLISH_BATCH scores (default 50) or every PUBLISH_INTERVAL seconds (default 30), whichever comes first.
+One transaction per batch amortizes fees and signing across users.
+A batch that fails is retried with the same batch id, before any newer batch, so that scores land in order and
+a batch that did land despite an error is not published twice.'''
+
+from collections import OrderedDict
+from datetime import datetime, timezone
+from icecream import ic
+from os import getenv
+
+import importlib
+import threading
+import hashlib
+import atexit
+import json
+import time
+
+
+# -------------------------------------------------------------------------- #
+#                                 Submitters                                 #
+# -------------------------------------------------------------------------- #
+
+class Submitter:
+    '''Interface of the chain the batches of scores are published to'''
+
+    def submit(self, batch_id, records):
+        '''
+        Description:
+            publish a batch of scores in a single transaction. Must be idempotent:
+            a batch id already published returns the transaction that published it, and publishes nothing
+
+        Parameters:
+            batch_id (str): content hash of the batch
+            records (list): one dict per score, with address, provider, model_version, score, and issued_at
+
+        Returns:
+            tx (str): transaction id
+        '''
+        raise NotImplementedError
+
+
+class LocalChain(Submitter):
+    '''
+    A local stand-in for the chain, holding the latest score of each wallet and provider in memory.
+    It can be told to fail the next `failures` submissions, after publishing them or not
+    '''
+
+    def __init__(self):
+        self.batches = dict()
+        self.scores = dict()
+        self.transactions = 0
+        self.failures = 0
+        self.fail_after_publish = False
+        self._lock = threading.Lock()
+
+    def submit(self, batch_id, records):
+        with self._lock:
+            if batch_id not in self.batches:
+                if self.failures and not self.fail_after_publish:
+                    self.failures -= 1
+                    raise Exception('local chain unavailable')
+                self.transactions += 1
+                self.batches[batch_id] = 'tx{}'.format(self.transactions)
+                for r in records:
+                    self.scores[(r['address'], r['provider'])] = r
+            if self.failures:
+                self.failures -= 1
+                raise Exception('local chain timed out')
+            return self.batches[batch_id]
+
+
+def load_submitter(name):
+    '''the submitter named by PUBLISH_SUBMITTER: 'local' for the local chain, or 'module:Class' for any other'''
+    if name == 'local':
+        return LocalChain()
+    module, cls = name.split(':')
+    return getattr(importlib.import_module(module), cls)()
+
+
+# -------------------------------------------------------------------------- #
+#                              Publication Queue                             #
+# -------------------------------------------------------------------------- #
+
+def batch_id(records):
+    '''content hash of a batch of scores'''
+    payload = json.dumps(records, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class PublicationQueue:
+    '''
+    Queue of the scores waiting to be published, flushed in batches by a background thread
+    '''
+
+    def __init__(self, submitter, batch_size=50, interval=30, backoff=1, max_backoff=300, max_pending=10000):
+        self.submitter = submitter
+        self.batch_size = batch_size
+        self.interval = interval
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_pending = max_pending
+        self.pending = OrderedDict()
+        self.retry = None
+        self.stats = {'queued': 0, 'dropped': 0, 'published': 0,
+                      'batches': 0, 'failures': 0, 'last_tx': None}
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def put(self, record):
+        '''queue a score for publication. A newer score of the same wallet from the same provider replaces the one queued'''
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='publisher', daemon=True)
+                self._thread.start()
+                atexit.register(self.flush, True)
+            key = (record['address'], record['provider'])
+            self.pending.pop(key, None)
+            self.pending[key] = (time.time(), record)
+            self.stats['queued'] += 1
+            if len(self.pending) > self.max_pending:
+                self.pending.popitem(last=False)
+                self.stats['dropped'] += 1
+            if len(self.pending) >= self.batch_size:
+                self._cond.notify()
+
+    def _wait(self, now):
+        '''seconds until the next batch is due, 0 if one is due now'''
+        if self.retry:
+            return max(self.retry['retry_at'] - now, 0)
+        if len(self.pending) >= self.batch_size:
+            return 0
+        if self.pending:
+            return max(next(iter(self.pending.values()))[0] + self.interval - now, 0)
+        return self.interval
+
+    def _next_batch(self, force):
+        '''the batch to submit now, if any: the failed batch once its backoff is over, else the oldest queued scores'''
+        now = time.time()
+        if self.retry:
+            return self.retry if force or self.retry['retry_at'] <= now else None
+        if self.pending and (force or self._wait(now) == 0):
+            records = [self.pending.popitem(last=False)[1][1]
+                       for _ in range(min(self.batch_size, len(self.pending)))]
+            return {'id': batch_id(records), 'records': records, 'attempts': 0}
+        return None
+
+    def flush(self, force=False):
+        '''
+        Description:
+            submit the batches that are due, one at a time and in order. A failed batch stops the flush,
+            and is retried first, after an exponential backoff
+
+        Parameters:
+            force (bool): submit the queued scores and the failed batch now, even if no batch is due
+
+        Returns:
+            count (int): number of scores published
+        '''
+        count = 0
+        with self._flush_lock:
+            while True:
+                with self._cond:
+                    batch = self._next_batch(force)
+                if batch is None:
+                    return count
+                try:
+                    tx = self.submitter.submit(batch['id'], batch['records'])
+                except Exception as e:
+                    ic(e)
+                    with self._cond:
+                        batch['attempts'] += 1
+                        batch['retry_at'] = time.time() + min(self.backoff*2**(batch['attempts'] - 1),
+                                                              self.max_backoff)
+                        self.retry = batch
+                        self.stats['failures'] += 1
+                    return count
+                with self._cond:
+                    self.retry = None
+                    self.stats['published'] += len(batch['records'])
+                    self.stats['batches'] += 1
+                    self.stats['last_tx'] = tx
+                count += len(batch['records'])
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait(self._wait(time.time()))
+            self.flush()
+
+    def snapshot(self):
+        '''number of scores queued and published, batches published, and failures'''
+        with self._cond:
+            return {**self.stats, 'pending': len(self.pending),
+                    'retrying': len(self.retry['records']) if self.retry else 0}
+
+
+_queue = {'queue': None}
+_queue_lock = threading.Lock()
+
+
+def publication_queue():
+    '''the publication queue of this worker, to the submitter named by PUBLISH_SUBMITTER. None if publication is disabled'''
+    with _queue_lock:
+        if _queue['queue'] is None and getenv('PUBLISH_SUBMITTER'):
+            _queue['queue'] = PublicationQueue(load_submitter(getenv('PUBLISH_SUBMITTER')),
+                                               int(getenv('PUBLISH_BATCH', 50)), float(
+                                                   getenv('PUBLISH_INTERVAL', 30)),
+                                               max_pending=int(getenv('PUBLISH_MAX_PENDING', 10000)))
+        return _queue['queue']
+
+
+def publish_score(address, provider, model_version, score, issued_at=None):
+    '''queue an issued score for publication, if publication is enabled and the wallet address is known. Never raises'''
+    try:
+        queue = publication_queue()
+        if queue is None or not address:
+            return False
+        queue.put({'address': address, 'provider': provider, 'model_version': model_version, 'score': int(score),
+                   'issued_at': (issued_at or datetime.now(timezone.utc)).isoformat()})
+        return True
+    except Exception as e:
+        ic(e)
+        return False
+
+
+def publish_stats():
+    '''publication counters of this worker, or None if publication is disabled'''
+    queue = _queue['queue']
+    return queue.snapshot() if queue else None
@@ -0,0 +1,242 @@
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from datetime import datetime, timezone
+from support.score import *
+
+import argparse
+import bisect
+import calendar
+import csv
+import json
+import os
+import time
+import warnings
+
+
+pillars = ['credit', 'velocity', 'stability', 'diversity',
+           'kyc', 'history', 'liquidity', 'activity']
+columns = ['user', 'model', 'as_of', 'transactions', 'score'] + pillars + ['error']
+
+
+# -------------------------------------------------------------------------- #
+#                               Helper Functions                             #
+# -------------------------------------------------------------------------- #
+
+def monthly_dates(end, months):
+    '''
+    Description:
+        the as-of dates of a monthly backtest: the same day of the month as `end`,
+        for each of the `months` months up to `end`, oldest first. Days are capped at the end of shorter months
+
+    Parameters:
+        end (date): last as-of date
+        months (int): number of as-of dates
+
+    Returns:
+        dates (list): as-of dates
+    '''
+    dates = []
+    for i in range(months):
+        year, month = divmod(end.year*12 + end.month - 1 - i, 12)
+        day = min(end.day, calendar.monthrange(year, month + 1)[1])
+        dates.append(end.replace(year=year, month=month + 1, day=day))
+    return dates[::-1]
+
+
+def corpus_files(corpus):
+    '''the stored user histories of a corpus: every .json file under the corpus directory, in a stable order'''
+    if os.path.isfile(corpus):
+        return [corpus]
+    files = []
+    for root, dirs, names in os.walk(corpus):
+        files += [os.path.join(root, n) for n in names if n.endswith('.json')]
+    return sorted(files)
+
+
+# -------------------------------------------------------------------------- #
+#                                User Histories                              #
+# -------------------------------------------------------------------------- #
+
+def load_history(path):
+    '''
+    Description:
+        load a stored user history, in the same shape as returned by the Plaid or Coinbase fetch,
+        and normalize it once: dates are parsed and transactions are sorted newest first, as the providers return them,
+        so that the history as of any date is a tail of the transactions list
+
+    Parameters:
+        path (str): path to a .json file with 'accounts' and 'transactions' keys
+
+    Returns:
+        model (str): 'plaid' or 'coinbase'
+        data (dict): normalized history
+        days (list): date of each transaction, oldest first, to slice the history with
+    '''
+    with open(path) as f:
+        data = json.load(f)
+
+    if 'item' in data or any(['account_id' in a for a in data['accounts']]):
+        txn = [t for t in data['transactions'] if not t.get('pending')]
+        for t in txn:
+            if isinstance(t['date'], str):
+                t['date'] = datetime.strptime(t['date'], '%Y-%m-%d').date()
+        txn.sort(key=lambda t: t['date'], reverse=True)
+        data['transactions'] = txn
+        return 'plaid', data, [t['date'] for t in txn[::-1]]
+
+    for a in data['accounts']:
+        if isinstance(a['created_at'], str):
+            a['created_at'] = datetime.strptime(
+                a['created_at'], '%Y-%m-%dT%H:%M:%SZ').date()
+    data['transactions'].sort(key=lambda t: t['created_at'], reverse=True)
+    return 'coinbase', data, [t['created_at'][:10] for t in data['transactions'][::-1]]
+
+
+def slice_history(model, data, days, as_of):
+    '''
+    Description:
+        a normalized user history as of a date. The transactions up to that date are sliced off the sorted list,
+        rather than filtered or parsed again
+
+    Parameters:
+        model (str): 'plaid' or 'coinbase'
+        data (dict): normalized history, as returned by load_history()
+        days (list): date of each transaction, as returned by load_history()
+        as_of (date): scoring date
+
+    Returns:
+        n (int): number of transactions as of the date
+        history (dict): Plaid 'Transactions' product, or Coinbase accounts and transactions, as of the date
+    '''
+    n = bisect.bisect_right(days, as_of if model == 'plaid' else as_of.isoformat())
+    if not n:
+        raise Exception('no transactions as of this date')
+    return n, {**data, 'transactions': data['transactions'][len(days) - n:]}
+
+
+def score_history(model, data, days, as_of):
+    '''
+    Description:
+        score a normalized user history as of a date
+
+    Parameters:
+        model (str): 'plaid' or 'coinbase'
+        data (dict): normalized history, as returned by load_history()
+        days (list): date of each transaction, as returned by load_history()
+        as_of (date): scoring date
+
+    Returns:
+        row (dict): number of transactions seen, score, and pillar scores as of the date
+    '''
+    n, history = slice_history(model, data, days, as_of)
+    if model == 'plaid':
+        stages = plaid_score_stages(history, create_feedback_plaid(), as_of)
+    else:
+        stages = coinbase_score_stages(
+            history['accounts'], history['transactions'], create_feedback_coinbase(), as_of)
+
+    row = {'transactions': n}
+    for stage, value, feedback in stages:
+        key = stage.split('_', 1)[-1]
+        row[key] = int(value) if stage == 'score' else round(value, 4)
+    return row
+
+
+def backtest_user(path, dates):
+    '''
+    Description:
+        score one stored user history at each as-of date. The history is loaded and normalized once for all dates
+
+    Parameters:
+        path (str): path to the stored user history
+        dates (list): as-of dates
+
+    Returns:
+        rows (list): one row of the results table per as-of date
+    '''
+    user = os.path.splitext(os.path.basename(path))[0]
+    try:
+        model, data, days = load_history(path)
+    except Exception as e:
+        return [{'user': user, 'as_of': d.isoformat(), 'error': 'invalid history: {}'.format(e)} for d in dates]
+
+    rows = []
+    with warnings.catch_warnings():
+        # metrics over short histories warn on empty slices, but already fall back to a default score
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for d in dates:
+            row = {'user': user, 'model': model, 'as_of': d.isoformat()}
+            try:
+                row.update(score_history(model, data, days, d))
+            except Exception as e:
+                row['error'] = str(e)
+            rows.append(row)
+    return rows
+
+
+def _backtest_user(args):
+    return backtest_user(*args)
+
+
+# -------------------------------------------------------------------------- #
+#                                   Runner                                   #
+# -------------------------------------------------------------------------- #
+
+def run_backtest(files, dates, out, workers=None, chunksize=16):
+    '''
+    Description:
+        score every user of a corpus at every as-of date, spreading users across a pool of processes,
+        and stream the results table to a csv file as users complete, in corpus order
+
+    Parameters:
+        files (list): paths to the stored user histories
+        dates (list): as-of dates
+        out (str): path to the output .csv file. One row per user and as-of date
+        workers (int): number of processes. Defaults to the number of CPUs. 1 runs in this process
+        chunksize (int): number of users sent to a process at once
+
+    Returns:
+        count (int): number of rows written
+    '''
+    tasks = [(f, dates) for f in files]
+    count = 0
+    with open(out, 'w', newline='') as f, ProcessPoolExecutor(max_workers=workers) if workers != 1 else nullcontext() as executor:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+
+        results = executor.map(_backtest_user, tasks, chunksize=chunksize) if executor else map(
+            _backtest_user, tasks)
+        for rows in results:
+            writer.writerows(rows)
+            count += len(rows)
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Backtest the credit score models over a corpus of stored user histories, at monthly as-of dates')
+    parser.add_argument(
+        'corpus', help='directory of stored user histories (.json), or a single history')
+    parser.add_argument('--months', type=int, default=12,
+                        help='number of monthly as-of dates (default: 12)')
+    parser.add_argument('--end', default=None,
+                        help='last as-of date, YYYY-MM-DD (default: today, UTC)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of processes (default: number of CPUs)')
+    parser.add_argument('--out', default='backtest.csv',
+                        help='output csv file (default: backtest.csv)')
+    args = parser.parse_args(argv)
+
+    end = datetime.strptime(args.end, '%Y-%m-%d').date(
+    ) if args.end else datetime.now(timezone.utc).date()
+    dates = monthly_dates(end, args.months)
+    files = corpus_files(args.corpus)
+
+    t0 = time.time()
+    count = run_backtest(files, dates, args.out, args.workers)
+    print('{} users x {} dates: {} rows written to {} in {:.1f} sec'.format(
+        len(files), len(dates), count, args.out, time.time() - t0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,357 @@
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from support.backtest import *
+
+import numpy as np
+import pandas as pd
+
+
+# -------------------------------------------------------------------------- #
+#                               Helper Functions                             #
+# -------------------------------------------------------------------------- #
+
+def model_spec(model):
+    '''
+    Description:
+        the current weights of a model, and the layout of its metrics in the calibration matrices
+
+    Parameters:
+        model (str): 'plaid' or 'coinbase'
+
+    Returns:
+        weights (dict): weights of the metrics of each pillar
+        pillar_weights (dict): weights of the pillars of each branch of the model.
+            Plaid users are scored on the 'credit' or 'no_credit' branch, Coinbase users on a single branch
+        layout (list): (pillar, metric) of each column of the metric matrix
+    '''
+    if model == 'plaid':
+        weights, pillar_weights = plaid_weights, plaid_pillar_weights
+    else:
+        weights, pillar_weights = coinbase_weights, {
+            'coinbase': coinbase_pillar_weights}
+    layout = [(p, m) for p in weights for m in weights[p]]
+    return weights, pillar_weights, layout
+
+
+def history_metrics(model, history, as_of):
+    '''
+    Description:
+        the grid score of every metric of a user history, before weighting
+
+    Parameters:
+        model (str): 'plaid' or 'coinbase'
+        history (dict): Plaid 'Transactions' product, or Coinbase accounts and transactions
+        as_of (date): scoring date
+
+    Returns:
+        branch (str): branch of the model the user is scored on
+        metrics (dict): grid score of each metric of each pillar. Metrics of a pillar left out of the branch are 0
+    '''
+    weights, pillar_weights, layout = model_spec(model)
+    metrics = {p: {k: 0 for k in weights[p]} for p in weights}
+    if model == 'plaid':
+        stages = plaid_score_stages(
+            history, create_feedback_plaid(), as_of, metrics)
+    else:
+        stages = coinbase_score_stages(
+            history['accounts'], history['transactions'], create_feedback_coinbase(), as_of, metrics)
+    for stage in stages:
+        pass
+    return metrics.pop('branch'), metrics
+
+
+def _labeled_metrics(args):
+    path, as_of = args
+    try:
+        model, data, days = load_history(path)
+        n, history = slice_history(model, data, days, as_of)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            return model, history_metrics(model, history, as_of)
+    except Exception:
+        return None, None
+
+
+def load_labels(path):
+    '''
+    Description:
+        load the outcomes of a labeled corpus
+
+    Parameters:
+        path (str): csv file with a 'user' column (the file name of the user history, without extension),
+            an 'outcome' column (1 if the user defaulted, 0 if they repaid), and an optional 'as_of' column (YYYY-MM-DD)
+            with the date the loan was granted, i.e. the date to score the user as of
+
+    Returns:
+        labels (dict): (outcome, as_of) of each user
+    '''
+    labels = dict()
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            as_of = datetime.strptime(row['as_of'], '%Y-%m-%d').date(
+            ) if row.get('as_of') else None
+            labels[row['user']] = (int(row['outcome']), as_of)
+    return labels
+
+
+# -------------------------------------------------------------------------- #
+#                              Metric Matrices                               #
+# -------------------------------------------------------------------------- #
+
+def metric_matrix(files, labels, model, as_of=None, workers=None):
+    '''
+    Description:
+        compute the metric grid scores of every labeled user of a corpus once, spreading users across a pool of processes.
+        Every candidate weight vector is then evaluated on this matrix, without running the pipeline again
+
+    Parameters:
+        files (list): paths to the stored user histories
+        labels (dict): (outcome, as_of) of each user, as returned by load_labels()
+        model (str): 'plaid' or 'coinbase'. Users of the other model are left out
+        as_of (date): scoring date of the users without an as_of label. Defaults to today
+        workers (int): number of processes. Defaults to the number of CPUs. 1 runs in this process
+
+    Returns:
+        X (np.ndarray): N x (branches x metrics) design matrix. The metrics of a user fill the block of its branch
+        y (np.ndarray): outcome of each user (1 if defaulted)
+    '''
+    weights, pillar_weights, layout = model_spec(model)
+    branches = list(pillar_weights)
+    users = [(f, labels[os.path.splitext(os.path.basename(f))[0]])
+             for f in files if os.path.splitext(os.path.basename(f))[0] in labels]
+    tasks = [(f, label[1] or scoring_date(as_of)) for f, label in users]
+
+    rows, y = [], []
+    with ProcessPoolExecutor(max_workers=workers) if workers != 1 else nullcontext() as executor:
+        results = executor.map(_labeled_metrics, tasks, chunksize=16) if executor else map(
+            _labeled_metrics, tasks)
+        for (f, (outcome, _)), (m, result) in zip(users, results):
+            if m != model:
+                continue
+            branch, metrics = result
+            row = np.zeros(len(branches)*len(layout))
+            i = branches.index(branch)*len(layout)
+            row[i:i + len(layout)] = [metrics[p][k] for p, k in layout]
+            rows.append(row)
+            y.append(outcome)
+
+    return np.array(rows).reshape(-1, len(branches)*len(layout)), np.array(y)
+
+
+def weight_matrix(weights, pillar_weights):
+    '''
+    Description:
+        the effective weight of every metric of every branch of a candidate model: pillar weight x metric weight
+
+    Parameters:
+        weights (dict): weights of the metrics of each pillar
+        pillar_weights (dict): weights of the pillars of each branch
+
+    Returns:
+        w (np.ndarray): (branches x metrics) vector, the row of a candidate in the weight matrix
+    '''
+    layout = [(p, m) for p in weights for m in weights[p]]
+    return np.concatenate([[pillar_weights[b].get(p, 0)*weights[p][m] for p, m in layout]
+                           for b in pillar_weights])
+
+
+def model_scores(X, W):
+    '''scores of N users under K candidate models, as a single matrix product: 300 + 600 X W.T (N x K)'''
+    return 300 + 600*(X @ W.T)
+
+
+# -------------------------------------------------------------------------- #
+#                                   Ranking                                  #
+# -------------------------------------------------------------------------- #
+
+def auc(scores, y):
+    '''
+    Description:
+        area under the ROC curve of each column of scores: the probability that a user who repaid
+        scores higher than a user who defaulted. Ties count for half
+
+    Parameters:
+        scores (np.ndarray): N x K scores
+        y (np.ndarray): outcome of each user (1 if defaulted)
+
+    Returns:
+        auc (np.ndarray): K values in range [0, 1]
+    '''
+    good = y == 0
+    n_good, n_bad = good.sum(), (~good).sum()
+    ranks = pd.DataFrame(scores).rank(axis=0).values
+    return (ranks[good].sum(axis=0) - n_good*(n_good + 1)/2)/(n_good*n_bad)
+
+
+def ks(scores, y):
+    '''
+    Description:
+        Kolmogorov-Smirnov statistic of each column of scores: the max distance between
+        the score distributions of the users who repaid and of the users who defaulted
+
+    Parameters:
+        scores (np.ndarray): N x K scores
+        y (np.ndarray): outcome of each user (1 if defaulted)
+
+    Returns:
+        ks (np.ndarray): K values in range [0, 1]
+    '''
+    order = np.argsort(scores, axis=0, kind='stable')
+    s = np.take_along_axis(scores, order, axis=0)
+    bad = y[order]
+    distance = np.abs(np.cumsum(bad, axis=0)/bad.sum(axis=0) -
+                      np.cumsum(1 - bad, axis=0)/(1 - bad).sum(axis=0))
+    # the distributions can only be compared after the last of a run of tied scores
+    distance[:-1][s[:-1] == s[1:]] = 0
+    return distance.max(axis=0)
+
+
+# -------------------------------------------------------------------------- #
+#                               Random Search                                #
+# -------------------------------------------------------------------------- #
+
+def random_candidates(rng, size, weights, pillar_weights):
+    '''
+    Description:
+        draw candidate models at random: the metric weights of each pillar, and the pillar weights of each branch,
+        are drawn uniformly among the weights that add up to the same total as the current ones
+
+    Parameters:
+        rng (np.random.Generator): random generator
+        size (int): number of candidates
+        weights (dict): current weights of the metrics of each pillar
+        pillar_weights (dict): current weights of the pillars of each branch
+
+    Returns:
+        W (np.ndarray): size x (branches x metrics) weight matrix
+        candidates (list): (weights, pillar_weights) of each candidate, as a function of its row in W
+    '''
+    draws = {p: rng.dirichlet(np.ones(len(weights[p])), size)*sum(weights[p].values())
+             for p in weights}
+    pillar_draws = {b: rng.dirichlet(np.ones(len(pillar_weights[b])), size)*sum(pillar_weights[b].values())
+                    for b in pillar_weights}
+
+    def candidate(i):
+        return ({p: dict(zip(weights[p], draws[p][i].round(4))) for p in weights},
+                {b: dict(zip(pillar_weights[b], pillar_draws[b][i].round(4))) for b in pillar_weights})
+
+    layout = [(p, m) for p in weights for m in weights[p]]
+    W = np.concatenate([np.stack([pillar_draws[b][:, list(pillar_weights[b]).index(p)] * draws[p][:, list(weights[p]).index(m)]
+                                  if p in pillar_weights[b] else np.zeros(size) for p, m in layout], axis=1)
+                        for b in pillar_weights], axis=1)
+    return W, candidate
+
+
+_X, _y = None, None
+
+
+def _init_search(X, y):
+    global _X, _y
+    _X, _y = X, y
+
+
+def _search(args):
+    model, seed, size, top = args
+    weights, pillar_weights, layout = model_spec(model)
+    W, candidate = random_candidates(
+        np.random.default_rng(seed), size, weights, pillar_weights)
+    scores = model_scores(_X, W)
+    a, k = auc(scores, _y), ks(scores, _y)
+    best = np.lexsort((-k, -a))[:top]
+    return [(a[i], k[i], *candidate(i)) for i in best]
+
+
+def calibrate(X, y, model, candidates=10000, batch=500, top=10, seed=0, workers=None):
+    '''
+    Description:
+        random search of the weights of a model, ranked by AUC then KS against the outcomes.
+        Candidates are drawn and evaluated in batches, one matrix product per batch, spread across a pool of processes
+
+    Parameters:
+        X (np.ndarray): design matrix, as returned by metric_matrix()
+        y (np.ndarray): outcome of each user (1 if defaulted)
+        model (str): 'plaid' or 'coinbase'
+        candidates (int): number of candidate models
+        batch (int): number of candidates evaluated at once. Memory grows with N x batch
+        top (int): number of candidates returned
+        seed (int): random seed. The same seed draws the same candidates, whatever the number of workers
+        workers (int): number of processes. Defaults to the number of CPUs. 1 runs in this process
+
+    Returns:
+        current (dict): AUC and KS of the current weights
+        ranking (list): auc, ks, weights, and pillar_weights of the best candidates, best first
+    '''
+    weights, pillar_weights, layout = model_spec(model)
+    scores = model_scores(X, weight_matrix(
+        weights, pillar_weights).reshape(1, -1))
+    current = {'auc': auc(scores, y)[0], 'ks': ks(scores, y)[0]}
+
+    seeds = np.random.SeedSequence(seed).generate_state(
+        (candidates + batch - 1)//batch)
+    tasks = [(model, int(s), min(batch, candidates - i*batch), top)
+             for i, s in enumerate(seeds)]
+
+    ranking = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_search, initargs=(X, y)) if workers != 1 else nullcontext() as executor:
+        if executor is None:
+            _init_search(X, y)
+        for best in executor.map(_search, tasks) if executor else map(_search, tasks):
+            ranking += best
+    ranking.sort(key=lambda c: (-c[0], -c[1]))
+
+    keys = ['auc', 'ks', 'weights', 'pillar_weights']
+    return current, [dict(zip(keys, c)) for c in ranking[:top]]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Calibrate the weights of a credit score model against the outcomes of a labeled corpus')
+    parser.add_argument(
+        'corpus', help='directory of stored user histories (.json)')
+    parser.add_argument(
+        'labels', help='csv file with user, outcome (1 if defaulted), and optional as_of columns')
+    parser.add_argument('--model', choices=['plaid', 'coinbase'], default='plaid',
+                        help='model to calibrate (default: plaid)')
+    parser.add_argument('--as-of', default=None,
+                        help='scoring date of the users without an as_of label, YYYY-MM-DD (default: today, UTC)')
+    parser.add_argument('--candidates', type=int, default=10000,
+                        help='number of candidate weight vectors (default: 10000)')
+    parser.add_argument('--batch', type=int, default=500,
+                        help='candidates evaluated per matrix product (default: 500)')
+    parser.add_argument('--top', type=int, default=10,
+                        help='number of best candidates written (default: 10)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed (default: 0)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of processes (default: number of CPUs)')
+    parser.add_argument('--out', default='calibration.json',
+                        help='output json file (default: calibration.json)')
+    args = parser.parse_args(argv)
+
+    as_of = datetime.strptime(args.as_of, '%Y-%m-%d').date(
+    ) if args.as_of else datetime.now(timezone.utc).date()
+
+    t0 = time.time()
+    X, y = metric_matrix(corpus_files(args.corpus), load_labels(
+        args.labels), args.model, as_of, args.workers)
+    if not 0 < y.sum() < len(y):
+        raise SystemExit(
+            'the labeled corpus needs users who defaulted and users who repaid')
+    t1 = time.time()
+    current, ranking = calibrate(X, y, args.model, args.candidates,
+                                 args.batch, args.top, args.seed, args.workers)
+    t2 = time.time()
+
+    with open(args.out, 'w') as f:
+        json.dump({'model': args.model, 'model_version': model_version, 'users': len(y), 'defaults': int(y.sum()),
+                   'current': current, 'ranking': ranking}, f, indent=4, default=float)
+    print('{} users scored in {:.1f} sec, {} candidates ranked in {:.1f} sec'.format(
+        len(y), t1 - t0, args.candidates, t2 - t1))
+    print('current weights: AUC {:.3f}, KS {:.3f}'.format(
+        current['auc'], current['ks']))
+    print('best candidate:  AUC {:.3f}, KS {:.3f}, written to {}'.format(
+        ranking[0]['auc'], ranking[0]['ks'], args.out))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,10 @@
+from datetime import datetime, timezone
+
+
+# -------------------------------------------------------------------------- #
+#                               Helper Functions                             #
+# -------------------------------------------------------------------------- #
+
+def scoring_date(as_of=None):
+    '''returns the date a score is computed as of: as_of if given, else today in UTC. Read at call time, never frozen at import time'''
+    return as_of or datetime.now(timezone.utc).date()
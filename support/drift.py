@@ -0,0 +1,351 @@
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from datetime import datetime, timezone
+from support.backtest import *
+from os import getenv
+
+import numpy as np
+import threading
+import argparse
+import warnings
+import random
+import math
+import json
+import time
+import os
+
+
+# -------------------------------------------------------------------------- #
+#                                  Features                                  #
+# -------------------------------------------------------------------------- #
+# Features watched for drift, read from the score feedback: feature-(pillar, feedback key) pairs.
+# The final score is always watched too
+
+drift_features = {
+    'plaid': {
+        'credit_limit': ('credit', 'credit_limit'),
+        'utilization_ratio': ('credit', 'utilization_ratio'),
+        'monthly_deposits': ('velocity', 'deposits_volume'),
+        'balance': ('stability', 'cumulative_current_balance')
+    },
+    'coinbase': {
+        'balance': ('liquidity', 'current_balance'),
+        'avg_running_balance': ('liquidity', 'avg_running_balance')
+    }
+}
+
+
+def feature_values(model, score, feedback):
+    '''the watched features of a scored user found in the feedback, and the score'''
+    values = {'score': score}
+    for feature, (pillar, key) in drift_features[model].items():
+        v = feedback.get(pillar, {}).get(key)
+        if isinstance(v, (int, float)) and math.isfinite(v):
+            values[feature] = v
+    return values
+
+
+# -------------------------------------------------------------------------- #
+#                              Quantile Sketch                               #
+# -------------------------------------------------------------------------- #
+
+class KLL:
+    '''
+    KLL streaming quantile sketch (Karnin, Lang, Liberty, 2016).
+    Values are kept in a stack of compactors. When the sketch is full, a compactor sorts its values and promotes
+    every other one to the compactor above, where each value counts twice as much. Capacities shrink by a factor c
+    down the stack, so that the sketch holds about k/(1 - c) values however many it has seen,
+    and ranks are off by about 1/k of the count
+    '''
+
+    def __init__(self, k=200, c=2/3, rng=None):
+        self.k = k
+        self.c = c
+        self.rng = rng or random.Random()
+        self.compactors = list()
+        self.count = 0
+        self.size = 0
+        self.max_size = 0
+        self._grow()
+
+    def _grow(self):
+        self.compactors.append(list())
+        self.max_size = sum([self._capacity(h)
+                            for h in range(len(self.compactors))])
+
+    def _capacity(self, h):
+        return int(math.ceil(self.k*self.c**(len(self.compactors) - h - 1))) + 1
+
+    def update(self, value):
+        self.compactors[0].append(value)
+        self.count += 1
+        self.size += 1
+        if self.size >= self.max_size:
+            self._compress()
+
+    def _compress(self):
+        for h in range(len(self.compactors)):
+            if len(self.compactors[h]) >= self._capacity(h):
+                if h + 1 >= len(self.compactors):
+                    self._grow()
+                values = sorted(self.compactors[h])
+                # promote the values at even or odd positions at random. An odd number of values leaves the largest behind
+                offset = int(self.rng.random() < 0.5)
+                end = len(values) - len(values) % 2
+                self.compactors[h] = values[end:]
+                self.compactors[h + 1] += values[offset:end:2]
+                self.size = sum([len(c) for c in self.compactors])
+                if self.size < self.max_size:
+                    break
+
+    def _weighted(self):
+        '''the values held, sorted, with the cumulative weight up to each of them'''
+        items = sorted([(v, 2**h) for h, c in enumerate(self.compactors)
+                        for v in c])
+        values = np.array([v for v, w in items], dtype=float)
+        weights = np.cumsum([w for v, w in items])
+        return values, weights
+
+    def cdf(self, x):
+        '''estimated share of the values seen that are <= x, for each x'''
+        values, weights = self._weighted()
+        if not len(values):
+            return np.zeros(len(np.atleast_1d(x)))
+        i = np.searchsorted(values, x, side='right')
+        return np.where(i > 0, weights[np.maximum(i - 1, 0)], 0)/weights[-1]
+
+    def quantile(self, q):
+        '''estimated q-quantile of the values seen, for each q in range [0, 1]'''
+        values, weights = self._weighted()
+        if not len(values):
+            return np.full(len(np.atleast_1d(q)), np.nan)
+        i = np.searchsorted(weights, np.asarray(q)*weights[-1], side='left')
+        return values[np.minimum(i, len(values) - 1)]
+
+
+# -------------------------------------------------------------------------- #
+#                               Drift Statistics                             #
+# -------------------------------------------------------------------------- #
+# A baseline holds the percentiles 0, 1, ..., 100 of each feature over the population the grids were tuned on,
+# under model/model_version/feature keys, as written by the command line below
+
+def baseline_cdf(percentiles, x):
+    '''share of the baseline population <= x, from its 101 percentiles'''
+    i = np.searchsorted(percentiles, x, side='right') - 1
+    return np.clip(i, 0, 100)/100
+
+
+def drift_psi(percentiles, sketch, bins=10, eps=1e-4):
+    '''
+    Description:
+        population stability index of the values in a sketch against a baseline, over the baseline deciles.
+        Below 0.1 is usually read as no shift, above 0.25 as a major shift
+
+    Parameters:
+        percentiles (np.ndarray): 101 percentiles of the baseline
+        sketch (KLL): sketch of the current values
+        bins (int): number of quantile bins of the baseline
+        eps (float): floor of the bin shares, so that empty bins do not make the index infinite
+
+    Returns:
+        psi (float): population stability index
+    '''
+    edges = np.unique(percentiles[np.arange(1, bins)*100//bins])
+    expected = np.diff(np.concatenate(
+        [[0], baseline_cdf(percentiles, edges), [1]]))
+    actual = np.diff(np.concatenate([[0], sketch.cdf(edges), [1]]))
+    expected, actual = np.maximum(expected, eps), np.maximum(actual, eps)
+    return float(np.sum((actual - expected)*np.log(actual/expected)))
+
+
+def drift_ks(percentiles, sketch):
+    '''largest gap between the distribution of the values in a sketch and the baseline (Kolmogorov-Smirnov statistic)'''
+    points = np.unique(np.concatenate(
+        [percentiles, sketch.quantile(np.linspace(0, 1, 101))]))
+    return float(np.max(np.abs(sketch.cdf(points) - baseline_cdf(percentiles, points))))
+
+
+class DriftMonitor:
+    '''
+    Sketches of the features and scores of the users scored by this worker, per model, model version, feature,
+    and time window of DRIFT_WINDOW seconds (default 86400). Only the last DRIFT_WINDOWS windows (default 7) are kept,
+    so memory stays constant whatever the traffic
+    '''
+
+    def __init__(self):
+        self.windows = dict()
+        self._lock = threading.Lock()
+
+    def record(self, model, version, values, now=None):
+        length = int(getenv('DRIFT_WINDOW', 86400))
+        start = int((time.time() if now is None else now)//length*length)
+        with self._lock:
+            if start not in self.windows:
+                self.windows[start] = dict()
+                for w in sorted(self.windows)[:-int(getenv('DRIFT_WINDOWS', 7))]:
+                    del self.windows[w]
+            # values of a window older than those kept are dropped
+            sketches = self.windows.get(start, dict())
+            for feature, v in values.items():
+                key = '/'.join([model, version, feature])
+                if key not in sketches:
+                    sketches[key] = KLL(int(getenv('DRIFT_SKETCH_K', 200)))
+                sketches[key].update(v)
+
+    def report(self, baseline, quantiles=(0.05, 0.25, 0.5, 0.75, 0.95)):
+        '''
+        Description:
+            count, quantiles, and drift against the baseline (psi and ks) of each feature, per time window, newest first
+
+        Parameters:
+            baseline (dict): 101 percentiles of each feature, under model/model_version/feature keys
+            quantiles (tuple): quantiles to report
+
+        Returns:
+            windows (list): one dict per window, with its start time and the statistics of each feature
+        '''
+        with self._lock:
+            windows = list()
+            for start in sorted(self.windows, reverse=True):
+                features = dict()
+                for key, sketch in sorted(self.windows[start].items()):
+                    stats = {'count': sketch.count,
+                             'quantiles': {str(q): float(v) for q, v in zip(quantiles, sketch.quantile(quantiles))}}
+                    if key in baseline:
+                        percentiles = np.asarray(baseline[key], dtype=float)
+                        stats['psi'] = round(drift_psi(percentiles, sketch), 4)
+                        stats['ks'] = round(drift_ks(percentiles, sketch), 4)
+                    features[key] = stats
+                windows.append({'start': datetime.fromtimestamp(start, timezone.utc).isoformat(),
+                                'features': features})
+            return windows
+
+
+drift_monitor = DriftMonitor()
+_baseline = {'path': None, 'mtime': None, 'baseline': dict()}
+_errors = {'count': 0}
+
+
+def drift_baseline():
+    '''the baseline at DRIFT_BASELINE (default drift_baseline.json), reloaded when the file changes. Empty if there is none'''
+    path = getenv('DRIFT_BASELINE', 'drift_baseline.json')
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        mtime = None
+    if (path, mtime) != (_baseline['path'], _baseline['mtime']):
+        try:
+            with open(path) as f:
+                baseline = json.load(f)
+        except (OSError, ValueError):
+            baseline = dict()
+        _baseline.update(path=path, mtime=mtime, baseline=baseline)
+    return _baseline['baseline']
+
+
+def drift_record(model, score, feedback):
+    '''
+    Description:
+        feed the watched features and the score of a scored user to the drift sketches of this worker. Never raises
+
+    Parameters:
+        model (str): 'plaid' or 'coinbase'
+        score (float): live score
+        feedback (dict): score feedback, before it is interpreted
+    '''
+    try:
+        drift_monitor.record(model, model_version,
+                             feature_values(model, score, feedback))
+    except Exception:
+        _errors['count'] += 1
+
+
+def drift_report():
+    '''drift statistics of this worker against the baseline, see DriftMonitor.report()'''
+    baseline = drift_baseline()
+    return {'baseline': _baseline['path'] if baseline else None,
+            'errors': _errors['count'],
+            'windows': drift_monitor.report(baseline)}
+
+
+# -------------------------------------------------------------------------- #
+#                                  Baseline                                  #
+# -------------------------------------------------------------------------- #
+
+def history_features(path, as_of):
+    '''the watched features and the score of one stored user history as of a date, or None if it cannot be scored'''
+    try:
+        model, data, days = load_history(path)
+        n, history = slice_history(model, data, days, as_of)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            if model == 'plaid':
+                score, feedback = plaid_score(
+                    history, create_feedback_plaid(), as_of=as_of)
+            else:
+                score, feedback = coinbase_score(
+                    history['accounts'], history['transactions'], create_feedback_coinbase(), as_of=as_of)
+        return model, feature_values(model, score, feedback)
+    except Exception:
+        return None
+
+
+def _history_features(args):
+    return history_features(*args)
+
+
+def build_baseline(files, as_of, workers=None, chunksize=16):
+    '''
+    Description:
+        the baseline of a corpus of stored user histories: the percentiles 0, 1, ..., 100 of each watched feature
+
+    Parameters:
+        files (list): paths to the stored user histories
+        as_of (date): scoring date
+        workers (int): number of processes. Defaults to the number of CPUs. 1 runs in this process
+        chunksize (int): number of users sent to a process at once
+
+    Returns:
+        baseline (dict): percentiles of each feature, under model/model_version/feature keys
+    '''
+    values = dict()
+    tasks = [(f, as_of) for f in files]
+    with ProcessPoolExecutor(max_workers=workers) if workers != 1 else nullcontext() as executor:
+        results = executor.map(_history_features, tasks, chunksize=chunksize) if executor else map(
+            _history_features, tasks)
+        for r in results:
+            if r:
+                for feature, v in r[1].items():
+                    values.setdefault(
+                        '/'.join([r[0], model_version, feature]), []).append(v)
+
+    return {k: np.percentile(v, np.arange(101)).tolist() for k, v in sorted(values.items())}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Build the drift baseline of the credit score models from a corpus of stored user histories')
+    parser.add_argument(
+        'corpus', help='directory of stored user histories (.json), or a single history')
+    parser.add_argument('--as-of', default=None,
+                        help='scoring date, YYYY-MM-DD (default: today, UTC)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of processes (default: number of CPUs)')
+    parser.add_argument('--out', default='drift_baseline.json',
+                        help='output json file (default: drift_baseline.json)')
+    args = parser.parse_args(argv)
+
+    as_of = datetime.strptime(args.as_of, '%Y-%m-%d').date(
+    ) if args.as_of else datetime.now(timezone.utc).date()
+    files = corpus_files(args.corpus)
+
+    t0 = time.time()
+    baseline = build_baseline(files, as_of, args.workers)
+    with open(args.out, 'w') as f:
+        json.dump(baseline, f, indent=4)
+    print('{} users: {} features written to {} in {:.1f} sec'.format(
+        len(files), len(baseline), args.out, time.time() - t0))
+
+
+if __name__ == '__main__':
+    main()
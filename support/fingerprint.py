@@ -0,0 +1,58 @@
+import hashlib
+import json
+
+
+# -------------------------------------------------------------------------- #
+#                               Helper Functions                             #
+# -------------------------------------------------------------------------- #
+
+def digest(rows):
+    '''returns a stable sha256 hex digest of a list of json-serializable rows, regardless of their order'''
+    h = hashlib.sha256()
+    for row in sorted([json.dumps(r, default=str) for r in rows]):
+        h.update(row.encode())
+        h.update(b'\n')
+    return h.hexdigest()
+
+
+# -------------------------------------------------------------------------- #
+#                                 Fingerprints                               #
+# -------------------------------------------------------------------------- #
+
+def plaid_fingerprint(data):
+    '''
+    Description:
+        A content hash of the Plaid data the model reads. Two datasets with the same fingerprint get the same score,
+        even if they were fetched with different access tokens (e.g. after the user re-linked their bank)
+
+    Parameters:
+        data (dict): Plaid 'Transactions' product
+
+    Returns:
+        fingerprint (str): sha256 hex digest over accounts (ids, types, names, balances) and transactions (ids, accounts, dates, amounts, categories)
+    '''
+    accounts = [['acc', a['account_id'], str(a['type']), str(a['subtype']), a.get('name'), a.get('official_name'),
+                 a['balances'].get('current'), a['balances'].get('available'), a['balances'].get('limit')]
+                for a in data['accounts']]
+    transactions = [['txn', t.get('transaction_id'), t['account_id'], t['date'], t['amount'], t['category']]
+                    for t in data['transactions']]
+    return digest(accounts + transactions)
+
+
+def coinbase_fingerprint(acc, txn):
+    '''
+    Description:
+        A content hash of the Coinbase data the model reads. Two datasets with the same fingerprint get the same score
+
+    Parameters:
+        acc (list): non-zero balance Coinbase accounts owned by the user in currencies of trusted reputation
+        txn (list): transactions history of above-listed accounts
+
+    Returns:
+        fingerprint (str): sha256 hex digest over accounts (ids, creation dates, balances) and transactions (ids, types, dates, amounts)
+    '''
+    accounts = [['acc', a['id'], a['currency'], a['created_at'], a['native_balance']['amount'], a['balance']['amount']]
+                for a in acc]
+    transactions = [['txn', t['id'], t['type'], t['created_at'], t['native_amount']['amount'], t['amount']['amount']]
+                    for t in txn]
+    return digest(accounts + transactions)
@@ -3,8 +3,7 @@ import pandas as pd
 import numpy as np
 
 from optimization.performance import *
-
-now = datetime.now().date()
+from support.dates import scoring_date
 
 # -------------------------------------------------------------------------- #
 #                               Helper Functions                             #
@@ -86,7 +85,7 @@ def nested_dict(d, keys, value):
     d[keys[-1]] = value
 
 
-def net_flow(txn, timeframe, feedback):
+def net_flow(txn, timeframe, feedback, as_of=None):
     '''
     Description:
         Returns monthly net flow (income - expenses)
@@ -95,6 +94,7 @@ def net_flow(txn, timeframe, feedback):
         txn (list): transactions history of above-listed accounts
         timeframe (str): length in months of transaction history
         feedback (dict): score feedback
+        as_of (date): scoring date. Defaults to today
 
     Returns:
         flow (dataframe): net monthly flow by datetime
@@ -121,7 +121,7 @@ def net_flow(txn, timeframe, feedback):
             df = df.groupby(pd.Grouper(freq='M')).sum()
 
             # exclude current month
-            if df.iloc[-1, ].name.strftime('%Y-%m') == now.strftime('%Y-%m'):
+            if df.iloc[-1, ].name.strftime('%Y-%m') == scoring_date(as_of).strftime('%Y-%m'):
                 df = df[:-1]
 
             # keep only past X-many months. If longer, then crop
@@ -180,7 +180,7 @@ def kyc(acc, txn, feedback):
 # @measure_time_and_memory
 
 
-def history_acc_longevity(acc, feedback):
+def history_acc_longevity(acc, feedback, as_of=None):
     '''
     Description:
         A score based on the longevity of user's best Coinbase accounts
@@ -188,6 +188,7 @@ def history_acc_longevity(acc, feedback):
     Parameters:
         acc (list): non-zero balance Coinbase accounts owned by the user in currencies of trusted reputation
         feedback (dict): score feedback
+        as_of (date): scoring date. Defaults to today
 
     Returns:
         score (float): score gained based on account longevity
@@ -199,7 +200,7 @@ def history_acc_longevity(acc, feedback):
         if acc:
             oldest = min([d['created_at'] for d in acc if d['created_at']])
             # age (in days) of longest standing Coinbase account
-            history_acc_longevity.age = (now - oldest).days
+            history_acc_longevity.age = (scoring_date(as_of) - oldest).days
             score = fico_medians[np.digitize(
                 history_acc_longevity.age, duration, right=True)]
 
@@ -262,7 +263,7 @@ def liquidity_tot_balance_now(acc, feedback):
 
 
 # @measure_time_and_memory
-def liquidity_loan_duedate(txn, feedback):
+def liquidity_loan_duedate(txn, feedback, as_of=None):
     '''
     Description:
         returns how many months it'll take the user to pay back their loan
@@ -270,6 +271,7 @@ def liquidity_loan_duedate(txn, feedback):
     Parameters:
         txn (list): transactions history of above-listed accounts
         feedback (dict): score feedback
+        as_of (date): scoring date. Defaults to today
 
     Returns:
         feedback (dict): score feedback with a new key-value pair 'loan_duedate':float (# of months in range [3,6])
@@ -279,7 +281,7 @@ def liquidity_loan_duedate(txn, feedback):
         # Read in the date of the oldest txn
         first_txn = datetime.strptime(
             txn[-1]['created_at'], '%Y-%m-%dT%H:%M:%SZ').date()
-        txn_length = int((now - first_txn).days/30)  # months
+        txn_length = int((scoring_date(as_of) - first_txn).days/30)  # months
 
         # Loan duedate is equal to the month of txn history there are
         due = np.digitize(txn_length, duedate, right=True)
@@ -295,7 +297,7 @@ def liquidity_loan_duedate(txn, feedback):
 
 
 # @measure_time_and_memory
-def liquidity_avg_running_balance(acc, txn, feedback):
+def liquidity_avg_running_balance(acc, txn, feedback, as_of=None):
     '''
     Description:
         A score based on the average running balance maintained for the past 12 months
@@ -304,6 +306,7 @@ def liquidity_avg_running_balance(acc, txn, feedback):
         acc (list): non-zero balance Coinbase accounts owned by the user in currencies of trusted reputation
         txn (list): transactions history of above-listed accounts
         feedback (dict): score feedback
+        as_of (date): scoring date. Defaults to today
 
     Returns:
         score (float): score gained for mimimum running balance
@@ -315,7 +318,7 @@ def liquidity_avg_running_balance(acc, txn, feedback):
             balance = sum([float(d['native_balance']['amount']) for d in acc])
 
             # Calculate net flow (i.e, |income-expenses|) each month for past 12 months
-            net, feedback = net_flow(txn, 12, feedback)
+            net, feedback = net_flow(txn, 12, feedback, as_of)
 
             # Iteratively subtract net flow from balance now to calculate the running balance for the past 12 months
             net = net['amount'].tolist()[::-1]
@@ -4,8 +4,7 @@ import pandas as pd
 import numpy as np
 
 from optimization.performance import *
-
-now = datetime.now().date()
+from support.dates import scoring_date
 
 # -------------------------------------------------------------------------- #
 #                               Helper Functions                             #
@@ -82,7 +81,7 @@ slope_linregression = np.array([-0.5, 0, 0.5, 1, 1.5, 2])
 #                               Helper Functions                             #
 # -------------------------------------------------------------------------- #
 
-def dynamic_select(data, acc_name, feedback):
+def dynamic_select(data, acc_name, feedback, as_of=None):
     '''
     dynamically pick the best credit account,
     i.e. the account that performs best in 2 out of these 3 categories:
@@ -92,6 +91,7 @@ def dynamic_select(data, acc_name, feedback):
                 data (dict): Plaid 'Transactions' product 
                 acc_name (str): acccepts 'credit' or 'checking'
                 feedback (dict): feedback describing the score
+                as_of (date): scoring date. Defaults to today
 
             Returns: 
                 best (str or dict): Plaid account_id of best credit account 
@@ -111,7 +111,7 @@ def dynamic_select(data, acc_name, feedback):
                 transat = [t for t in txn if t['account_id'] == id]
                 txn_count = len(transat)
                 if len(transat) != 0:
-                    length = (now - transat[-1]['date']).days
+                    length = (scoring_date(as_of) - transat[-1]['date']).days
                 else:
                     length = 0
                 info.append([id, type, limit, txn_count, length])
@@ -138,7 +138,7 @@ def dynamic_select(data, acc_name, feedback):
         return best
 
 
-def flows(data, how_many_months, feedback):
+def flows(data, how_many_months, feedback, as_of=None):
     '''
     returns monthly net flow
 
@@ -146,6 +146,7 @@ def flows(data, how_many_months, feedback):
                 data (dict): Plaid 'Transactions' product 
                 how_many_month (float): how many months of transaction history are you considering? 
                 feedback (dict): feedback describing the score
+                as_of (date): scoring date. Defaults to today
 
             Returns: 
                 flow (df): pandas dataframe with amounts for net monthly flow and datetime index
@@ -189,7 +190,7 @@ def flows(data, how_many_months, feedback):
         flow = df.groupby(pd.Grouper(freq='M')).sum()
 
         # Exclude current month
-        if flow.iloc[-1, ].name.strftime('%Y-%m') == datetime.today().date().strftime('%Y-%m'):
+        if flow.iloc[-1, ].name.strftime('%Y-%m') == scoring_date(as_of).strftime('%Y-%m'):
             flow = flow[:-1]
 
         # Keep only past X months. If longer, then crop
@@ -234,7 +235,7 @@ def balance_now_checking_only(data, feedback):
 #                               Metric #1 Credit                             #
 # -------------------------------------------------------------------------- #
 # @measure_time_and_memory
-def credit_mix(data, feedback):
+def credit_mix(data, feedback, as_of=None):
     '''
     Description:
         A score based on user's credit accounts composition and status
@@ -242,6 +243,7 @@ def credit_mix(data, feedback):
     Parameters:
         data (dict): Plaid 'Transactions' product
         feedback (dict): score feedback
+        as_of (date): scoring date. Defaults to today
 
     Returns: 
         score (float): gained based on number of credit accounts owned and duration
@@ -262,7 +264,7 @@ def credit_mix(data, feedback):
                           if d['account_id'] in credit_ids]
 
             first_txn = credit_txn[-1]['date']
-            date_diff = (now - first_txn).days
+            date_diff = (scoring_date(as_of) - first_txn).days
 
             m = np.digitize(size, count0, right=True)
             n = np.digitize(date_diff, duration, right=True)
@@ -284,7 +286,7 @@ def credit_mix(data, feedback):
 # @measure_time_and_memory
 
 
-def credit_limit(data, feedback):
+def credit_limit(data, feedback, as_of=None):
     '''
     Description:
         A score for the cumulative credit limit of a user across ALL of his credit accounts
@@ -292,6 +294,7 @@ def credit_limit(data, feedback):
     Parameters:
         data (dict): Plaid 'Transactions' product
         feedback (dict): score feedback
+        as_of (date): scoring date. Defaults to today
 
     Returns: 
         score (float): gained based on the cumulative credit limit across all credit accounts
@@ -310,13 +313,14 @@ def credit_limit(data, feedback):
                           if d['account_id'] in credit_ids]
 
             first_txn = credit_txn[-1]['date']
-            date_diff = (now - first_txn).days
+            date_diff = (scoring_date(as_of) - first_txn).days
 
             m = np.digitize(date_diff, duration, right=True)
             n = np.digitize(credit_lim, volume_cred_limit, right=True)
             score = m7x7_03_17[m][n]
 
             feedback['credit']['credit_limit'] = credit_lim
+            feedback['credit']['credit_limit_duration_(days)'] = date_diff
         else:
             raise Exception('no credit limit')
 
@@ -330,7 +334,7 @@ def credit_limit(data, feedback):
 # @measure_time_and_memory
 
 
-def credit_util_ratio(data, feedback):
+def credit_util_ratio(data, feedback, as_of=None):
     '''
     Description:
         A score reflective of the user's credit utilization ratio, that is credit_used/credit_limit
@@ -338,6 +342,7 @@ def credit_util_ratio(data, feedback):
     Parameters:
         data (dict): Plaid 'Transactions' product
         feedback (dict): score feedback
+        as_of (date): scoring date. Defaults to today
 
     Returns:
         score (float): score for avg percent of credit limit used
@@ -348,7 +353,7 @@ def credit_util_ratio(data, feedback):
         txn = data['transactions']
 
         # Dynamically select best credit account
-        dynamic = dynamic_select(data, 'credit', feedback)
+        dynamic = dynamic_select(data, 'credit', feedback, as_of)
 
         if dynamic['id'] == 'inexistent' or dynamic['limit'] == 0:
             score = 0
@@ -379,7 +384,7 @@ def credit_util_ratio(data, feedback):
                 util['cred_util'] = [x/limit for x in util['purchases']]
 
                 # Exclude current month
-                if util.iloc[-1, ].name.strftime('%Y-%m') == datetime.today().date().strftime('%Y-%m'):
+                if util.iloc[-1, ].name.strftime('%Y-%m') == scoring_date(as_of).strftime('%Y-%m'):
                     util = util[:-1]
 
                 avg_util = np.mean(util['cred_util'])
@@ -388,6 +393,7 @@ def credit_util_ratio(data, feedback):
                 score = m7x7_85_55[m][n]
 
                 feedback['credit']['utilization_ratio'] = round(avg_util, 2)
+                feedback['credit']['utilization_months'] = len(util)
 
             else:
                 raise Exception('no credit history')
@@ -400,20 +406,21 @@ def credit_util_ratio(data, feedback):
         return score, feedback
 
 
-def credit_interest(data, feedback):
+def credit_interest(data, feedback, as_of=None):
     '''
     returns score based on number of times user was charged credit card interest fees in past 24 months
 
             Parameters:
                 data (dict): Plaid 'Transactions' product 
                 feedback (dict): feedback describing the score
+                as_of (date): scoring date. Defaults to today
 
             Returns: 
                 score (float): gained based on interest charged
                 feedback (dict): feedback describing the score
     '''
     try:
-        id = dynamic_select(data, 'credit', feedback)['id']
+        id = dynamic_select(data, 'credit', feedback, as_of)['id']
 
         if id == 'inexistent':
             score = 0
@@ -425,7 +432,8 @@ def credit_interest(data, feedback):
             interests = list()
 
             if alltxn:
-                length = min(24, round((now - alltxn[-1]['date']).days/30, 0))
+                as_of = scoring_date(as_of)
+                length = min(24, round((as_of - alltxn[-1]['date']).days/30, 0))
                 for t in alltxn:
 
                     # keep only txn of type 'interest on credit card'
@@ -433,7 +441,7 @@ def credit_interest(data, feedback):
                         date = t['date']
 
                         # keep only txn of last 24 months
-                        if date > now - timedelta(days=2*365):
+                        if date > as_of - timedelta(days=2*365):
                             interests.append(t)
 
                 frequency = len(interests)/length
@@ -454,27 +462,28 @@ def credit_interest(data, feedback):
         return score, feedback
 
 
-def credit_length(data, feedback):
+def credit_length(data, feedback, as_of=None):
     '''
     returns score based on length of user's best credit account
 
             Parameters:
                 data (dict): Plaid 'Transactions' product 
                 feedback (dict): feedback describing the score
+                as_of (date): scoring date. Defaults to today
 
             Returns: 
                 score (float): gained because of credit account duration
                 feedback (dict): feedback describing the score
     '''
     try:
-        id = dynamic_select(data, 'credit', feedback)['id']
+        id = dynamic_select(data, 'credit', feedback, as_of)['id']
         txn = data['transactions']
         alltxn = [t for t in txn if t['account_id'] == id]
 
         if alltxn:
             oldest_txn = alltxn[-1]['date']
             # date today - date of oldest credit transaction
-            how_long = (now - oldest_txn).days
+            how_long = (scoring_date(as_of) - oldest_txn).days
             score = fico_medians[np.digitize(how_long, duration, right=True)]
 
             feedback['credit']['credit_duration_(days)'] = how_long
@@ -490,20 +499,21 @@ def credit_length(data, feedback):
         return score, feedback
 
 
-def credit_livelihood(data, feedback):
+def credit_livelihood(data, feedback, as_of=None):
     '''
     returns score quantifying the avg monthly txn count for your best credit account
 
             Parameters:
                 data (dict): Plaid 'Transactions' product 
                 feedback (dict): feedback describing the score
+                as_of (date): scoring date. Defaults to today
 
             Returns: 
                 score (float): based on avg monthly txn count
                 feedback (dict): feedback describing the score
     '''
     try:
-        id = dynamic_select(data, 'credit', feedback)['id']
+        id = dynamic_select(data, 'credit', feedback, as_of)['id']
         txn = data['transactions']
         alltxn = [t for t in txn if t['account_id'] == id]
 
@@ -656,20 +666,21 @@ def velocity_deposits(data, feedback):
         return score, feedback
 
 
-def velocity_month_net_flow(data, feedback):
+def velocity_month_net_flow(data, feedback, as_of=None):
     '''
     returns score for monthly net flow
 
             Parameters:
                 data (dict): Plaid 'Transactions' product 
                 feedback (dict): feedback describing the score
+                as_of (date): scoring date. Defaults to today
 
             Returns: 
                 score (float): score associated with monthly new flow
                 feedback (dict): feedback describing the score
     '''
     try:
-        flow = flows(data, 12, feedback)
+        flow = flows(data, 12, feedback, as_of)
 
         # Calculate magnitude of flow (how much is flowing monthly?)
         cum_flow = [abs(x) for x in flow['amounts'].tolist()]
@@ -768,20 +779,21 @@ def velocity_month_txn_count(data, feedback):
         return score, feedback
 
 
-def velocity_slope(data, feedback):
+def velocity_slope(data, feedback, as_of=None):
     '''
     returns score for the historical behavior of the net monthly flow for past 24 months
 
             Parameters:
                 data (dict): Plaid 'Transactions' product 
                 feedback (dict): feedback describing the score
+                as_of (date): scoring date. Defaults to today
 
             Returns:
                 score (float): score for flow net behavior over past 24 months
                 feedback (dict): feedback describing the score
     '''
     try:
-        flow = flows(data, 24, feedback)
+        flow = flows(data, 24, feedback, as_of)
 
         # If you have > 10 data points OR all net flows are positive, then perform linear regression
         if len(flow) >= 10 or len(list(filter(lambda x: (x < 0), flow['amounts'].tolist()))) == 0:
@@ -866,7 +878,7 @@ def stability_tot_balance_now(data, feedback):
 
 
 # @measure_time_and_memory
-def stability_loan_duedate(data, feedback):
+def stability_loan_duedate(data, feedback, as_of=None):
     '''
     Description:
         returns how many months it'll take the user to pay back their loan
@@ -874,6 +886,7 @@ def stability_loan_duedate(data, feedback):
     Parameters:
         data (dict): Plaid 'Transactions' product
         feedback (dict): score feedback
+        as_of (date): scoring date. Defaults to today
 
     Returns:
         feedback (dict): score feedback with a new key-value pair 'loan_duedate':float (# of months in range [3,6])
@@ -882,7 +895,7 @@ def stability_loan_duedate(data, feedback):
     try:
         # Read in the date of the oldest txn
         first_txn = data['transactions'][-1]['date']
-        txn_length = int((now - first_txn).days/30)  # months
+        txn_length = int((scoring_date(as_of) - first_txn).days/30)  # months
 
         # Loan duedate is equal to the month of txn history there are
         due = np.digitize(txn_length, duedate, right=True)
@@ -898,7 +911,7 @@ def stability_loan_duedate(data, feedback):
 
 
 # @measure_time_and_memory
-def stability_min_running_balance(data, feedback):
+def stability_min_running_balance(data, feedback, as_of=None):
     '''
     Description:
         A score based on the average minimum balance maintained for 12 months
@@ -906,6 +919,7 @@ def stability_min_running_balance(data, feedback):
     Parameters:
         data (dict): Plaid 'Transactions' product
         feedback (dict): score feedback
+        as_of (date): scoring date. Defaults to today
 
     Returns:
         score (float): volume of minimum balance and duration
@@ -914,7 +928,7 @@ def stability_min_running_balance(data, feedback):
 
     try:
         # Calculate net flow each month for past 12 months i.e, |income-expenses|
-        nets = flows(data, 12, feedback)['amounts'].tolist()
+        nets = flows(data, 12, feedback, as_of)['amounts'].tolist()
 
         # Calculate total current balance now
         balance = balance_now_checking_only(data, feedback)
@@ -951,7 +965,7 @@ def stability_min_running_balance(data, feedback):
 #                            Metric #4 Diversity                             #
 # -------------------------------------------------------------------------- #
 # @measure_time_and_memory
-def diversity_acc_count(data, feedback):
+def diversity_acc_count(data, feedback, as_of=None):
     '''
     Description:
         A score based on count of accounts owned by the user and account duration
@@ -959,6 +973,7 @@ def diversity_acc_count(data, feedback):
     Parameters:
         data (dict): Plaid 'Transactions' product
         feedback (dict): score feedback
+        as_of (date): scoring date. Defaults to today
 
     Returns:
         score (float): score for accounts count
@@ -969,7 +984,7 @@ def diversity_acc_count(data, feedback):
         size = len(data['accounts'])
 
         first_txn = data['transactions'][-1]['date']
-        date_diff = (now - first_txn).days
+        date_diff = (scoring_date(as_of) - first_txn).days
 
         m = np.digitize(size, [i+2 for i in count0], right=False)
         n = np.digitize(date_diff, duration, right=True)
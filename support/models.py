@@ -6,91 +6,144 @@ from support.metrics_coinbase import *
 # -------------------------------------------------------------------------- #
 
 
-def plaid_credit(txn, feedback):
+# weights of the metrics of each pillar, in the order they are computed
+plaid_weights = {
+    'credit': {'limit': 0.45, 'util_ratio': 0.12, 'interest': 0.05, 'length': 0.26, 'livelihood': 0.12},
+    'velocity': {'withdrawals': 0.16, 'deposits': 0.25, 'net_flow': 0.25, 'txn_count': 0.16, 'slope': 0.18},
+    'stability': {'balance': 0.70, 'run_balance': 0.30},
+    'diversity': {'acc_count': 0.40, 'profile': 0.60}
+}
 
-    limit, feedback = credit_limit(txn, feedback)
-    util_ratio, feedback = credit_util_ratio(txn, feedback)
-    interest, feedback = credit_interest(txn, feedback)
-    length, feedback = credit_length(txn, feedback)
-    livelihood, feedback = credit_livelihood(txn, feedback)
 
-    score = 0.45*limit \
-        + 0.12*util_ratio \
-        + 0.05*interest \
-        + 0.26*length \
-        + 0.12*livelihood
+def weigh(metrics, weights):
+    '''returns the weighted sum of the metric scores of a pillar'''
+    score = 0
+    for k, w in weights.items():
+        score += w*metrics[k]
+    return score
 
-    return score, feedback
 
+def plaid_credit_metrics(txn, feedback, as_of=None):
 
-def plaid_velocity(txn, feedback):
+    limit, feedback = credit_limit(txn, feedback, as_of)
+    util_ratio, feedback = credit_util_ratio(txn, feedback, as_of)
+    interest, feedback = credit_interest(txn, feedback, as_of)
+    length, feedback = credit_length(txn, feedback, as_of)
+    livelihood, feedback = credit_livelihood(txn, feedback, as_of)
+
+    metrics = {'limit': limit, 'util_ratio': util_ratio,
+               'interest': interest, 'length': length, 'livelihood': livelihood}
+
+    return metrics, feedback
+
+
+def plaid_velocity_metrics(txn, feedback, as_of=None):
 
     withdrawals, feedback = velocity_withdrawals(txn, feedback)
     deposits, feedback = velocity_deposits(txn, feedback)
-    net_flow, feedback = velocity_month_net_flow(txn, feedback)
+    net_flow, feedback = velocity_month_net_flow(txn, feedback, as_of)
     txn_count, feedback = velocity_month_txn_count(txn, feedback)
-    slope, feedback = velocity_slope(txn, feedback)
+    slope, feedback = velocity_slope(txn, feedback, as_of)
 
-    score = 0.16*withdrawals \
-        + 0.25*deposits \
-        + 0.25*net_flow \
-        + 0.16*txn_count \
-        + 0.18*slope
+    metrics = {'withdrawals': withdrawals, 'deposits': deposits,
+               'net_flow': net_flow, 'txn_count': txn_count, 'slope': slope}
 
-    return score, feedback
+    return metrics, feedback
 
 
-def plaid_stability(txn, feedback):
+def plaid_stability_metrics(txn, feedback, as_of=None):
 
     balance, feedback = stability_tot_balance_now(txn, feedback)
-    feedback = stability_loan_duedate(txn, feedback)
-    run_balance, feedback = stability_min_running_balance(txn, feedback)
+    feedback = stability_loan_duedate(txn, feedback, as_of)
+    run_balance, feedback = stability_min_running_balance(
+        txn, feedback, as_of)
 
-    score = 0.70*balance + 0.30*run_balance
+    metrics = {'balance': balance, 'run_balance': run_balance}
 
-    return score, feedback
+    return metrics, feedback
 
 
-def plaid_diversity(txn, feedback):
+def plaid_diversity_metrics(txn, feedback, as_of=None):
 
-    acc_count, feedback = diversity_acc_count(txn, feedback)
+    acc_count, feedback = diversity_acc_count(txn, feedback, as_of)
     profile, feedback = diversity_profile(txn, feedback)
 
-    score = 0.40*acc_count + 0.60*profile
+    metrics = {'acc_count': acc_count, 'profile': profile}
+
+    return metrics, feedback
+
+
+def plaid_credit(txn, feedback, as_of=None):
+
+    metrics, feedback = plaid_credit_metrics(txn, feedback, as_of)
+
+    return weigh(metrics, plaid_weights['credit']), feedback
+
+
+def plaid_velocity(txn, feedback, as_of=None):
+
+    metrics, feedback = plaid_velocity_metrics(txn, feedback, as_of)
+
+    return weigh(metrics, plaid_weights['velocity']), feedback
+
+
+def plaid_stability(txn, feedback, as_of=None):
+
+    metrics, feedback = plaid_stability_metrics(txn, feedback, as_of)
+
+    return weigh(metrics, plaid_weights['stability']), feedback
+
+
+def plaid_diversity(txn, feedback, as_of=None):
+
+    metrics, feedback = plaid_diversity_metrics(txn, feedback, as_of)
+
+    return weigh(metrics, plaid_weights['diversity']), feedback
+
 
-    return score, feedback
+plaid_pillar_metrics = {'credit': plaid_credit_metrics, 'velocity': plaid_velocity_metrics,
+                        'stability': plaid_stability_metrics, 'diversity': plaid_diversity_metrics}
 
 # -------------------------------------------------------------------------- #
 #                               Coinbase Model                               #
 # -------------------------------------------------------------------------- #
 
 
-def coinbase_kyc(acc, txn, feedback):
+coinbase_weights = {
+    'kyc': {'kyc': 1},
+    'history': {'longevity': 1},
+    'liquidity': {'balance': 0.60, 'run_balance': 0.40},
+    'activity': {'credit_volume': 0.2, 'debit_volume': 0.2, 'credit_consistency': 0.2, 'debit_consistency': 0.2, 'inception': 0.2}
+}
+
+
+def coinbase_kyc_metrics(acc, txn, feedback):
 
     score, feedback = kyc(acc, txn, feedback)
 
-    return score, feedback
+    return {'kyc': score}, feedback
 
 
-def coinbase_history(acc, feedback):
+def coinbase_history_metrics(acc, feedback, as_of=None):
 
-    score, feedback = history_acc_longevity(acc, feedback)
+    score, feedback = history_acc_longevity(acc, feedback, as_of)
 
-    return score, feedback
+    return {'longevity': score}, feedback
 
 
-def coinbase_liquidity(acc, txn, feedback):
+def coinbase_liquidity_metrics(acc, txn, feedback, as_of=None):
 
     balance, feedback = liquidity_tot_balance_now(acc, feedback)
-    feedback = liquidity_loan_duedate(txn, feedback)
-    run_balance, feedback = liquidity_avg_running_balance(acc, txn, feedback)
+    feedback = liquidity_loan_duedate(txn, feedback, as_of)
+    run_balance, feedback = liquidity_avg_running_balance(
+        acc, txn, feedback, as_of)
 
-    score = 0.60*balance + 0.40*run_balance
+    metrics = {'balance': balance, 'run_balance': run_balance}
 
-    return score, feedback
+    return metrics, feedback
 
 
-def coinbase_activity(acc, txn, feedback):
+def coinbase_activity_metrics(acc, txn, feedback):
 
     credit_volume, feedback = activity_tot_volume_tot_count(
         txn, 'credit', feedback)
@@ -101,10 +154,35 @@ def coinbase_activity(acc, txn, feedback):
     debit_consistency, feedback = activity_consistency(txn, 'debit', feedback)
     inception, feedback = activity_profit_since_inception(acc, txn, feedback)
 
-    score = 0.2*credit_volume \
-        + 0.2 * debit_volume \
-        + 0.2*credit_consistency \
-        + 0.2*debit_consistency \
-        + 0.2*inception
+    metrics = {'credit_volume': credit_volume, 'debit_volume': debit_volume, 'credit_consistency': credit_consistency,
+               'debit_consistency': debit_consistency, 'inception': inception}
+
+    return metrics, feedback
+
+
+def coinbase_kyc(acc, txn, feedback):
+
+    metrics, feedback = coinbase_kyc_metrics(acc, txn, feedback)
+
+    return weigh(metrics, coinbase_weights['kyc']), feedback
+
+
+def coinbase_history(acc, feedback, as_of=None):
+
+    metrics, feedback = coinbase_history_metrics(acc, feedback, as_of)
+
+    return weigh(metrics, coinbase_weights['history']), feedback
+
+
+def coinbase_liquidity(acc, txn, feedback, as_of=None):
+
+    metrics, feedback = coinbase_liquidity_metrics(acc, txn, feedback, as_of)
+
+    return weigh(metrics, coinbase_weights['liquidity']), feedback
+
+
+def coinbase_activity(acc, txn, feedback):
+
+    metrics, feedback = coinbase_activity_metrics(acc, txn, feedback)
 
-    return score, feedback
+    return weigh(metrics, coinbase_weights['activity']), feedback
@@ -0,0 +1,242 @@
+from support.score import *
+from os import getenv
+
+import threading
+import atexit
+import fcntl
+import json
+import time
+import os
+
+
+# -------------------------------------------------------------------------- #
+#                                Score Index                                 #
+# -------------------------------------------------------------------------- #
+# Every issued score and pillar score is counted in a fixed-bin histogram per model, model version, and pillar.
+# Scores fall in 1-point bins over [300, 900], pillar scores in 0.001-wide bins over [0, 1].
+# Counts are held in Fenwick trees, so that adding a score and ranking one both take O(log bins) steps.
+
+bins = {'score': (300, 900, 1), 'pillar': (0, 1, 0.001)}
+
+
+class Fenwick:
+    '''
+    Binary indexed tree over the counts of a histogram: point updates and prefix sums in O(log n)
+    '''
+
+    def __init__(self, counts):
+        self.counts = list(counts)
+        self.tree = [0]*(len(self.counts) + 1)
+        for i, c in enumerate(self.counts):
+            j = i + 1
+            self.tree[j] += c
+            k = j + (j & -j)
+            if k < len(self.tree):
+                self.tree[k] += self.tree[j]
+
+    def add(self, i, n=1):
+        self.counts[i] += n
+        i += 1
+        while i < len(self.tree):
+            self.tree[i] += n
+            i += i & -i
+
+    def prefix(self, i):
+        '''sum of the counts of bins [0, i)'''
+        total = 0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def total(self):
+        return self.prefix(len(self.counts))
+
+
+def index_key(model, version, pillar):
+    return '/'.join([model, version, pillar])
+
+
+def index_size(pillar):
+    '''number of bins of the histogram of a score ('score') or a pillar score (any other pillar)'''
+    lo, hi, width = bins['score' if pillar == 'score' else 'pillar']
+    return int(round((hi - lo)/width)) + 1
+
+
+def index_bin(pillar, value):
+    '''bin of a value in its histogram. Values out of range fall in the first or last bin'''
+    lo, hi, width = bins['score' if pillar == 'score' else 'pillar']
+    return min(max(int(round((value - lo)/width)), 0), index_size(pillar) - 1)
+
+
+class ScoreIndex:
+    '''
+    Histograms of the issued scores, persisted to a json file shared by all workers.
+    Each worker counts new scores locally, and merges them into the file every SCORE_INDEX_SAVE seconds (default 60)
+    and at exit, under a file lock. Each merge also brings in the scores counted by the other workers
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.pending = dict()
+        self.saves = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self.trees = {k: Fenwick(v) for k, v in self._read().items()}
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+    def _tree(self, key, pillar):
+        if key not in self.trees:
+            self.trees[key] = Fenwick([0]*index_size(pillar))
+        return self.trees[key]
+
+    def add(self, key, pillar, value):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='score-index', daemon=True)
+                self._thread.start()
+                atexit.register(self.save)
+            i = index_bin(pillar, value)
+            self._tree(key, pillar).add(i)
+            self.pending.setdefault(key, dict())
+            self.pending[key][i] = self.pending[key].get(i, 0) + 1
+
+    def rank(self, key, pillar, value):
+        '''
+        Description:
+            percentile rank of a value among the values counted so far: the share below it, plus half the share in its bin
+
+        Returns:
+            count (int): number of values counted
+            percentile (float): in range [0, 100], None if no value was counted
+        '''
+        with self._lock:
+            tree = self.trees.get(key)
+            total = tree.total() if tree else 0
+            if not total:
+                return 0, None
+            i = index_bin(pillar, value)
+            return total, 100*(tree.prefix(i) + tree.counts[i]/2)/total
+
+    def save(self):
+        '''merge the scores counted since the last save into the file, and reload the counts of all workers'''
+        with self._lock:
+            pending, self.pending = self.pending, dict()
+        if not pending:
+            return
+        try:
+            with open(self.path + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                counts = self._read()
+                for key, added in pending.items():
+                    if key not in counts:
+                        counts[key] = [0]*index_size(key.split('/')[-1])
+                    for i, n in added.items():
+                        counts[key][i] += n
+                tmp = '{}.{}'.format(self.path, os.getpid())
+                with open(tmp, 'w') as f:
+                    json.dump(counts, f)
+                os.replace(tmp, self.path)
+
+            with self._lock:
+                # scores counted while the file was written are only in the local trees
+                trees = {k: Fenwick(v) for k, v in counts.items()}
+                for key, added in self.pending.items():
+                    if key in trees:
+                        for i, n in added.items():
+                            trees[key].add(i, n)
+                self.trees.update(trees)
+                self.saves += 1
+
+        except (OSError, ValueError):
+            # keep the scores for the next save
+            with self._lock:
+                for key, added in pending.items():
+                    for i, n in added.items():
+                        self.pending.setdefault(key, dict())
+                        self.pending[key][i] = self.pending[key].get(
+                            i, 0) + n
+                self.errors += 1
+
+    def _run(self):
+        while True:
+            time.sleep(float(getenv('SCORE_INDEX_SAVE', 60)))
+            self.save()
+
+
+_index = {'index': None}
+_index_lock = threading.Lock()
+
+
+def score_index():
+    '''the score index of this worker, loaded from SCORE_INDEX_PATH (default score_index.json) on first use'''
+    path = getenv('SCORE_INDEX_PATH', 'score_index.json')
+    with _index_lock:
+        if _index['index'] is None or _index['index'].path != path:
+            _index['index'] = ScoreIndex(path)
+        return _index['index']
+
+
+# -------------------------------------------------------------------------- #
+#                              Percentile Ranks                              #
+# -------------------------------------------------------------------------- #
+
+def pillar_scores(metrics):
+    '''pillar scores of the live model, from the metrics filled by plaid_score_stages or coinbase_score_stages'''
+    weights = coinbase_weights if metrics['branch'] == 'coinbase' else plaid_weights
+    return {p: weigh(metrics[p], weights[p]) for p in weights if p in metrics}
+
+
+def score_percentiles(model, score, metrics, record=True):
+    '''
+    Description:
+        percentile ranks of a score and its pillar scores among all scores issued by the same model version,
+        then count them in the index. Ranks are left out until SCORE_INDEX_MIN (default 100) scores were issued
+
+    Parameters:
+        model (str): 'plaid' or 'coinbase'
+        score (float): live score
+        metrics (dict): metrics filled by the live scoring, e.g. by plaid_score(..., metrics=metrics)
+        record (bool): count the score in the index after ranking it
+
+    Returns:
+        percentiles (dict): percentile rank in range [0, 100] of the score ('score') and of each pillar,
+            e.g. {'score': 62.4, 'velocity': 48.0, ...}, or None if too few scores were issued
+    '''
+    try:
+        index = score_index()
+        values = {'score': score, **pillar_scores(metrics)}
+        minimum = int(getenv('SCORE_INDEX_MIN', 100))
+
+        percentiles = dict()
+        for p, v in values.items():
+            count, rank = index.rank(index_key(model, model_version, p), p, v)
+            if count >= minimum and rank is not None:
+                percentiles[p] = round(rank, 1)
+
+        if record:
+            for p, v in values.items():
+                index.add(index_key(model, model_version, p), p, v)
+
+        return percentiles or None
+
+    except Exception:
+        return None
+
+
+def score_index_stats():
+    '''number of scores in the index of this worker, per model and model version, and the number of saves to file'''
+    index = score_index()
+    with index._lock:
+        counts = {k[:-len('/score')]: t.total()
+                  for k, t in index.trees.items() if k.endswith('/score')}
+        pending = sum([sum(v.values()) for v in index.pending.values()])
+    return {'scores': counts, 'pending': pending, 'saves': index.saves, 'errors': index.errors}
@@ -1,38 +1,243 @@
+from support.fingerprint import *
 from support.models import *
 
+import copy
 
-def plaid_score(txn, feedback):
+# bump whenever a metric, grid, bin, or weight changes, so that cached and stored scores are not mixed across models
+model_version = '1.0.0'
 
-    mix, feedback = credit_mix(txn, feedback)
+# weights of the pillars of each model. A Plaid user without a credit card is scored on the 'no_credit' pillars
+plaid_pillar_weights = {
+    # adds up to 0.95 for lack of credit card - it's a penalty
+    'no_credit': {'velocity': 0.33, 'stability': 0.42, 'diversity': 0.20},
+    'credit': {'credit': 0.42, 'velocity': 0.20, 'stability': 0.28, 'diversity': 0.10}
+}
+coinbase_pillar_weights = {'kyc': 0.10,
+                           'history': 0.10, 'liquidity': 0.40, 'activity': 0.40}
 
-    if mix == 0:
-        velocity, feedback = plaid_velocity(txn, feedback)
-        stability, feedback = plaid_stability(txn, feedback)
-        diversity, feedback = plaid_diversity(txn, feedback)
 
-        # adds up to 0.95 for lack of credit card - it's a penalty
-        score = 300 + 600*(0.33*velocity + 0.42*stability + 0.20*diversity)
+def create_feedback_plaid():
+    '''create a feedback dict for Plaid'''
+    return {'fetch': {}, 'credit': {}, 'velocity': {}, 'stability': {}, 'diversity': {}}
 
+
+def create_feedback_coinbase():
+    '''create a feedback dict for Coinbase'''
+    return {'kyc': {}, 'history': {}, 'liquidity': {}, 'activity': {}}
+
+
+def plaid_as_of(txn, as_of):
+    '''Plaid data as it stood on the as_of date: transactions after that date are left out'''
+    if all([t['date'] <= as_of for t in txn['transactions']]):
+        return txn
+    return {**txn, 'transactions': [t for t in txn['transactions'] if t['date'] <= as_of]}
+
+
+def coinbase_as_of(acc, txn, as_of):
+    '''Coinbase data as it stood on the as_of date: accounts opened and transactions made after that date are left out'''
+    day = as_of.isoformat()
+    acc = [a for a in acc if not a['created_at'] or a['created_at'] <= as_of]
+    txn = [t for t in txn if t['created_at'][:10] <= day]
+    return acc, txn
+
+
+def plaid_score_stages(txn, feedback, as_of=None, metrics=None):
+    '''
+    Description:
+        Score a Plaid user one pillar at a time, yielding after each pillar so that callers can report progress
+
+    Parameters:
+        txn (dict): Plaid 'Transactions' product
+        feedback (dict): score feedback
+        as_of (date): score the data as it stood on this date. Defaults to today
+        metrics (dict): if given, filled with the branch of the model the user is scored on ('credit' or 'no_credit')
+            and the metric scores of each pillar before weighting, so that the user can be scored with other weights
+
+    Yields:
+        stage (str): name of the pillar just scored (e.g. 'plaid_credit'), or 'score' for the final score
+        value (float): pillar score in range [0, 1], or the final score in range [300, 900]
+        feedback (dict): score feedback
+    '''
+    as_of = scoring_date(as_of)
+    txn = plaid_as_of(txn, as_of)
+    metrics = dict() if metrics is None else metrics
+    mix, feedback = credit_mix(txn, feedback, as_of)
+
+    # users without a credit card are not scored on the credit pillar
+    metrics['branch'] = 'no_credit' if mix == 0 else 'credit'
+    pillars = dict()
+    for p in plaid_pillar_weights[metrics['branch']]:
+        metrics[p], feedback = plaid_pillar_metrics[p](txn, feedback, as_of)
+        pillars[p] = weigh(metrics[p], plaid_weights[p])
+        yield 'plaid_' + p, pillars[p], feedback
+
+    score = 300 + 600 * \
+        weigh(pillars, plaid_pillar_weights[metrics['branch']])
+
+    yield 'score', score, feedback
+
+
+def plaid_score_stages_cached(txn, feedback, cache, as_of=None, metrics=None):
+    '''Same as plaid_score_stages, but replays the stages from cache when the same data was already scored as of the same date'''
+    as_of = scoring_date(as_of)
+    key = ('plaid', model_version, as_of.isoformat(), plaid_fingerprint(txn))
+    return cached_stages(cache, key, lambda fb, m: plaid_score_stages(txn, fb, as_of, m), feedback, metrics)
+
+
+def plaid_score(txn, feedback, cache=None, as_of=None, metrics=None):
+
+    if cache is None:
+        stages = plaid_score_stages(txn, feedback, as_of, metrics)
     else:
-        credit, feedback = plaid_credit(txn, feedback)
-        velocity, feedback = plaid_velocity(txn, feedback)
-        stability, feedback = plaid_stability(txn, feedback)
-        diversity, feedback = plaid_diversity(txn, feedback)
+        stages = plaid_score_stages_cached(
+            txn, feedback, cache, as_of, metrics)
 
-        score = 300 + 600*(0.42*credit + 0.20*velocity +
-                           0.28*stability + 0.10*diversity)
+    for stage, score, feedback in stages:
+        pass
 
     return score, feedback
 
 
-def coinbase_score(acc, txn, feedback):
+def coinbase_score_stages(acc, txn, feedback, as_of=None, metrics=None):
+    '''
+    Description:
+        Score a Coinbase user one pillar at a time, yielding after each pillar so that callers can report progress
+
+    Parameters:
+        acc (list): non-zero balance Coinbase accounts owned by the user in currencies of trusted reputation
+        txn (list): transactions history of above-listed accounts
+        feedback (dict): score feedback
+        as_of (date): score the data as it stood on this date. Defaults to today
+        metrics (dict): if given, filled with the branch of the model ('coinbase') and the metric scores of each pillar before weighting
+
+    Yields:
+        stage (str): name of the pillar just scored (e.g. 'coinbase_kyc'), or 'score' for the final score
+        value (float): pillar score in range [0, 1], or the final score in range [300, 900]
+        feedback (dict): score feedback
+    '''
+    as_of = scoring_date(as_of)
+    acc, txn = coinbase_as_of(acc, txn, as_of)
+    metrics = dict() if metrics is None else metrics
+    metrics['branch'] = 'coinbase'
+
+    metrics['kyc'], feedback = coinbase_kyc_metrics(acc, txn, feedback)
+    kyc = weigh(metrics['kyc'], coinbase_weights['kyc'])
+    yield 'coinbase_kyc', kyc, feedback
+    metrics['history'], feedback = coinbase_history_metrics(
+        acc, feedback, as_of)
+    history = weigh(metrics['history'], coinbase_weights['history'])
+    yield 'coinbase_history', history, feedback
+    metrics['liquidity'], feedback = coinbase_liquidity_metrics(
+        acc, txn, feedback, as_of)
+    liquidity = weigh(metrics['liquidity'], coinbase_weights['liquidity'])
+    yield 'coinbase_liquidity', liquidity, feedback
+    metrics['activity'], feedback = coinbase_activity_metrics(
+        acc, txn, feedback)
+    activity = weigh(metrics['activity'], coinbase_weights['activity'])
+    yield 'coinbase_activity', activity, feedback
+
+    pillars = {'kyc': kyc, 'history': history,
+               'liquidity': liquidity, 'activity': activity}
+    score = 300 + 600*weigh(pillars, coinbase_pillar_weights)
+
+    yield 'score', score, feedback
+
+
+def coinbase_score_stages_cached(acc, txn, feedback, cache, as_of=None, metrics=None):
+    '''Same as coinbase_score_stages, but replays the stages from cache when the same data was already scored as of the same date'''
+    as_of = scoring_date(as_of)
+    key = ('coinbase', model_version, as_of.isoformat(),
+           coinbase_fingerprint(acc, txn))
+    return cached_stages(cache, key, lambda fb, m: coinbase_score_stages(acc, txn, fb, as_of, m), feedback, metrics)
 
-    kyc, feedback = coinbase_kyc(acc, txn, feedback)
-    history, feedback = coinbase_history(acc, feedback)
-    liquidity, feedback = coinbase_liquidity(acc, txn, feedback)
-    activity, feedback = coinbase_activity(acc, txn, feedback)
 
-    score = 300 + 600*(0.10*kyc + 0.10*history +
-                       0.40*liquidity + 0.40*activity)
+def coinbase_score(acc, txn, feedback, cache=None, as_of=None, metrics=None):
+
+    if cache is None:
+        stages = coinbase_score_stages(acc, txn, feedback, as_of, metrics)
+    else:
+        stages = coinbase_score_stages_cached(
+            acc, txn, feedback, cache, as_of, metrics)
+
+    for stage, score, feedback in stages:
+        pass
 
     return score, feedback
+
+
+def cached_stages(cache, key, stages, feedback, metrics=None):
+    '''
+    Description:
+        replay the score stages stored in cache under a content fingerprint, or compute and store them.
+        Computed metrics are merged into the feedback, without overwriting the values the caller already wrote (e.g. bank_name)
+
+    Parameters:
+        cache (TTLCache): any cache exposing get(key) and set(key, value)
+        key (tuple): model, model version, as_of date, and data fingerprint
+        stages (function): takes a feedback dict and a metrics dict, and returns a generator of score stages
+        feedback (dict): score feedback
+        metrics (dict): if given, filled with the metric scores before weighting, same as plaid_score_stages and coinbase_score_stages
+
+    Yields:
+        stage (str), value (float), feedback (dict): same as plaid_score_stages and coinbase_score_stages
+    '''
+    metrics = dict() if metrics is None else metrics
+    hit = cache.get(key)
+
+    if hit is not None:
+        history, computed, stored = hit
+        for k, v in computed.items():
+            feedback[k] = {**copy.deepcopy(v), **feedback.get(k, {})}
+        metrics.update(copy.deepcopy(stored))
+        for stage, value in history:
+            yield stage, value, feedback
+
+    else:
+        history = list()
+        for stage, value, feedback in stages(feedback, metrics):
+            history.append((stage, value))
+            yield stage, value, feedback
+        cache.set(key, (history, copy.deepcopy(feedback), copy.deepcopy(metrics)))
+
+
+# default contribution of each validator to a combined score
+blend_weights = {'plaid': 0.6, 'coinbase': 0.4}
+
+
+def blend_score(scores, policy='weighted', weights=None):
+    '''
+    Description:
+        blend the scores of several validators into a single score
+
+    Parameters:
+        scores (dict): validator-score pairs, e.g. {'plaid': 650, 'coinbase': 700}. Leave out the validators that returned no score
+        policy (str): accepts 'weighted', 'mean', 'max', or 'min'
+        weights (dict): validator-weight pairs used by the 'weighted' policy. Weights are renormalized over the available scores
+
+    Returns:
+        score (float): blended score in range [300, 900]
+    '''
+    if not scores:
+        raise Exception('no score to blend')
+
+    if policy == 'weighted':
+        weights = weights or blend_weights
+        total = sum([weights.get(k, 0) for k in scores])
+        if total <= 0:
+            raise Exception('invalid blend weights')
+        score = sum([v*weights.get(k, 0)
+                    for k, v in scores.items()]) / total
+
+    elif policy == 'mean':
+        score = sum(scores.values()) / len(scores)
+
+    elif policy == 'max':
+        score = max(scores.values())
+
+    elif policy == 'min':
+        score = min(scores.values())
+
+    else:
+        raise Exception('unknown blend policy: {}'.format(policy))
+
+    return score
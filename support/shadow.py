@@ -0,0 +1,191 @@
+from datetime import datetime, timezone
+from os import getenv
+from support.score import *
+
+import threading
+import queue
+import json
+import time
+import os
+
+
+# -------------------------------------------------------------------------- #
+#                                Shadow Models                               #
+# -------------------------------------------------------------------------- #
+# A shadow model is a candidate model version scored alongside the live one, on the same data and metrics.
+# Shadow models are declared in the json file at SHADOW_MODELS, as a list of:
+#   {"model": "plaid", "model_version": "1.1.0-rc1", "weights": {...}, "pillar_weights": {...}}
+# where weights and pillar_weights have the same layout as the output of support/calibration.py.
+# Pillars left out keep their live weights.
+
+_models = {'path': None, 'mtime': None, 'models': []}
+_lock = threading.Lock()
+
+
+def shadow_models(model):
+    '''
+    Description:
+        the shadow models of a live model, read from the SHADOW_MODELS file and reloaded when the file changes
+
+    Parameters:
+        model (str): 'plaid' or 'coinbase'
+
+    Returns:
+        models (list): at most SHADOW_MAX (default 3) shadow models, each with its model_version, weights, and pillar_weights
+    '''
+    path = getenv('SHADOW_MODELS')
+    if not path:
+        return []
+
+    with _lock:
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            mtime = None
+        if (path, mtime) != (_models['path'], _models['mtime']):
+            # an unreadable or invalid file disables shadow scoring until it changes
+            try:
+                with open(path) as f:
+                    models = json.load(f)
+            except (OSError, ValueError):
+                _stats['errors'] += 1
+                models = []
+            _models.update(path=path, mtime=mtime, models=models)
+        models = _models['models']
+
+    live = {'plaid': (plaid_weights, plaid_pillar_weights),
+            'coinbase': (coinbase_weights, {'coinbase': coinbase_pillar_weights})}[model]
+    return [{'model_version': m['model_version'],
+             'weights': {**live[0], **m.get('weights', {})},
+             'pillar_weights': {**live[1], **m.get('pillar_weights', {})}}
+            for m in models if m.get('model') == model][:int(getenv('SHADOW_MAX', 3))]
+
+
+def weighted_score(metrics, weights, pillar_weights):
+    '''
+    Description:
+        the score of a user under other weights, from the metric scores computed by the live model.
+        It only costs the weighted sums: no data is fetched, parsed, or binned again
+
+    Parameters:
+        metrics (dict): branch and metric scores of each pillar, as filled by plaid_score_stages or coinbase_score_stages
+        weights (dict): weights of the metrics of each pillar
+        pillar_weights (dict): weights of the pillars of each branch
+
+    Returns:
+        score (float): score in range [300, 900]
+    '''
+    branch = pillar_weights[metrics['branch']]
+    pillars = {p: weigh(metrics[p], weights[p]) for p in branch}
+    return 300 + 600*weigh(pillars, branch)
+
+
+# -------------------------------------------------------------------------- #
+#                                 Shadow Log                                 #
+# -------------------------------------------------------------------------- #
+
+class ShadowLog:
+    '''
+    Appends shadow scores as json lines to a file, from a background thread, so that requests never wait on disk.
+    When the queue is full, records are dropped rather than slowing requests down
+    '''
+
+    def __init__(self, size=1000):
+        self.queue = queue.Queue(size)
+        self.dropped = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            try:
+                with open(getenv('SHADOW_LOG', 'shadow_scores.jsonl'), 'a') as f:
+                    f.write(json.dumps(record, default=str) + '\n')
+            except OSError:
+                self.dropped += 1
+            finally:
+                self.queue.task_done()
+
+
+shadow_log = ShadowLog()
+_stats = {'requests': 0, 'scores': 0, 'skipped': 0,
+          'errors': 0, 'cost': 0.0, 'max_cost': 0.0}
+
+
+def shadow_score(model, score, metrics, as_of=None, endpoint=None):
+    '''
+    Description:
+        score a user with every shadow model of the live model, and log the shadow scores next to the live score.
+        Shadow scores are never returned to the user. The cost is bounded by SHADOW_BUDGET_MS (default 5) per request:
+        shadow models left once the budget is spent are skipped. Never raises
+
+    Parameters:
+        model (str): 'plaid' or 'coinbase'
+        score (float): live score
+        metrics (dict): metrics filled by the live scoring, e.g. by plaid_score(..., metrics=metrics)
+        as_of (date): scoring date
+        endpoint (str): endpoint that scored the user
+
+    Returns:
+        shadows (dict): shadow model_version-score pairs
+    '''
+    t0 = time.perf_counter()
+    shadows = dict()
+    try:
+        models = shadow_models(model)
+        if not models or 'branch' not in metrics:
+            return shadows
+
+        budget = float(getenv('SHADOW_BUDGET_MS', 5))/1000
+        for m in models:
+            if time.perf_counter() - t0 > budget:
+                break
+            shadows[m['model_version']] = weighted_score(
+                metrics, m['weights'], m['pillar_weights'])
+
+        cost = time.perf_counter() - t0
+        with _lock:
+            _stats['requests'] += 1
+            _stats['scores'] += len(shadows)
+            _stats['skipped'] += len(models) - len(shadows)
+            _stats['cost'] += cost
+            _stats['max_cost'] = max(_stats['max_cost'], cost)
+        shadow_log.write({
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'endpoint': endpoint,
+            'model': model,
+            'as_of': as_of,
+            'live': {model_version: score},
+            'shadow': shadows,
+            'cost_ms': round(cost*1000, 3)
+        })
+
+    except Exception:
+        _stats['errors'] += 1
+
+    return shadows
+
+
+def shadow_stats():
+    '''number of requests and shadow scores, and the cost of shadow scoring in this worker'''
+    requests = _stats['requests']
+    return {
+        'requests': requests,
+        'scores': _stats['scores'],
+        'skipped': _stats['skipped'],
+        'errors': _stats['errors'],
+        'dropped_logs': shadow_log.dropped,
+        'mean_cost_ms': 1000*_stats['cost']/requests if requests else 0,
+        'max_cost_ms': 1000*_stats['max_cost']
+    }
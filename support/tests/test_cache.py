@@ -0,0 +1,333 @@
+import copy
+import pickle
+import json
+import time
+import tempfile
+import unittest
+import multiprocessing
+import socketserver
+import threading
+from datetime import datetime
+from optimization.cache import *  # import code to get tested
+from optimization.market_data import *
+import optimization.market_data as market_data
+from support.score import *
+
+
+# -------------------------------------------------------------------------- #
+#                                TEST CASES                                  #
+#                      - caches shared by the scoring routes -               #
+# -------------------------------------------------------------------------- #
+
+class TestHashKey(unittest.TestCase):
+
+    def test_hash_key(self):
+        '''
+        - the same parts always yield the same key
+        - different parts yield different keys
+        - secrets never appear in the key
+        '''
+        a = hash_key('/credit_score/plaid', 'access-sandbox-secret', '2022-05-01')
+        b = hash_key('/credit_score/plaid', 'access-sandbox-secret', '2022-05-01')
+        c = hash_key('/credit_score/plaid', 'access-sandbox-secret', '2022-05-02')
+
+        self.assertEqual(a, b)
+        self.assertNotEqual(a, c)
+        self.assertNotIn('secret', a)
+
+
+class TestTTLCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = TTLCache(ttl=60, maxsize=2)
+
+    def tearDown(self):
+        self.cache = None
+
+    def test_get_set(self):
+        '''
+        - a missing key returns the default
+        - a stored value is returned until it expires
+        '''
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.set('a', {'score': 700})
+        self.assertEqual(self.cache.get('a'), {'score': 700})
+
+        self.cache.set('b', 1, ttl=0.01)
+        time.sleep(0.02)
+        self.assertEqual(self.cache.get('b', 'expired'), 'expired')
+
+    def test_lru_eviction(self):
+        '''
+        - the least recently used entry is evicted beyond maxsize
+        '''
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(len(self.cache), 2)
+
+
+
+class TestFeatureCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = TTLCache(ttl=60)
+        with open('data/test_user_plaid.json') as my_file:
+            self.data = json.load(my_file)
+        for t in self.data['transactions']:
+            t['date'] = datetime.strptime(t['date'], '%Y-%m-%d').date()
+
+    def tearDown(self):
+        self.cache = None
+        self.data = None
+
+    def test_plaid_fingerprint(self):
+        '''
+        - the fingerprint does not depend on the order of accounts and transactions
+        - any change to a transaction amount changes the fingerprint
+        '''
+        shuffled = copy.deepcopy(self.data)
+        shuffled['transactions'].reverse()
+        shuffled['accounts'].reverse()
+        changed = copy.deepcopy(self.data)
+        changed['transactions'][0]['amount'] += 1
+
+        self.assertEqual(plaid_fingerprint(self.data),
+                         plaid_fingerprint(shuffled))
+        self.assertNotEqual(plaid_fingerprint(self.data),
+                            plaid_fingerprint(changed))
+
+    def test_plaid_score_cached(self):
+        '''
+        - a cached re-score returns the same score, pillar stages, and feedback as a full score
+        - values written to the feedback before scoring are preserved on a cache hit
+        '''
+        fb = {'fetch': {}, 'credit': {}, 'velocity': {},
+              'stability': {}, 'diversity': {'bank_name': 'Bank A'}}
+        stages = list(plaid_score_stages_cached(
+            self.data, copy.deepcopy(fb), self.cache))
+        fb['diversity']['bank_name'] = 'Bank B'
+        cached = list(plaid_score_stages_cached(
+            self.data, copy.deepcopy(fb), self.cache))
+
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual([x[:2] for x in stages], [x[:2] for x in cached])
+        self.assertEqual(cached[-1][2]['diversity']['bank_name'], 'Bank B')
+        self.assertEqual(cached[-1][2]['credit'], stages[-1][2]['credit'])
+
+
+
+class RedisStandIn(socketserver.StreamRequestHandler):
+    '''a local stand-in for a Redis server, speaking just enough RESP for RedisBackend'''
+
+    store = {}
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:-2])):
+            size = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(size + 2)[:-2])
+        return args
+
+    def handle(self):
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            cmd = args[0].upper()
+            if cmd == b'GET':
+                value = self.store.get(args[1])
+                if value is None or value[1] < time.time():
+                    self.wfile.write(b'$-1\r\n')
+                else:
+                    self.wfile.write(b'$%d\r\n%s\r\n' %
+                                     (len(value[0]), value[0]))
+            elif cmd == b'SET':
+                self.store[args[1]] = (
+                    args[2], time.time() + int(args[4])/1000)
+                self.wfile.write(b'+OK\r\n')
+            elif cmd == b'DEL':
+                n = sum([self.store.pop(k, None) is not None for k in args[1:]])
+                self.wfile.write(b':%d\r\n' % n)
+            elif cmd == b'SCAN':
+                prefix = args[3][:-1]
+                keys = [k for k in self.store if k.startswith(prefix)]
+                reply = b''.join([b'$%d\r\n%s\r\n' % (len(k), k) for k in keys])
+                self.wfile.write(b'*2\r\n$1\r\n0\r\n*%d\r\n%s' %
+                                 (len(keys), reply))
+            else:
+                self.wfile.write(b'-ERR unknown command\r\n')
+
+
+class TestCacheBackends(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def check_backend(self, a, b):
+        '''
+        - a value written by one client is read by another client of the same backend
+        - namespaces do not collide, and clearing one leaves the other intact
+        - an expired value is a miss
+        '''
+        scores_a, scores_b = Cache('scores', 60, a), Cache('scores', 60, b)
+        features = Cache('features', 60, b)
+
+        scores_a.set('user', {'score': 700})
+        features.set('user', ('stages', 'feedback'))
+        self.assertEqual(scores_b.get('user'), {'score': 700})
+        self.assertEqual(features.get('user'), ('stages', 'feedback'))
+
+        scores_a.clear()
+        self.assertIsNone(scores_b.get('user'))
+        self.assertEqual(features.get('user'), ('stages', 'feedback'))
+
+        scores_a.set('user', 1, ttl=0.01)
+        time.sleep(0.05)
+        self.assertIsNone(scores_b.get('user'))
+
+        self.assertEqual(scores_b.stats()['hits'], 1)
+        self.assertEqual(scores_b.stats()['misses'], 2)
+
+    def test_memory_backend(self):
+        '''
+        - least recently used values are evicted beyond max_bytes, and counted
+        '''
+        backend = MemoryBackend()
+        self.check_backend(backend, backend)
+
+        small = Cache('scores', 60, MemoryBackend(max_bytes=200))
+        for i in range(10):
+            small.set(i, 'x'*50)
+        self.assertLessEqual(small.backend.size, 200)
+        self.assertGreater(small.stats()['evictions'], 0)
+
+    def test_sqlite_backend(self):
+        path = os.path.join(self.dir.name, 'cache.sqlite')
+        self.check_backend(SQLiteBackend(path), SQLiteBackend(path))
+
+    def test_sqlite_purge(self):
+        '''
+        - expired entries are deleted every `purge_every` writes, even if they are never read again
+        '''
+        backend = SQLiteBackend(os.path.join(self.dir.name, 'cache.sqlite'), purge_every=3)
+        cache = Cache('scores', 60, backend)
+        cache.set('a', 1, ttl=0.01)
+        cache.set('b', 2, ttl=0.01)
+        time.sleep(0.05)
+        cache.set('c', 3)
+        count = backend._connect().execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+        self.assertEqual(count, 1)
+
+    def test_untrusted_values(self):
+        '''
+        - a value written to the backend by anyone but a cache sharing CACHE_SECRET is a miss, and never unpickled
+        - a value copied under another key is a miss
+        '''
+        backend = MemoryBackend()
+        cache = Cache('scores', 60, backend)
+        backend.set('scores:user', pickle.dumps({'score': 900}), 60)
+        self.assertIsNone(cache.get('user'))
+
+        cache.set('other', {'score': 300})
+        backend.set('scores:user', backend.get('scores:other'), 60)
+        self.assertIsNone(cache.get('user'))
+        self.assertEqual(cache.get('other'), {'score': 300})
+        self.assertEqual(cache.stats()['errors'], 2)
+
+    def test_redis_backend(self):
+        server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), RedisStandIn)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            url = 'redis://127.0.0.1:{}/0'.format(server.server_address[1])
+            self.check_backend(RedisBackend(url), RedisBackend(url))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_backend_failure_is_a_miss(self):
+        '''
+        - an unreachable backend never fails the caller, and errors are counted
+        '''
+        cache = Cache('scores', 60, RedisBackend('redis://127.0.0.1:1/0'))
+        cache.set('user', 1)
+
+        self.assertIsNone(cache.get('user'))
+        self.assertEqual(cache.stats()['errors'], 2)
+
+
+def read_version(path, queue):
+    '''read a snapshot from another process'''
+    queue.put(SharedSnapshot(path).read())
+
+
+class TestSharedSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'market_data')
+        # each test publishes to its own file: forget the versions polled from the previous one
+        market_data._local.update({'version': 0, 'snapshot': None})
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_publish_read(self):
+        '''
+        - an empty snapshot file reads as None
+        - each publication bumps the version by 2 and is readable from another process
+        - polling swaps the local snapshot only when the version changes
+        '''
+        shared = SharedSnapshot(self.path, capacity=1024)
+        self.assertIsNone(shared.read())
+
+        v1 = shared.publish({'rate': 0.5})
+        v2 = shared.publish({'rate': 0.6, 'coins': {'BTC': 1}})
+        self.assertEqual(v2, v1 + 2)
+
+        queue = multiprocessing.Queue()
+        p = multiprocessing.Process(
+            target=read_version, args=(self.path, queue))
+        p.start()
+        p.join()
+        self.assertEqual(queue.get(), (v2, {'rate': 0.6, 'coins': {'BTC': 1}}))
+
+        self.assertEqual(poll_market_data(shared)['rate'], 0.6)
+        self.assertIs(poll_market_data(shared), market_snapshot())
+
+    def test_refresh_keeps_last_good_value(self):
+        '''
+        - a field that fails to refresh keeps its previous value and refresh time
+        - a field refreshed too long ago should read as missing, so that readers fall back to a live call
+        - a snapshot larger than the file capacity is rejected
+        '''
+        shared = SharedSnapshot(self.path, capacity=1024)
+        refresh_market_data(shared, lambda prev: {'rate': 0.5})
+        refreshed = shared.read()[1]['refreshed']['rate']
+        time.sleep(0.02)
+        refresh_market_data(shared, lambda prev: {'coins': {'BTC': 1}})
+
+        snapshot = shared.read()[1]
+        self.assertEqual(snapshot['rate'], 0.5)
+        self.assertEqual(snapshot['refreshed']['rate'], refreshed)
+        poll_market_data(shared)
+        self.assertEqual(market_field('coins', 60), {'BTC': 1})
+        self.assertEqual(market_field('rate', 60), 0.5)
+        self.assertIsNone(market_field('rate', 0.01))
+        self.assertIsNone(market_field('currencies', 60))
+        self.assertRaises(Exception, shared.publish, {'x': 'y'*2048})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,335 @@
+import os
+import json
+import base64
+import hashlib
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from datetime import date
+from oracle.ledger import *  # import code to get tested
+from oracle.publisher import *
+from oracle.attestation import *
+from oracle.keplr import *
+import app_route
+
+
+# -------------------------------------------------------------------------- #
+#                                TEST CASES                                  #
+#                            - oracle: score ledger -                        #
+# -------------------------------------------------------------------------- #
+
+class TestScoreLedger(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.env = os.environ.get('SCORE_LEDGER_PATH')
+        os.environ['SCORE_LEDGER_PATH'] = os.path.join(
+            self.dir, 'ledger.db')
+        self.ledger = score_ledger()
+
+    def tearDown(self):
+        if self.env is None:
+            os.environ.pop('SCORE_LEDGER_PATH', None)
+        else:
+            os.environ['SCORE_LEDGER_PATH'] = self.env
+        shutil.rmtree(self.dir)
+
+    def test_latest_and_history(self):
+        '''
+        - the latest score of a wallet should be the last one recorded, of any provider or of the one asked for
+        - history should list the scores newest first
+        - only the compact score record should be stored, never balances, card names, or advice
+        '''
+        self.ledger.record('secret1a', 'plaid', '1.0.0', 610, {'score': {
+            'points': 610, 'quality': 'fair', 'loan_amount': 1000, 'card_names': ['Chase'], 'cum_balance': 2500},
+            'advice': {'what_if': []}}, date(2022, 1, 1))
+        self.ledger.record('secret1b', 'plaid', '1.0.0', 700, {})
+        self.ledger.record('secret1a', 'coinbase', '1.0.0', 650.7, {})
+
+        latest = self.ledger.latest('secret1a')
+        self.assertEqual((latest['provider'], latest['score']), ('coinbase', 650))
+        latest = self.ledger.latest('secret1a', 'plaid')
+        self.assertEqual(latest['feedback'], {'points': 610, 'quality': 'fair',
+                                              'loan_amount': 1000, 'loan_duedate': None})
+        self.assertEqual(latest['as_of'], '2022-01-01')
+        self.assertEqual([s['score'] for s in self.ledger.history('secret1a', limit=10)], [650, 610])
+        self.assertIsNone(self.ledger.latest('secret1c'))
+
+    def test_concurrent_records(self):
+        '''
+        - scores recorded from several threads should all be stored
+        - scores without a wallet address should not be recorded
+        '''
+        def record(i):
+            for j in range(20):
+                ledger_record('secret1t', 'plaid', '1.0.0', 300 + j, {})
+        threads = [threading.Thread(target=record, args=(i,)) for i in range(4)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        self.assertIsNone(ledger_record(None, 'plaid', '1.0.0', 600, {}))
+        self.assertEqual(len(self.ledger.history('secret1t', limit=100)), 80)
+
+    def test_endpoint(self):
+        '''
+        - GET /credit_score/<address> should return the stored scores, or 404 if there is none
+        '''
+        client = app_route.app.test_client()
+        self.assertEqual(client.get('/credit_score/secret1x').status_code, 404)
+        self.assertEqual(client.get(
+            '/credit_score/secret1x?provider=other').status_code, 400)
+
+        self.ledger.record('secret1x', 'plaid', '1.0.0', 610, {})
+        self.ledger.record('secret1x', 'coinbase', '1.0.0', 620, {})
+        response = client.get('/credit_score/secret1x?provider=plaid')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([s['score'] for s in response.json['scores']], [610])
+        response = client.get('/credit_score/secret1x?limit=5')
+        self.assertEqual([s['score'] for s in response.json['scores']], [620, 610])
+
+
+# -------------------------------------------------------------------------- #
+#                                TEST CASES                                  #
+#                         - oracle: publication queue -                      #
+# -------------------------------------------------------------------------- #
+
+class TestPublicationQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.chain = LocalChain()
+
+    def score(self, address, score, provider='plaid'):
+        return {'address': address, 'provider': provider, 'model_version': '1.0.0',
+                'score': score, 'issued_at': '2022-01-01T00:00:00+00:00'}
+
+    def test_batches(self):
+        '''
+        - full batches should be published as soon as they are due, the rest on a forced flush
+        - only the latest score of a wallet from each provider should be published
+        '''
+        queue = PublicationQueue(self.chain, batch_size=3, interval=60)
+        for i in range(7):
+            queue.put(self.score('secret1{}'.format(i), 600))
+        queue.put(self.score('secret10', 650))
+        queue.put(self.score('secret10', 700, 'coinbase'))
+
+        queue.flush()
+        self.assertEqual(self.chain.transactions, 2)
+        self.assertEqual(queue.snapshot()['pending'], 2)
+        self.assertEqual(queue.flush(True), 2)
+        self.assertEqual(self.chain.transactions, 3)
+        self.assertEqual(len(self.chain.scores), 8)
+        self.assertEqual(self.chain.scores[('secret10', 'plaid')]['score'], 650)
+        self.assertEqual(self.chain.scores[('secret10', 'coinbase')]['score'], 700)
+
+    def test_retry_is_idempotent(self):
+        '''
+        - a batch that failed after it was published should be retried without being published twice
+        - newer scores should wait for the failed batch
+        '''
+        queue = PublicationQueue(self.chain, batch_size=10, interval=60, backoff=60)
+        queue.put(self.score('secret1a', 600))
+        self.chain.failures, self.chain.fail_after_publish = 1, True
+        self.assertEqual(queue.flush(True), 0)
+        self.assertEqual(queue.snapshot()['retrying'], 1)
+
+        queue.put(self.score('secret1a', 700))
+        self.assertEqual(queue.flush(), 0)
+        self.assertEqual(queue.flush(True), 2)
+        self.assertEqual(self.chain.transactions, 2)
+        self.assertEqual(queue.snapshot()['batches'], 2)
+        self.assertEqual(self.chain.scores[('secret1a', 'plaid')]['score'], 700)
+
+    def test_interval(self):
+        '''
+        - scores should be published by the background thread once the oldest one waited the interval
+        '''
+        queue = PublicationQueue(self.chain, batch_size=10, interval=0.05)
+        queue.put(self.score('secret1a', 600))
+        for _ in range(100):
+            if self.chain.transactions:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.chain.transactions, 1)
+        self.assertEqual(queue.snapshot()['published'], 1)
+
+
+# -------------------------------------------------------------------------- #
+#                                TEST CASES                                  #
+#                           - oracle: attestations -                         #
+# -------------------------------------------------------------------------- #
+
+class TestAttestation(unittest.TestCase):
+
+    def setUp(self):
+        self.key = ECC.generate(curve='P-256')
+
+    def record(self, i):
+        return {'address': 'secret1{}'.format(i), 'provider': 'plaid', 'model_version': '1.0.0',
+                'score': 600 + i, 'issued_at': '2022-01-01T00:00:00+00:00'}
+
+    def test_merkle_proofs(self):
+        '''
+        - every leaf of trees of any size should prove its inclusion in O(log n) hashes
+        '''
+        for n in range(1, 18):
+            leaves = [leaf_hash(self.record(i)) for i in range(n)]
+            levels = merkle_tree(leaves)
+            for i, leaf in enumerate(leaves):
+                proof = merkle_proof(levels, i)
+                self.assertLessEqual(len(proof), (n - 1).bit_length())
+                self.assertEqual(merkle_root(leaf, proof), levels[-1][0])
+            if n > 1:
+                self.assertNotEqual(merkle_root(
+                    leaves[0], merkle_proof(levels, 1)), levels[-1][0])
+
+    def test_concurrent_attestations(self):
+        '''
+        - scores issued in the same window should share one tree and one signature, and each should verify
+        - a tampered score should not verify
+        '''
+        attestor = Attestor(self.key, window=0.05)
+        results = [None]*20
+
+        def attest(i):
+            results[i] = attestor.attest(self.record(i), 5)
+        threads = [threading.Thread(target=attest, args=(i,))
+                   for i in range(20)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+
+        public = self.key.public_key()
+        self.assertTrue(all([verify_attestation(public, a) for a in results]))
+        self.assertLess(attestor.snapshot()['batches'], 20)
+        tampered = {**results[0], 'record': {**results[0]['record'], 'score': 900}}
+        self.assertFalse(verify_attestation(public, tampered))
+        other = ECC.generate(curve='P-256').public_key()
+        self.assertFalse(verify_attestation(other, results[0]))
+
+    def test_late_attestation(self):
+        '''
+        - a score whose window is not signed in time should get a pending attestation, served later by leaf
+        '''
+        attestor = Attestor(self.key, window=0.2)
+        pending = attestor.attest(self.record(0), 0.01)
+        self.assertEqual(pending['status'], 'pending')
+        for _ in range(100):
+            if attestor.lookup(pending['leaf']):
+                break
+            time.sleep(0.01)
+        self.assertTrue(verify_attestation(
+            self.key.public_key(), attestor.lookup(pending['leaf'])))
+        self.assertEqual(attestor.snapshot()['late'], 1)
+
+    def test_shared_lookup(self):
+        '''
+        - an attestation sealed by one worker should be served by another one, from the ledger
+        '''
+        directory = tempfile.mkdtemp()
+        ledger = ScoreLedger(os.path.join(directory, 'ledger.db'))
+        try:
+            attestation = Attestor(self.key, window=0.01, ledger=lambda: ledger).attest(self.record(0), 5)
+            other = Attestor(self.key, ledger=lambda: ledger)
+            self.assertEqual(other.lookup(attestation['leaf']), attestation)
+            self.assertTrue(verify_attestation(
+                self.key.public_key(), other.lookup(attestation['leaf'])))
+            self.assertIsNone(other.lookup(leaf_hash(self.record(1))))
+        finally:
+            shutil.rmtree(directory)
+
+
+# -------------------------------------------------------------------------- #
+#                                TEST CASES                                  #
+#                          - oracle: wallet tokens -                         #
+# -------------------------------------------------------------------------- #
+
+class TestKeplr(unittest.TestCase):
+
+    def setUp(self):
+        self.secret = int.from_bytes(os.urandom(32), 'big') % N
+        x, y = point_mul(self.secret, G)
+        self.pub_key = bytes([2 + y % 2]) + x.to_bytes(32, 'big')
+        self.address = wallet_address(self.pub_key)
+        self.verifier = KeplrVerifier(size=2, ttl=300)
+        self.binding = request_binding('/credit_score/plaid', 'access-test')
+
+    def token(self, nonce, address=None, binding=None):
+        '''a keplr_token signed like Keplr's signArbitrary(), for the request of the given binding'''
+        address = address or self.address
+        e = int.from_bytes(hashlib.sha256(
+            sign_doc(address, signed_data(nonce, binding or self.binding))).digest(), 'big')
+        k = int.from_bytes(os.urandom(32), 'big') % N
+        r = point_mul(k, G)[0] % N
+        s = pow(k, N - 2, N)*(e + r*self.secret) % N
+        return {'address': address, 'pub_key': {'type': 'tendermint/PubKeySecp256k1', 'value': base64.b64encode(self.pub_key).decode()},
+                'signature': base64.b64encode(r.to_bytes(32, 'big') + s.to_bytes(32, 'big')).decode(), 'nonce': nonce}
+
+    def test_address(self):
+        '''
+        - the address of a public key should be the bech32 encoding of its hash
+        '''
+        g = bytes([2]) + G[0].to_bytes(32, 'big')
+        self.assertEqual(wallet_address(g),
+                         'secret1w508d6qejxtdg4y5r3zarvary0c5xw7kccrnjy')
+        self.assertEqual(keplr_claim({'address': 'secret1x'}), None)
+        self.assertEqual(request_binding('/credit_score/plaid', ['access-1', 'access-2']),
+                         hashlib.sha256(b'["/credit_score/plaid",["access-1","access-2"]]').hexdigest())
+
+    def test_verify(self):
+        '''
+        - a signed token should verify once, and be served from the cache when the same request is retried
+        - a token with an expired nonce, another signature over a used nonce, or someone else's address should be rejected
+        - a token should be rejected with any other request than the one it was signed for, cached or not
+        '''
+        nonce = '{}:a1'.format(int(time.time()))
+        token = self.token(nonce)
+        self.assertEqual(self.verifier.verify(token, self.binding), self.address)
+        self.assertEqual(self.verifier.verify(json.dumps(token), self.binding), self.address)
+        self.assertEqual(self.verifier.snapshot()['hits'], 1)
+
+        with self.assertRaises(KeplrError):
+            self.verifier.verify(self.token(nonce), self.binding)
+        with self.assertRaises(KeplrError):
+            self.verifier.verify(self.token('{}:a2'.format(int(time.time()) - 600)), self.binding)
+        with self.assertRaises(KeplrError):
+            self.verifier.verify(self.token('{}:a3'.format(int(time.time())), 'secret1w508d6qejxtdg4y5r3zarvary0c5xw7kccrnjy'),
+                                 self.binding)
+        forged = {**self.token('{}:a4'.format(int(time.time()))), 'nonce': '{}:a5'.format(int(time.time()))}
+        with self.assertRaises(KeplrError):
+            self.verifier.verify(forged, self.binding)
+        self.assertEqual(self.verifier.snapshot()['rejected'], 4)
+
+        other = request_binding('/credit_score/plaid', 'access-other')
+        with self.assertRaises(KeplrError):
+            self.verifier.verify(token, other)
+        with self.assertRaises(KeplrError):
+            KeplrVerifier().verify(token, other)
+
+    def test_plain_address(self):
+        '''
+        - a plain address should be rejected by default
+        - a plain address accepted while migrating should not be issued scores
+        - a request with a token that does not verify should fail with 401
+        '''
+        env = os.environ.get('KEPLR_VERIFY')
+        try:
+            os.environ.pop('KEPLR_VERIFY', None)
+            with self.assertRaises(KeplrError):
+                verify_keplr_async(self.address, self.binding).result()
+            os.environ['KEPLR_VERIFY'] = '0'
+            unsigned = keplr_stats()['unsigned']
+            self.assertIsNone(verify_keplr_async(self.address, self.binding).result())
+            self.assertEqual(keplr_stats()['unsigned'], unsigned + 1)
+            self.assertIsNone(keplr_address(None, self.binding))
+        finally:
+            if env is None:
+                os.environ.pop('KEPLR_VERIFY', None)
+            else:
+                os.environ['KEPLR_VERIFY'] = env
+        self.assertEqual(app_route.error_status(
+            KeplrError('invalid signature'), app_route.Deadline(10)), 401)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+import copy
+import json
+import unittest
+from datetime import datetime
+from validator_api.plaid import plaid_merge_items  # import code to get tested
+
+
+# -------------------------------------------------------------------------- #
+#                               Helper Functions                             #
+#                                                                            #
+# -------------------------------------------------------------------------- #
+
+def load_item(institution_id):
+    '''load the Plaid test user as if it was an item linked at the given institution'''
+    with open('data/test_user_plaid.json') as my_file:
+        data = json.load(my_file)
+    for t in data['transactions']:
+        t['date'] = datetime.strptime(t['date'], '%Y-%m-%d').date()
+    data['item'] = {'item_id': institution_id, 'institution_id': institution_id}
+    return data
+
+
+def transfer(account_id, date, amount):
+    return {'account_id': account_id, 'amount': amount, 'category': ['Transfer', 'Debit'],
+            'date': date, 'name': 'Online Transfer', 'pending': False, 'transaction_id': str(amount)}
+
+
+# -------------------------------------------------------------------------- #
+#                                TEST CASES                                  #
+#              - merge and deduplicate several Plaid items -                 #
+# -------------------------------------------------------------------------- #
+
+class TestPlaidMergeItems(unittest.TestCase):
+
+    def setUp(self):
+        self.item = load_item('ins_1')
+
+    def tearDown(self):
+        self.item = None
+
+    def test_same_item_linked_twice(self):
+        '''
+        - an item linked twice should merge into the original item
+        - repeated identical txns of one item are not duplicates and must be kept
+        '''
+        twin = copy.deepcopy(self.item)
+        for a in twin['accounts']:
+            a['account_id'] = 'twin_' + a['account_id']
+        for t in twin['transactions']:
+            t['account_id'] = 'twin_' + t['account_id']
+
+        merged = plaid_merge_items([self.item, twin])
+
+        self.assertEqual(len(merged['accounts']), len(self.item['accounts']))
+        self.assertEqual(len(merged['transactions']),
+                         len(self.item['transactions']))
+        self.assertEqual(merged['item']['institution_id'], 'ins_1')
+
+    def test_transfer_seen_from_both_sides(self):
+        '''
+        - a transfer between two institutions should be dropped from both sides
+        - a transfer with no counterpart in another item should be kept
+        '''
+        other = load_item('ins_2')
+        for a in other['accounts']:
+            a['account_id'] = 'other_' + a['account_id']
+        for t in other['transactions']:
+            t['account_id'] = 'other_' + t['account_id']
+            t['name'] = 'other ' + t['name']
+        date = self.item['transactions'][0]['date']
+        self.item['transactions'].insert(
+            0, transfer(self.item['accounts'][0]['account_id'], date, 1234.5))
+        other['transactions'].insert(
+            0, transfer(other['accounts'][0]['account_id'], date, -1234.5))
+        other['transactions'].insert(
+            0, transfer(other['accounts'][0]['account_id'], date, -99.5))
+
+        merged = plaid_merge_items([self.item, other])
+        amounts = [t['amount'] for t in merged['transactions']]
+
+        self.assertNotIn(1234.5, amounts)
+        self.assertNotIn(-1234.5, amounts)
+        self.assertIn(-99.5, amounts)
+        self.assertEqual(len(merged['accounts']),
+                         2 * len(self.item['accounts']))
+        self.assertEqual(merged['item']['institution_id'], ['ins_1', 'ins_2'])
+
+    def test_many_identical_transfers(self):
+        '''
+        - repeated transfers of the same amount on the same day should each be matched with one opposite leg, once
+        '''
+        other = load_item('ins_2')
+        for a in other['accounts']:
+            a['account_id'] = 'other_' + a['account_id']
+        other['transactions'] = []
+        date = self.item['transactions'][0]['date']
+        account, other_account = self.item['accounts'][0]['account_id'], other['accounts'][0]['account_id']
+        self.item['transactions'] = [transfer(account, date, 10.0)] * 3000 + \
+            [transfer(account, date, -10.0)] * 1000 + self.item['transactions']
+        other['transactions'] = [transfer(other_account, date, -10.0)] * 3001 + \
+            [transfer(other_account, date, 10.0)] * 999
+
+        amounts = [t['amount'] for t in plaid_merge_items(
+            [self.item, other])['transactions'] if t['name'] == 'Online Transfer']
+
+        self.assertEqual(amounts.count(10.0), 0)
+        self.assertEqual(amounts.count(-10.0), 2)
+
+    def test_sorted_newest_first(self):
+        '''
+        - merged transactions should be sorted by date, newest first, as the metrics expect
+        '''
+        other = load_item('ins_2')
+        for t in other['transactions']:
+            t['name'] = 'other ' + t['name']
+
+        dates = [t['date'] for t in plaid_merge_items(
+            [self.item, other])['transactions']]
+
+        self.assertEqual(dates, sorted(dates, reverse=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,511 @@
+import os
+import json
+import time
+import unittest
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from optimization.singleflight import *  # import code to get tested
+from optimization.http import *
+from optimization.circuit import *
+from optimization.deadline import *
+from optimization.admission import *
+from optimization.bulkhead import *
+from feedback.message import *
+from validator_api.coinmarketcap import *
+
+
+# -------------------------------------------------------------------------- #
+#                               Helper Functions                             #
+# -------------------------------------------------------------------------- #
+
+class CoinmarketcapStub(BaseHTTPRequestHandler):
+    '''a local stand-in for the coinmarketcap API. Fails the first `failures` calls with a 503'''
+
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    failures = 0
+    calls = 0
+    ports = set()
+    delay = 0
+
+    def do_GET(self):
+        CoinmarketcapStub.calls += 1
+        time.sleep(CoinmarketcapStub.delay)
+        CoinmarketcapStub.ports.add(self.client_address[1])
+        if CoinmarketcapStub.calls <= CoinmarketcapStub.failures:
+            self.reply(503, {'status': {'error_message': 'unavailable'}})
+        elif self.path.startswith('/v2/tools/price-conversion'):
+            self.reply(200, {'data': [{'quote': {'SCRT': {'price': 0.25}}}]})
+        else:
+            self.reply(200, {'data': [{'symbol': 'BTC', 'quote': {'USD': {'price': 30000}}}]})
+
+    def reply(self, status, body):
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stub(handler):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# -------------------------------------------------------------------------- #
+#                                TEST CASES                                  #
+#                   - protection of the upstream API calls -                 #
+# -------------------------------------------------------------------------- #
+
+class TestSingleFlight(unittest.TestCase):
+
+    def setUp(self):
+        self.group = SingleFlight()
+        self.calls = 0
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.group = None
+
+    def slow_call(self, fail=False):
+        self.calls += 1
+        self.release.wait(5)
+        if fail:
+            raise Exception('upstream unavailable')
+        return {'SCRT': 1.5}
+
+    def run_concurrently(self, n, fail=False):
+        results = [None]*n
+
+        def caller(i):
+            try:
+                results[i] = self.group.do('rate', self.slow_call, fail)
+            except Exception as e:
+                results[i] = e
+
+        threads = [threading.Thread(target=caller, args=(i,))
+                   for i in range(n)]
+        for t in threads:
+            t.start()
+        while self.group.stats()['shared'] < n - 1:
+            time.sleep(0.001)
+        self.release.set()
+        for t in threads:
+            t.join()
+        return results
+
+    def test_concurrent_calls_share_one_result(self):
+        '''
+        - concurrent callers with the same key should trigger a single call
+        - every caller should get an equal but distinct copy of the result
+        '''
+        results = self.run_concurrently(8)
+
+        self.assertEqual(self.calls, 1)
+        self.assertTrue(all([r == {'SCRT': 1.5} for r in results]))
+        self.assertEqual(len(set([id(r) for r in results])), 8)
+
+    def test_concurrent_calls_share_one_error(self):
+        '''
+        - the error of the shared call should be raised to every caller
+        - the next call after a failure should start a new flight
+        '''
+        results = self.run_concurrently(4, fail=True)
+
+        self.assertEqual(self.calls, 1)
+        self.assertTrue(all([isinstance(r, Exception) for r in results]))
+
+        self.release.set()
+        self.group.do('rate', self.slow_call)
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(self.group.stats()['in_flight'], 0)
+
+    def test_decorator_keys(self):
+        '''
+        - calls with different keys should not be coalesced
+        '''
+        @single_flight(lambda client, x: x)
+        def square(client, x):
+            return x*x
+
+        self.assertEqual([square(None, 2), square(None, 3)], [4, 9])
+        self.assertEqual(square.flights.stats()['calls'], 2)
+
+    def test_unshared_results(self):
+        '''
+        - a result that cannot be shared (e.g. an error for the leader's own credentials) should not be handed to followers,
+          which should make their own call
+        '''
+        group = SingleFlight(share=lambda r: 'error' not in r)
+        results = dict()
+
+        def currencies(client):
+            self.release.wait(5)
+            return {'error': 'invalid token'} if client == 'bad' else {'USD': 0.01}
+
+        def caller(client):
+            results[client] = group.do('currencies', currencies, client)
+
+        leader = threading.Thread(target=caller, args=('bad',))
+        leader.start()
+        while group.stats()['in_flight'] == 0:
+            time.sleep(0.001)
+        followers = [threading.Thread(target=caller, args=(c,)) for c in ['a', 'b']]
+        [t.start() for t in followers]
+        while group.stats()['shared'] < 2:
+            time.sleep(0.001)
+        self.release.set()
+        [t.join() for t in [leader] + followers]
+
+        self.assertEqual(results, {'bad': {'error': 'invalid token'},
+                                   'a': {'USD': 0.01}, 'b': {'USD': 0.01}})
+
+    def test_followers_keep_their_deadline(self):
+        '''
+        - a follower should stop waiting for the shared call at its own deadline
+        - a follower should not inherit the DeadlineExceeded of a leader with a shorter deadline
+        '''
+        started = threading.Event()
+
+        def leader():
+            try:
+                self.group.run('rate', Deadline(5), lambda: started.set() or self.slow_call())
+            except Exception:
+                pass
+
+        thread = threading.Thread(target=leader)
+        thread.start()
+        started.wait(5)
+        t0 = time.monotonic()
+        with self.assertRaises(DeadlineExceeded):
+            self.group.run('rate', Deadline(0.1), self.slow_call)
+        self.assertLess(time.monotonic() - t0, 1)
+        self.release.set()
+        thread.join()
+
+        def expired():
+            started.wait(5)
+            raise DeadlineExceeded('rate')
+
+        started.clear()
+        thread = threading.Thread(target=lambda: self.assertRaises(
+            DeadlineExceeded, self.group.run, 'rate', Deadline(0.1), expired))
+        thread.start()
+        while self.group.stats()['in_flight'] == 0:
+            time.sleep(0.001)
+        follower = threading.Timer(0.05, started.set)
+        follower.start()
+        self.assertEqual(self.group.run('rate', Deadline(5), self.slow_call), {'SCRT': 1.5})
+        thread.join()
+
+
+class TestHttpRetries(unittest.TestCase):
+
+    def setUp(self):
+        CoinmarketcapStub.failures = 0
+        CoinmarketcapStub.calls = 0
+        CoinmarketcapStub.ports = set()
+        self.server = start_stub(CoinmarketcapStub)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        os.environ['COINMARKETCAP_URL'] = self.url
+        market_cache.clear()
+
+    def tearDown(self):
+        CoinmarketcapStub.delay = 0
+        os.environ.pop('COINMARKETCAP_URL', None)
+        market_cache.clear()
+        market_fallback.clear()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_retry_transient_errors(self):
+        '''
+        - 503 responses should be retried, and the validator should return the first successful response
+        - consecutive calls should reuse the same keep-alive connection
+        '''
+        CoinmarketcapStub.failures = 2
+
+        rate = coinmarketcap_rate('key', 'USD', 'SCRT')
+        coins = coinmarketcap_coins('key', 25)
+
+        self.assertEqual(rate, 0.25)
+        self.assertEqual(coins, {'BTC': 30000})
+        self.assertEqual(CoinmarketcapStub.calls, 4)
+        self.assertEqual(len(CoinmarketcapStub.ports), 1)
+
+    def test_retries_are_bounded(self):
+        '''
+        - once retries are exhausted, the last response should be returned
+        - an unreachable host should raise within the retry budget
+        '''
+        CoinmarketcapStub.failures = 10
+
+        r = http_get(self.url + '/v1/cryptocurrency/listings/latest', retries=2)
+        self.assertEqual(r.status_code, 503)
+        self.assertEqual(CoinmarketcapStub.calls, 3)
+
+        t0 = time.monotonic()
+        with self.assertRaises(Exception):
+            http_get('http://10.255.255.1', timeout=(0.2, 0.2), retries=10, budget=0.5)
+        self.assertLess(time.monotonic() - t0, 1)
+
+    def test_deadline_timeouts(self):
+        '''
+        - a timeout cut short by the caller's deadline should raise DeadlineExceeded, and not open the circuit
+        - a timeout within the caller's deadline should still count as a failure of the upstream
+        '''
+        CoinmarketcapStub.delay = 0.3
+        breaker = CircuitBreaker('slow', failures=1)
+        url = self.url + '/v1/cryptocurrency/listings/latest'
+
+        with self.assertRaises(DeadlineExceeded):
+            with breaker:
+                http_get(url, timeout=(1, 1), retries=0, deadline=Deadline(0.1))
+        self.assertEqual(breaker.state, 'closed')
+
+        with self.assertRaises(requests.Timeout):
+            with breaker:
+                http_get(url, timeout=(1, 0.1), retries=0, deadline=Deadline(5))
+        self.assertEqual(breaker.state, 'open')
+
+    def test_deadline_is_not_a_fallback(self):
+        '''
+        - a coinmarketcap error should be answered with the last known good value
+        - running out of time should raise DeadlineExceeded, not return the last known good value
+        '''
+        market_fallback.set(('coinmarketcap_rate', 'USD', 'SCRT'), 0.2)
+        CoinmarketcapStub.failures = 10
+        self.assertEqual(coinmarketcap_rate('key', 'USD', 'SCRT'), 0.2)
+
+        CoinmarketcapStub.failures = 0
+        CoinmarketcapStub.delay = 0.3
+        with self.assertRaises(DeadlineExceeded):
+            coinmarketcap_rate('key', 'USD', 'SCRT', Deadline(0.1))
+        with self.assertRaises(DeadlineExceeded):
+            coinmarketcap_coins('key', 25, Deadline(0.1))
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def setUp(self):
+        self.breaker = CircuitBreaker('upstream', failures=2, reset=0.05)
+
+    def tearDown(self):
+        self.breaker = None
+
+    def fail(self, e=Exception('timeout')):
+        try:
+            with self.breaker:
+                raise e
+        except CircuitOpen:
+            raise
+        except Exception:
+            pass
+
+    def test_open_after_consecutive_failures(self):
+        '''
+        - the circuit should open after `failures` consecutive failures, and then fail fast
+        - client errors should not count as failures
+        '''
+        e = Exception('invalid institution')
+        e.status = 400
+        for _ in range(3):
+            self.fail(e)
+        self.assertEqual(self.breaker.state, 'closed')
+
+        self.fail()
+        self.fail()
+        self.assertEqual(self.breaker.state, 'open')
+        with self.assertRaises(CircuitOpen):
+            self.fail()
+
+    def test_half_open_trial(self):
+        '''
+        - after the reset timeout, a single trial call should go through
+        - a successful trial should close the circuit, a failed one should open it again
+        '''
+        self.fail()
+        self.fail()
+        time.sleep(0.06)
+        self.assertEqual(self.breaker.state, 'half-open')
+        self.fail()
+        self.assertEqual(self.breaker.state, 'open')
+
+        time.sleep(0.06)
+        with self.breaker:
+            with self.assertRaises(CircuitOpen):
+                self.breaker.allow()
+        self.assertEqual(self.breaker.state, 'closed')
+
+    def test_inconclusive_trial(self):
+        '''
+        - a trial that runs out of the caller's deadline or gets a client error should not close the circuit,
+          and should free the trial for the next call
+        '''
+        self.fail()
+        self.fail()
+        time.sleep(0.06)
+        e = Exception('invalid institution')
+        e.status = 400
+        for error in [DeadlineExceeded('scoring'), e]:
+            self.fail(error)
+            self.assertEqual(self.breaker.state, 'half-open')
+        with self.breaker:
+            pass
+        self.assertEqual(self.breaker.state, 'closed')
+
+    def test_degraded_rate(self):
+        '''
+        - a rate that failed to fetch should be left out of the message, instead of being multiplied
+        '''
+        self.assertEqual(loan_amount_text(1000, 0.5), '$1,000 USD (500 SCRT)')
+        self.assertEqual(loan_amount_text(1000, 'coinmarketcap unavailable'), '$1,000 USD')
+
+
+class TestDeadline(unittest.TestCase):
+
+    def test_request_deadline(self):
+        '''
+        - the caller's X-Request-Timeout header should set the deadline, capped by REQUEST_TIMEOUT_MAX
+        - a missing or invalid header should fall back to REQUEST_TIMEOUT
+        '''
+        self.assertAlmostEqual(request_deadline({'X-Request-Timeout': '5'}).remaining(), 5, places=1)
+        self.assertAlmostEqual(request_deadline({'X-Request-Timeout': '600'}).remaining(), 60, places=1)
+        self.assertAlmostEqual(request_deadline({'X-Request-Timeout': 'soon'}).remaining(), 30, places=1)
+        self.assertAlmostEqual(request_deadline({}).remaining(), 30, places=1)
+
+    def test_optional_stages(self):
+        '''
+        - optional stages should be skipped once the remaining budget is within the reserve of the required stages
+        - an optional stage should get the remaining budget minus the reserve
+        '''
+        deadline = Deadline(3, reserve=1)
+        self.assertTrue(deadline.allows())
+        self.assertAlmostEqual(deadline.optional().remaining(), 2, places=1)
+        self.assertFalse(Deadline(0.5, reserve=1).allows())
+        self.assertEqual(Deadline(0.5, reserve=1).optional().remaining(), 0)
+
+    def test_expired_deadline(self):
+        '''
+        - required stages and upstream calls should not start once the deadline has expired
+        - a skipped call should not count as a failure of the upstream
+        '''
+        deadline = Deadline(0)
+        with self.assertRaises(DeadlineExceeded):
+            deadline.check('scoring')
+        with self.assertRaises(DeadlineExceeded):
+            http_get('http://127.0.0.1:9', deadline=deadline)
+        self.assertFalse(is_failure(DeadlineExceeded()))
+
+
+class TestAdmissionControl(unittest.TestCase):
+
+    def setUp(self):
+        self.admission = AdmissionControl(
+            rate=1, burst=2, limit=1, queue=1, max_wait=0.05)
+
+    def tearDown(self):
+        self.admission = None
+
+    def test_rate_limit_per_client(self):
+        '''
+        - a client should be limited to its burst, then told when to retry (429)
+        - other clients should not be affected
+        '''
+        deadline = Deadline(5)
+        codes = list()
+        for _ in range(3):
+            code, retry_after = self.admission.admit('client_a', deadline)
+            codes.append(code)
+            if code == 200:
+                self.admission.release()
+
+        self.assertEqual(codes, [200, 200, 429])
+        self.assertEqual(retry_after, 1)
+        self.assertEqual(self.admission.admit('client_b', deadline)[0], 200)
+
+    def test_shed_when_saturated(self):
+        '''
+        - a request that cannot get a slot within its wait bound should be shed (503)
+        - a request should get the slot freed by a finishing request
+        '''
+        deadline = Deadline(5)
+        self.assertEqual(self.admission.admit('a', deadline)[0], 200)
+        self.assertEqual(self.admission.admit('b', deadline), (503, 1))
+
+        threading.Timer(0.01, self.admission.release).start()
+        self.assertEqual(self.admission.admit('c', deadline)[0], 200)
+        self.assertEqual(self.admission.stats()['timed_out'], 1)
+
+
+class TestBulkhead(unittest.TestCase):
+
+    def test_saturated_provider_is_isolated(self):
+        '''
+        - a call to a saturated provider should be rejected after waiting max_wait for a slot
+        - calls to another provider should not wait
+        - queue times should be recorded
+        '''
+        slow = Bulkhead('slow', limit=1, max_wait=0.05)
+        fast = Bulkhead('fast', limit=1, max_wait=0.05)
+        release = threading.Event()
+
+        @slow
+        def slow_call():
+            release.wait(5)
+
+        @fast
+        def fast_call():
+            return 'ok'
+
+        t = threading.Thread(target=slow_call)
+        t.start()
+        while slow.active == 0:
+            time.sleep(0.001)
+
+        with self.assertRaises(BulkheadFull):
+            slow_call()
+        self.assertEqual(fast_call(), 'ok')
+        release.set()
+        t.join()
+
+        self.assertEqual(slow.stats()['rejected'], 1)
+        self.assertGreaterEqual(slow.stats()['max_queue_time'], 0.05)
+        self.assertLess(fast.stats()['max_queue_time'], 0.05)
+        self.assertEqual(slow.active, 0)
+
+    def test_wait_within_deadline(self):
+        '''
+        - a call with a deadline shorter than max_wait should stop waiting at its deadline, and fail with DeadlineExceeded
+        - the deadline argument of a decorated function should be used
+        '''
+        pool = Bulkhead('pool', limit=1, max_wait=5)
+        release = threading.Event()
+
+        @pool
+        def call(deadline=None):
+            release.wait(5)
+
+        t = threading.Thread(target=call)
+        t.start()
+        while pool.active == 0:
+            time.sleep(0.001)
+
+        t0 = time.monotonic()
+        with self.assertRaises(DeadlineExceeded):
+            call(deadline=Deadline(0.05))
+        with self.assertRaises(DeadlineExceeded):
+            with pool.slot(Deadline(0.05)):
+                pass
+        self.assertLess(time.monotonic() - t0, 1)
+        release.set()
+        t.join()
+        self.assertEqual(pool.active, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
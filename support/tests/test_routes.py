@@ -0,0 +1,253 @@
+import os
+import json
+import uuid
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from datetime import datetime
+from validator_api.coinmarketcap import market_cache
+import app_route  # import code to get tested
+
+
+# -------------------------------------------------------------------------- #
+#                               Helper Functions                             #
+# -------------------------------------------------------------------------- #
+
+def load_plaid():
+    '''the Plaid test user, as plaid_fetch() returns it'''
+    with open('data/test_user_plaid.json') as my_file:
+        data = json.load(my_file)
+    for t in data['transactions']:
+        t['date'] = datetime.strptime(t['date'], '%Y-%m-%d').date()
+    data['item'] = {'item_id': 'item_1', 'institution_id': 'ins_1'}
+    return None, data
+
+
+def load_coinbase(*args, **kwargs):
+    '''the Coinbase test user, as coinbase_fetch() returns it'''
+    with open('data/test_user_coinbase.json') as my_file:
+        data = json.load(my_file)
+    acc = [a for a in data['accounts'] if a['created_at']]
+    for a in acc:
+        a['created_at'] = datetime.strptime(
+            a['created_at'], '%Y-%m-%dT%H:%M:%SZ').date()
+    return acc, data['transactions']
+
+
+def read_events(response):
+    '''the (event, data) pairs of a Server-Sent Events response'''
+    events = list()
+    for block in response.get_data(as_text=True).split('\n\n'):
+        if block.strip():
+            lines = dict(l.split(': ', 1) for l in block.split('\n'))
+            events.append((lines['event'], json.loads(lines['data'])))
+    return events
+
+
+class RouteTestCase(unittest.TestCase):
+    '''calls the scoring endpoints with stubbed providers, each test as its own client of the admission control'''
+
+    body = {'plaid_token': 'access-test', 'plaid_client_id': 'client-test', 'plaid_client_secret': 'secret-test',
+            'coinbase_access_token': 'access-test', 'coinbase_refresh_token': 'refresh-test',
+            'coinmarketcap_key': 'key-test', 'as_of': '2022-04-21'}
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.env = {k: os.environ.get(k) for k in ['SCORE_INDEX_PATH']}
+        os.environ['SCORE_INDEX_PATH'] = os.path.join(self.dir, 'index.json')
+        market_cache.set(('coinmarketcap_rate', 'USD', 'SCRT'), 0.25)
+        market_cache.set(('coinmarketcap_coins', 25), {'BTC': 30000})
+        self.client = app_route.app.test_client()
+        self.headers = {'X-API-Key': uuid.uuid4().hex}
+
+    def tearDown(self):
+        market_cache.delete(('coinmarketcap_rate', 'USD', 'SCRT'))
+        market_cache.delete(('coinmarketcap_coins', 25))
+        for k, v in self.env.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+        shutil.rmtree(self.dir)
+
+    def post(self, endpoint, **fields):
+        return self.client.post(endpoint, json=dict(self.body, **fields), headers=self.headers)
+
+
+# -------------------------------------------------------------------------- #
+#                                TEST CASES                                  #
+#                          - streaming endpoints -                           #
+# -------------------------------------------------------------------------- #
+
+class TestStreamingEndpoints(RouteTestCase):
+
+    def test_plaid_stream(self):
+        '''
+        - the Plaid stream should report the data fetched, each pillar in order, the score, and the message
+        '''
+        # the stream is generated while the response is read
+        with mock.patch.object(app_route, 'plaid_fetch', return_value=load_plaid()):
+            response = self.post('/credit_score/plaid/stream')
+            events = read_events(response)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        self.assertEqual([e for e, d in events], ['start', 'fetch', 'plaid_credit', 'plaid_velocity',
+                                                  'plaid_stability', 'plaid_diversity', 'score', 'message'])
+        self.assertEqual(events[1][1], {'accounts': 9, 'transactions': 100})
+        score = events[6][1]
+        self.assertTrue(300 <= score['score'] <= 900)
+        self.assertIn('feedback', score)
+        self.assertIsInstance(events[7][1]['message'], str)
+
+    def test_coinbase_stream(self):
+        '''
+        - the Coinbase stream should report the data fetched, each pillar in order, the score, and the message
+        '''
+        with mock.patch.object(app_route, 'coinbase_fetch', side_effect=load_coinbase):
+            events = read_events(self.post('/credit_score/coinbase/stream'))
+        self.assertEqual([e for e, d in events], ['start', 'fetch', 'coinbase_kyc', 'coinbase_history',
+                                                  'coinbase_liquidity', 'coinbase_activity', 'score', 'message'])
+        self.assertTrue(300 <= events[6][1]['score'] <= 900)
+
+    def test_stream_error(self):
+        '''
+        - a provider failure should end the stream with an error event, after the events already sent
+        - missing top coins should be reported as coinmarketcap being unavailable
+        '''
+        with mock.patch.object(app_route, 'plaid_fetch', side_effect=Exception('invalid plaid_token')):
+            events = read_events(self.post('/credit_score/plaid/stream'))
+        self.assertEqual([e for e, d in events], ['start', 'error'])
+        self.assertEqual(events[1][1], {'status_code': 400, 'message': 'invalid plaid_token'})
+
+        with mock.patch.object(app_route, 'coinbase_fetch', side_effect=app_route.BulkheadFull('coinbase')):
+            events = read_events(self.post('/credit_score/coinbase/stream'))
+        self.assertEqual(events[-1][0], 'error')
+        self.assertEqual(events[-1][1]['status_code'], 503)
+
+        with mock.patch.object(app_route, 'market_coins', return_value='coinmarketcap unavailable (503)'):
+            events = read_events(self.post('/credit_score/coinbase/stream'))
+        self.assertEqual(events[-1][0], 'error')
+        self.assertEqual(events[-1][1]['message'],
+                         'coinmarketcap unavailable: coinmarketcap unavailable (503)')
+
+
+# -------------------------------------------------------------------------- #
+#                                TEST CASES                                  #
+#                           - combined endpoint -                            #
+# -------------------------------------------------------------------------- #
+
+class TestCombinedEndpoint(RouteTestCase):
+
+    def test_concurrent_fetch(self):
+        '''
+        - Plaid and Coinbase should be fetched at the same time, and their scores blended
+        '''
+        barrier = threading.Barrier(2, timeout=5)
+
+        def plaid_fetch(*args):
+            barrier.wait()
+            return load_plaid()
+
+        def coinbase_fetch(*args, **kwargs):
+            barrier.wait()
+            return load_coinbase()
+
+        with mock.patch.object(app_route, 'plaid_fetch', side_effect=plaid_fetch), \
+                mock.patch.object(app_route, 'coinbase_fetch', side_effect=coinbase_fetch):
+            response = self.post('/credit_score/combined', blend_policy='mean')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.json['percentile']), {'plaid', 'coinbase'})
+        self.assertIn('based on Plaid and Coinbase', response.json['message'])
+
+    def test_one_provider_fails(self):
+        '''
+        - a provider that fails should be left out of the blend and reported as such, not as a source of the score
+        - the top coins should not be fetched without a coinbase_access_token
+        '''
+        with mock.patch.object(app_route, 'plaid_fetch', return_value=load_plaid()), \
+                mock.patch.object(app_route, 'coinbase_fetch', side_effect=Exception('invalid coinbase_access_token')):
+            response = self.post('/credit_score/combined')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('based on Plaid.', response.json['message'])
+        self.assertIn('Coinbase was left out: invalid coinbase_access_token',
+                      response.json['message'])
+        self.assertEqual(response.json['feedback']['coinbase'], {
+                         'error': 'invalid coinbase_access_token'})
+
+        with mock.patch.object(app_route, 'plaid_fetch', return_value=load_plaid()), \
+                mock.patch.object(app_route, 'market_coins') as market_coins:
+            response = self.post('/credit_score/combined',
+                                 coinbase_access_token=None)
+        self.assertEqual(response.status_code, 200)
+        market_coins.assert_not_called()
+
+    def test_all_providers_fail(self):
+        '''
+        - the request should fail when no provider returns a score
+        '''
+        with mock.patch.object(app_route, 'plaid_fetch', side_effect=Exception('invalid plaid_token')):
+            response = self.post('/credit_score/combined',
+                                 coinbase_access_token=None)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json['message'], 'Plaid: invalid plaid_token')
+
+
+
+# -------------------------------------------------------------------------- #
+#                                TEST CASES                                  #
+#                              - score cache -                               #
+# -------------------------------------------------------------------------- #
+
+class TestScoreCache(RouteTestCase):
+
+    def test_credentials_in_key(self):
+        '''
+        - a repeated request should be served from cache, without fetching again
+        - a request with another client secret should not be served the cached score, but checked by the provider
+        '''
+        secret = uuid.uuid4().hex
+        with mock.patch.object(app_route, 'plaid_fetch', return_value=load_plaid()):
+            first = self.post('/credit_score/plaid', plaid_client_secret=secret)
+        self.assertEqual(first.status_code, 200)
+
+        with mock.patch.object(app_route, 'plaid_fetch', side_effect=Exception('invalid plaid_client_secret')) as fetch:
+            response = self.post('/credit_score/plaid', plaid_client_secret=secret)
+            self.assertEqual(response.json['score'], first.json['score'])
+            fetch.assert_not_called()
+            response = self.post('/credit_score/plaid', plaid_client_secret='wrong')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json['message'], 'invalid plaid_client_secret')
+
+
+# -------------------------------------------------------------------------- #
+#                                TEST CASES                                  #
+#                           - wallet verification -                          #
+# -------------------------------------------------------------------------- #
+
+class TestWalletVerification(RouteTestCase):
+
+    def test_unverified_address(self):
+        '''
+        - a plain wallet address should be rejected with 401 by default
+        - a plain wallet address accepted while migrating should be scored, but not stored, published, or attested
+        '''
+        with mock.patch.object(app_route, 'plaid_fetch', return_value=load_plaid()):
+            response = self.post('/credit_score/plaid', keplr_token='secret1plain')
+        self.assertEqual(response.status_code, 401)
+
+        with mock.patch.dict(os.environ, {'KEPLR_VERIFY': '0'}), \
+                mock.patch.object(app_route, 'plaid_fetch', return_value=load_plaid()), \
+                mock.patch.object(app_route, 'ledger_record') as ledger_record, \
+                mock.patch.object(app_route, 'publish_score') as publish_score, \
+                mock.patch.object(app_route, 'attest_score') as attest_score:
+            response = self.post('/credit_score/plaid', keplr_token='secret1plain')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('attestation', response.json)
+        ledger_record.assert_not_called()
+        publish_score.assert_not_called()
+        attest_score.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,593 @@
+import copy
+import csv
+import json
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+from support.score import *  # import code to get tested
+from optimization.cache import TTLCache
+from support.backtest import *
+from support.calibration import *
+from support.shadow import *
+from feedback.whatif import *
+from support.percentile import *
+from support.drift import *
+
+
+# -------------------------------------------------------------------------- #
+#                               Helper Functions                             #
+#                                                                            #
+# -------------------------------------------------------------------------- #
+
+def load_plaid():
+    with open('data/test_user_plaid.json') as my_file:
+        data = json.load(my_file)
+    data['transactions'] = [t for t in data['transactions'] if not t['pending']]
+    for t in data['transactions']:
+        t['date'] = datetime.strptime(t['date'], '%Y-%m-%d').date()
+    return data
+
+
+def load_coinbase():
+    with open('data/test_user_coinbase.json') as my_file:
+        data = json.load(my_file)
+    for a in data['accounts']:
+        if a['created_at']:
+            a['created_at'] = datetime.strptime(
+                a['created_at'], '%Y-%m-%dT%H:%M:%SZ').date()
+    return data['accounts'], data['transactions']
+
+
+# -------------------------------------------------------------------------- #
+#                                TEST CASES                                  #
+#                      - score engine: point-in-time scores -                #
+# -------------------------------------------------------------------------- #
+
+class TestScoreAsOf(unittest.TestCase):
+
+    def setUp(self):
+        self.data = load_plaid()
+        dates = sorted([t['date'] for t in self.data['transactions']])
+        self.as_of = dates[len(dates)//2]
+
+    def tearDown(self):
+        self.data = None
+
+    def test_plaid_excludes_later_transactions(self):
+        '''
+        - scoring as of a past date should ignore the transactions made after that date
+        '''
+        past = copy.deepcopy(self.data)
+        past['transactions'] = [
+            t for t in past['transactions'] if t['date'] <= self.as_of]
+
+        a = plaid_score(self.data, create_feedback_plaid(), as_of=self.as_of)
+        b = plaid_score(past, create_feedback_plaid(), as_of=self.as_of)
+
+        self.assertEqual(a, b)
+
+    def test_plaid_durations_use_as_of(self):
+        '''
+        - durations should be measured up to the as_of date, not up to the date the worker was started
+        '''
+        later = self.as_of + timedelta(days=365)
+        a = plaid_score(self.data, create_feedback_plaid(), as_of=self.as_of)[1]
+        b = plaid_score(self.data, create_feedback_plaid(), as_of=later)[1]
+
+        self.assertEqual(b['credit']['credit_duration_(days)'] -
+                         a['credit']['credit_duration_(days)'], 365)
+
+    def test_coinbase_excludes_later_data(self):
+        '''
+        - scoring as of a past date should ignore the accounts opened and transactions made after that date
+        '''
+        acc, txn = load_coinbase()
+        as_of = min([a['created_at'] for a in acc if a['created_at']])
+        score, feedback = coinbase_score(
+            acc, txn, create_feedback_coinbase(), as_of=as_of)
+
+        self.assertEqual(feedback['history']['wallet_age(days)'], 0)
+        self.assertEqual(len(coinbase_as_of(acc, txn, as_of - timedelta(days=1))[0]), len(
+            [a for a in acc if not a['created_at']]))
+
+    def test_cache_key_per_as_of(self):
+        '''
+        - the same data scored as of two dates should not share a cache entry
+        '''
+        cache = TTLCache(ttl=60)
+        later = self.as_of + timedelta(days=365)
+        plaid_score(self.data, create_feedback_plaid(), cache, self.as_of)
+        plaid_score(self.data, create_feedback_plaid(), cache, later)
+
+        self.assertEqual(len(cache), 2)
+
+
+# -------------------------------------------------------------------------- #
+#                                TEST CASES                                  #
+#                         - score engine: blending -                         #
+# -------------------------------------------------------------------------- #
+
+class TestBlendScore(unittest.TestCase):
+
+    def test_policies(self):
+        '''
+        - each policy should blend the scores as documented
+        - weights should be renormalized over the validators that returned a score
+        '''
+        scores = {'plaid': 600, 'coinbase': 800}
+        self.assertAlmostEqual(blend_score(scores), 600*0.6 + 800*0.4)
+        self.assertAlmostEqual(blend_score(
+            scores, 'weighted', {'plaid': 1, 'coinbase': 3}), 750)
+        self.assertEqual(blend_score(scores, 'mean'), 700)
+        self.assertEqual(blend_score(scores, 'max'), 800)
+        self.assertEqual(blend_score(scores, 'min'), 600)
+        self.assertAlmostEqual(blend_score({'coinbase': 800}), 800)
+
+    def test_invalid_blends(self):
+        '''
+        - no score, an unknown policy, or weights that leave out every validator should raise
+        '''
+        with self.assertRaises(Exception):
+            blend_score({})
+        with self.assertRaises(Exception):
+            blend_score({'plaid': 600}, 'median')
+        with self.assertRaises(Exception):
+            blend_score({'plaid': 600}, 'weighted', {'coinbase': 1})
+
+
+# -------------------------------------------------------------------------- #
+#                                TEST CASES                                  #
+#                             - backtest runner -                            #
+# -------------------------------------------------------------------------- #
+
+class TestBacktest(unittest.TestCase):
+
+    def setUp(self):
+        self.corpus = tempfile.mkdtemp()
+        for name in ['plaid', 'coinbase']:
+            for i in range(2):
+                shutil.copy('data/test_user_{}.json'.format(name),
+                            os.path.join(self.corpus, '{}_{}.json'.format(name, i)))
+        self.dates = monthly_dates(date(2022, 4, 30), 6)
+
+    def tearDown(self):
+        shutil.rmtree(self.corpus)
+
+    def test_monthly_dates(self):
+        '''
+        - as-of dates should be one per month, oldest first, capped at the end of shorter months
+        '''
+        self.assertEqual(monthly_dates(date(2022, 3, 31), 3), [
+            date(2022, 1, 31), date(2022, 2, 28), date(2022, 3, 31)])
+        self.assertEqual(monthly_dates(date(2022, 1, 15), 2), [
+            date(2021, 12, 15), date(2022, 1, 15)])
+
+    def test_slices_match_as_of_scores(self):
+        '''
+        - slicing the normalized history should give the same score as scoring the full history as of the same date
+        '''
+        path = os.path.join(self.corpus, 'plaid_0.json')
+        rows = backtest_user(path, self.dates)
+        data = load_plaid()
+
+        for row, d in zip(rows, self.dates):
+            if row.get('error'):
+                self.assertFalse([t for t in data['transactions'] if t['date'] <= d])
+                continue
+            score, feedback = plaid_score(data, create_feedback_plaid(), as_of=d)
+            self.assertEqual(row['score'], int(score))
+
+        rows = backtest_user(os.path.join(
+            self.corpus, 'coinbase_0.json'), self.dates)
+        acc, txn = load_coinbase()
+        for row, d in zip(rows, self.dates):
+            score, feedback = coinbase_score(
+                acc, txn, create_feedback_coinbase(), as_of=d)
+            self.assertEqual(row['score'], int(score))
+
+    def test_parallel_matches_serial(self):
+        '''
+        - spreading users across processes should write the same results table, in the same order, as one process
+        '''
+        files = corpus_files(self.corpus)
+        serial = os.path.join(self.corpus, 'serial.csv')
+        parallel = os.path.join(self.corpus, 'parallel.csv')
+
+        self.assertEqual(run_backtest(files, self.dates, serial, workers=1), 24)
+        run_backtest(files, self.dates, parallel, workers=2, chunksize=1)
+
+        with open(serial) as a, open(parallel) as b:
+            rows = list(csv.DictReader(a))
+            self.assertEqual(rows, list(csv.DictReader(b)))
+        self.assertEqual([r['user'] for r in rows[::6]], [
+            'coinbase_0', 'coinbase_1', 'plaid_0', 'plaid_1'])
+
+
+# -------------------------------------------------------------------------- #
+#                                TEST CASES                                  #
+#                            - weight calibration -                          #
+# -------------------------------------------------------------------------- #
+
+class TestCalibration(unittest.TestCase):
+
+    def setUp(self):
+        self.corpus = tempfile.mkdtemp()
+        self.labels = dict()
+        for name in ['plaid', 'coinbase']:
+            for i in range(3):
+                user = '{}_{}'.format(name, i)
+                shutil.copy('data/test_user_{}.json'.format(name),
+                            os.path.join(self.corpus, user + '.json'))
+                self.labels[user] = (i % 2, date(2022, 4, 30) - timedelta(days=60*i))
+
+    def tearDown(self):
+        shutil.rmtree(self.corpus)
+
+    def test_matrix_reproduces_scores(self):
+        '''
+        - the current weights applied to the metric matrix should give the same scores as the scoring pipeline
+        '''
+        files = corpus_files(self.corpus)
+        for model in ['plaid', 'coinbase']:
+            X, y = metric_matrix(files, self.labels, model, workers=1)
+            weights, pillar_weights, layout = model_spec(model)
+            scores = model_scores(X, weight_matrix(
+                weights, pillar_weights).reshape(1, -1))[:, 0]
+
+            self.assertEqual(list(y), [0, 1, 0])
+            for i in range(3):
+                path = os.path.join(self.corpus, '{}_{}.json'.format(model, i))
+                row = score_history(
+                    *load_history(path), self.labels['{}_{}'.format(model, i)][1])
+                self.assertEqual(int(scores[i]), row['score'])
+
+    def test_auc_ks(self):
+        '''
+        - AUC and KS of many candidates at once should match their definition, including ties
+        '''
+        rng = np.random.default_rng(0)
+        scores = rng.integers(300, 310, (40, 5)).astype(float)
+        y = rng.integers(0, 2, 40)
+
+        a, k = auc(scores, y), ks(scores, y)
+        for j in range(5):
+            good, bad = scores[y == 0, j], scores[y == 1, j]
+            pairs = [(g > b) + 0.5*(g == b) for g in good for b in bad]
+            self.assertAlmostEqual(a[j], np.mean(pairs))
+            cdf = [abs(np.mean(good <= t) - np.mean(bad <= t))
+                   for t in scores[:, j]]
+            self.assertAlmostEqual(k[j], max(cdf))
+
+    def test_random_search(self):
+        '''
+        - the search should rank candidates best first, find better weights than the current ones
+          when the outcome only depends on one metric, and not depend on the number of workers
+        '''
+        rng = np.random.default_rng(1)
+        weights, pillar_weights, layout = model_spec('coinbase')
+        X = rng.random((200, len(layout)))
+        y = (X[:, layout.index(('kyc', 'kyc'))] < 0.3).astype(int)
+
+        current, ranking = calibrate(
+            X, y, 'coinbase', candidates=400, batch=100, top=5, workers=1)
+        self.assertEqual(len(ranking), 5)
+        self.assertEqual([r['auc'] for r in ranking], sorted(
+            [r['auc'] for r in ranking], reverse=True))
+        self.assertGreater(ranking[0]['auc'], current['auc'])
+        self.assertEqual(set(ranking[0]['weights']), set(weights))
+
+        current, parallel = calibrate(
+            X, y, 'coinbase', candidates=400, batch=100, top=5, workers=2)
+        self.assertEqual([r['auc'] for r in parallel], [r['auc'] for r in ranking])
+
+
+# -------------------------------------------------------------------------- #
+#                                TEST CASES                                  #
+#                             - shadow scoring -                             #
+# -------------------------------------------------------------------------- #
+
+class TestShadowScoring(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.env = {k: os.environ.get(k) for k in [
+            'SHADOW_MODELS', 'SHADOW_LOG', 'SHADOW_BUDGET_MS']}
+        os.environ['SHADOW_MODELS'] = os.path.join(self.dir, 'shadow.json')
+        os.environ['SHADOW_LOG'] = os.path.join(self.dir, 'shadow.jsonl')
+        with open(os.environ['SHADOW_MODELS'], 'w') as f:
+            json.dump([{'model': 'plaid', 'model_version': 'live-copy'},
+                       {'model': 'plaid', 'model_version': 'candidate',
+                        'pillar_weights': {'credit': {'credit': 0.1, 'velocity': 0.3, 'stability': 0.3, 'diversity': 0.3}}},
+                       {'model': 'coinbase', 'model_version': 'other'}], f)
+        self.data = load_plaid()
+        self.as_of = max([t['date'] for t in self.data['transactions']])
+
+    def tearDown(self):
+        # let the log thread write to the test log before it is removed
+        shadow_log.queue.join()
+        for k, v in self.env.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+        shutil.rmtree(self.dir)
+
+    def test_shadow_scores(self):
+        '''
+        - shadow models should be scored from the metrics of the live model, also when its stages are replayed from cache
+        '''
+        cache = TTLCache(ttl=60)
+        for i in range(2):
+            metrics = dict()
+            score, feedback = plaid_score(
+                self.data, create_feedback_plaid(), cache, self.as_of, metrics)
+            shadows = shadow_score('plaid', score, metrics, self.as_of)
+
+            self.assertEqual(list(shadows), ['live-copy', 'candidate'])
+            self.assertAlmostEqual(shadows['live-copy'], score)
+            self.assertNotAlmostEqual(shadows['candidate'], score)
+
+    def test_shadow_log_and_budget(self):
+        '''
+        - shadow scores should be logged next to the live score, and skipped once the budget is spent
+        '''
+        metrics = dict()
+        score, feedback = plaid_score(
+            self.data, create_feedback_plaid(), as_of=self.as_of, metrics=metrics)
+        shadow_score('plaid', score, metrics, self.as_of, '/credit_score/plaid')
+        shadow_log.queue.join()
+
+        with open(os.environ['SHADOW_LOG']) as f:
+            record = json.loads(f.readlines()[-1])
+        self.assertEqual(record['live'], {model_version: score})
+        self.assertEqual(set(record['shadow']), {'live-copy', 'candidate'})
+        self.assertEqual(record['as_of'], self.as_of.isoformat())
+
+        os.environ['SHADOW_BUDGET_MS'] = '-1'
+        skipped = shadow_stats()['skipped']
+        self.assertEqual(shadow_score('plaid', score, metrics), {})
+        self.assertEqual(shadow_stats()['skipped'], skipped + 2)
+
+
+# -------------------------------------------------------------------------- #
+#                                TEST CASES                                  #
+#                        - score engine: what-if advice -                    #
+# -------------------------------------------------------------------------- #
+
+class TestWhatIf(unittest.TestCase):
+
+    def setUp(self):
+        self.data = load_plaid()
+        self.as_of = max([t['date'] for t in self.data['transactions']])
+        self.acc, self.txn = load_coinbase()
+
+    def score_plaid(self, data):
+        metrics = dict()
+        score, feedback = plaid_score(
+            data, create_feedback_plaid(), as_of=self.as_of, metrics=metrics)
+        return score, feedback, metrics
+
+    def one_change(self, levels, **changes):
+        grid = {k: np.array([changes.get(k, v[0])]) for k, v in levels.items()}
+        return grid
+
+    def test_plaid_predictions(self):
+        '''
+        - a higher credit limit should predict the score of the data with that limit
+        - money added now should never predict more than the score of the data with that balance
+        '''
+        score, feedback, metrics = self.score_plaid(self.data)
+        levels = plaid_levels(feedback, metrics)
+
+        data = copy.deepcopy(self.data)
+        card = [a for a in data['accounts'] if a['type'] == 'credit'][0]
+        card['balances']['limit'] += 1000
+        grid = self.one_change(levels, credit_limit=1000)
+        self.assertAlmostEqual(plaid_scores(feedback, metrics, grid)[0],
+                               self.score_plaid(data)[0])
+
+        data = copy.deepcopy(self.data)
+        checking = [a for a in data['accounts']
+                    if a['subtype'] == 'checking'][0]
+        checking['balances']['current'] += 5000
+        grid = self.one_change(levels, balance=5000)
+        self.assertLessEqual(plaid_scores(feedback, metrics, grid)[0],
+                             self.score_plaid(data)[0] + 1e-9)
+        self.assertGreater(plaid_scores(feedback, metrics, grid)[0], score)
+
+    def test_coinbase_predictions(self):
+        '''
+        - a higher balance should predict the score of the data with that balance
+        '''
+        as_of = date(2022, 1, 1)
+        metrics = dict()
+        score, feedback = coinbase_score(
+            self.acc, self.txn, create_feedback_coinbase(), as_of=as_of, metrics=metrics)
+
+        acc = copy.deepcopy(self.acc)
+        acc[0]['native_balance']['amount'] = str(
+            float(acc[0]['native_balance']['amount']) + 2000)
+        expected, _ = coinbase_score(
+            acc, self.txn, create_feedback_coinbase(), as_of=as_of)
+        grid = self.one_change(coinbase_levels(
+            feedback, metrics), balance=2000)
+        self.assertAlmostEqual(coinbase_scores(
+            feedback, metrics, grid)[0], expected)
+
+    def test_cheapest_changes(self):
+        '''
+        - every change should reach the next tier, the fewest and smallest changes first, then the highest score
+        - users in the top tier should get no change
+        '''
+        score, feedback, metrics = self.score_plaid(self.data)
+        tier = np.digitize(score, score_bins, right=False)
+        changes = what_if_plaid(score, feedback, metrics)
+
+        self.assertTrue(changes)
+        for c in changes:
+            self.assertGreaterEqual(c['score'], score_bins[tier])
+            self.assertIn(c['quality'], score_quality)
+        pulled = [len(c['changes']) for c in changes]
+        self.assertEqual(pulled, sorted(pulled))
+
+        levels = {'a': np.arange(5), 'b': np.arange(5)}
+        self.assertEqual(cheapest_changes(
+            900, levels, lambda grid: grid['a'] + 900), [])
+        changes = cheapest_changes(
+            score_bins[-1] - 1, levels, lambda grid: score_bins[-1] - 1 + grid['a'] + 2*grid['b'])
+        self.assertEqual([c['changes'] for c in changes], [
+                         {'b': 1}, {'a': 1}, {'b': 2}])
+
+
+# -------------------------------------------------------------------------- #
+#                                TEST CASES                                  #
+#                     - score engine: population percentiles -               #
+# -------------------------------------------------------------------------- #
+
+class TestScorePercentiles(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.env = {k: os.environ.get(k) for k in [
+            'SCORE_INDEX_PATH', 'SCORE_INDEX_MIN']}
+        os.environ['SCORE_INDEX_PATH'] = os.path.join(self.dir, 'index.json')
+        os.environ['SCORE_INDEX_MIN'] = '1'
+
+    def tearDown(self):
+        for k, v in self.env.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+        shutil.rmtree(self.dir)
+
+    def test_fenwick(self):
+        '''
+        - prefix sums should match the sums of the counts, after updates too
+        '''
+        rng = np.random.default_rng(0)
+        counts = rng.integers(0, 10, 601)
+        tree = Fenwick(counts)
+        for i in rng.integers(0, 601, 100):
+            tree.add(int(i))
+            counts[i] += 1
+        for i in [0, 1, 7, 300, 600, 601]:
+            self.assertEqual(tree.prefix(i), counts[:i].sum())
+        self.assertEqual(tree.total(), counts.sum())
+
+    def test_percentile_ranks(self):
+        '''
+        - a score should be ranked among the scores issued before it, then counted
+        - ranks should be left out until enough scores were issued
+        '''
+        metrics = {'branch': 'no_credit', 'velocity': {k: 0.5 for k in plaid_weights['velocity']},
+                   'stability': {k: 0.5 for k in plaid_weights['stability']},
+                   'diversity': {k: 0.5 for k in plaid_weights['diversity']}}
+        self.assertIsNone(score_percentiles('plaid', 600, metrics))
+        for score in range(400, 800):
+            score_percentiles('plaid', score, metrics)
+
+        p = score_percentiles('plaid', 500, metrics, record=False)
+        self.assertAlmostEqual(p['score'], 100*100.5/401, places=1)
+        self.assertEqual(p['velocity'], 50)
+        self.assertNotIn('credit', p)
+        self.assertIsNone(score_percentiles('coinbase', 500, {'branch': 'coinbase'}, record=False))
+
+        os.environ['SCORE_INDEX_MIN'] = '1000'
+        self.assertIsNone(score_percentiles('plaid', 500, metrics))
+
+    def test_index_persisted(self):
+        '''
+        - counts should survive a restart, and saves of several workers should add up
+        '''
+        path = os.environ['SCORE_INDEX_PATH']
+        key = index_key('plaid', model_version, 'score')
+        a, b = ScoreIndex(path), ScoreIndex(path)
+        for score in [500, 600, 700]:
+            a.add(key, 'score', score)
+        b.add(key, 'score', 800)
+        a.save()
+        b.save()
+
+        c = ScoreIndex(path)
+        self.assertEqual(c.rank(key, 'score', 650), (4, 50))
+        self.assertEqual(b.rank(key, 'score', 650), (4, 50))
+        a.save()
+        self.assertEqual(ScoreIndex(path).rank(key, 'score', 900)[0], 4)
+
+
+# -------------------------------------------------------------------------- #
+#                                TEST CASES                                  #
+#                         - score engine: drift sketches -                   #
+# -------------------------------------------------------------------------- #
+
+class TestDrift(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.values = rng.lognormal(7, 1, 50000)
+        self.baseline = np.percentile(self.values, np.arange(101))
+
+    def sketch(self, values):
+        sketch = KLL(200, rng=random.Random(0))
+        for v in values:
+            sketch.update(float(v))
+        return sketch
+
+    def test_sketch(self):
+        '''
+        - quantiles should be close to the exact ones, with a number of values held that does not grow with the count
+        '''
+        sketch = self.sketch(self.values)
+        self.assertEqual(sketch.count, len(self.values))
+        self.assertLess(sketch.size, 1000)
+        for q in [0.05, 0.5, 0.95]:
+            exact = np.mean(self.values <= sketch.quantile([q])[0])
+            self.assertAlmostEqual(exact, q, delta=0.02)
+
+    def test_psi_ks(self):
+        '''
+        - the same distribution should show no drift, a shifted one should
+        '''
+        same = self.sketch(self.values[::-1][:20000])
+        self.assertLess(drift_psi(self.baseline, same), 0.01)
+        self.assertLess(drift_ks(self.baseline, same), 0.03)
+
+        shifted = self.sketch(1.5*self.values[:20000])
+        self.assertGreater(drift_psi(self.baseline, shifted), 0.1)
+        self.assertGreater(drift_ks(self.baseline, shifted), 0.1)
+
+    def test_windows_and_baseline(self):
+        '''
+        - only the last DRIFT_WINDOWS windows should be kept
+        - the features of scored users should be reported against the baseline of a corpus
+        '''
+        data = load_plaid()
+        as_of = max([t['date'] for t in data['transactions']])
+        score, feedback = plaid_score(
+            data, create_feedback_plaid(), as_of=as_of)
+        baseline = build_baseline(
+            ['data/test_user_plaid.json'], as_of, workers=1)
+        self.assertIn('plaid/{}/credit_limit'.format(model_version), baseline)
+
+        monitor = DriftMonitor()
+        for day in range(10):
+            monitor.record('plaid', model_version, feature_values(
+                'plaid', score, feedback), now=day*86400)
+        windows = monitor.report(baseline)
+        self.assertEqual(len(windows), 7)
+        self.assertEqual(windows[0]['start'], '1970-01-10T00:00:00+00:00')
+        stats = windows[0]['features']['plaid/{}/score'.format(model_version)]
+        self.assertEqual(stats['count'], 1)
+        self.assertEqual(stats['psi'], 0)
+        self.assertEqual(stats['ks'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
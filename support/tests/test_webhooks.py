@@ -0,0 +1,220 @@
+import os
+import json
+import time
+import base64
+import hashlib
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+from Crypto.PublicKey import ECC
+from Crypto.Signature import DSS
+from Crypto.Hash import SHA256
+from optimization.webhooks import *  # import code to get tested
+from validator_api.plaid import *
+from validator_api.coinmarketcap import market_cache
+from optimization.cache import TTLCache
+from oracle.ledger import score_ledger
+import app_route
+
+
+# -------------------------------------------------------------------------- #
+#                               Helper Functions                             #
+# -------------------------------------------------------------------------- #
+
+def load_item(item_id):
+    '''load the Plaid test user as if it was an item linked a few days ago'''
+    with open('data/test_user_plaid.json') as my_file:
+        data = json.load(my_file)
+    shift = datetime.now(timezone.utc).date() - timedelta(days=5) - \
+        datetime.strptime(data['transactions'][0]['date'], '%Y-%m-%d').date()
+    for t in data['transactions']:
+        t['date'] = datetime.strptime(
+            t['date'], '%Y-%m-%d').date() + shift
+    data['item'] = {'item_id': item_id, 'institution_id': 'ins_1'}
+    return data
+
+
+def new_transaction(account_id, transaction_id):
+    return {'account_id': account_id, 'amount': -2500.0, 'category': ['Transfer', 'Payroll'],
+            'date': datetime.now(timezone.utc).date(), 'name': 'Payroll', 'pending': False,
+            'pending_transaction_id': None, 'transaction_id': transaction_id}
+
+
+def b64url(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+class PlaidKeys:
+    '''a local stand-in for the Plaid client, serving the key webhooks are signed with'''
+
+    def __init__(self, key):
+        self.key = key
+        self.calls = 0
+
+    def webhook_verification_key_get(self, request):
+        self.calls += 1
+        point = self.key.public_key().pointQ
+        jwk = {'alg': 'ES256', 'crv': 'P-256', 'kid': request.key_id, 'kty': 'EC', 'use': 'sig',
+               'x': b64url(int(point.x).to_bytes(32, 'big')), 'y': b64url(int(point.y).to_bytes(32, 'big')),
+               'created_at': 1560466150, 'expired_at': None}
+        return type('Response', (), {'to_dict': lambda self: {'key': jwk}})()
+
+
+def sign_webhook(key, kid, body, iat=None):
+    '''the Plaid-Verification header Plaid would send with a webhook'''
+    header = b64url(json.dumps({'alg': 'ES256', 'kid': kid, 'typ': 'JWT'}).encode())
+    payload = b64url(json.dumps({'iat': int(iat or time.time()),
+                                 'request_body_sha256': hashlib.sha256(body).hexdigest()}).encode())
+    signature = DSS.new(key, 'fips-186-3').sign(SHA256.new((header + '.' + payload).encode()))
+    return header + '.' + payload + '.' + b64url(signature)
+
+
+# -------------------------------------------------------------------------- #
+#                                TEST CASES                                  #
+#                  - Plaid webhooks and background re-scoring -              #
+# -------------------------------------------------------------------------- #
+
+class TestPlaidWebhooks(unittest.TestCase):
+
+    def setUp(self):
+        self.env = {k: os.environ.get(k) for k in [
+            'PLAID_WEBHOOKS', 'PLAID_WEBHOOK_VERIFY', 'SCORE_LEDGER_PATH', 'SCORE_INDEX_PATH', 'KEPLR_VERIFY']}
+        os.environ['PLAID_WEBHOOKS'] = '1'
+        os.environ['PLAID_WEBHOOK_VERIFY'] = '0'
+        self.local = LocalPlaid()
+        self.data = self.local.link('item_1', load_item('item_1'))
+        self.rescored = list()
+        self.store = TTLCache(3600)
+        self.webhooks = PlaidWebhooks(
+            self.local.fetch, lambda registration, data: self.rescored.append(data), store=self.store)
+
+    def tearDown(self):
+        for k, v in self.env.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+
+    def test_incremental_refresh(self):
+        '''
+        - new transactions should be fetched for the last days only, merged into the stored data, and re-scored
+        - removed transactions should be dropped without fetching the item again
+        '''
+        fetched = datetime.now(timezone.utc).date() - timedelta(days=3)
+        self.webhooks.register('item_1', {'client': None}, self.data, fetched)
+        account_id = self.data['accounts'][0]['account_id']
+
+        event = self.local.add(
+            'item_1', [new_transaction(account_id, 'new_1')])
+        self.assertEqual(self.webhooks.notify(event), (200, 'queued'))
+        self.assertTrue(self.webhooks.drain(5))
+        self.assertEqual(self.local.fetches, [('item_1', 10)])
+        self.assertEqual(len(self.rescored[-1]['transactions']), 101)
+        self.assertEqual(self.rescored[-1]['transactions'][0]['transaction_id'], 'new_1')
+
+        event = self.local.remove('item_1', ['new_1'])
+        self.assertEqual(self.webhooks.notify(event), (200, 'queued'))
+        self.assertTrue(self.webhooks.drain(5))
+        self.assertEqual(len(self.local.fetches), 1)
+        self.assertEqual(self.rescored[-1]['transactions'], self.data['transactions'])
+        self.assertEqual(self.webhooks.snapshot()['rescored'], 2)
+
+    def test_ignored_webhooks(self):
+        '''
+        - webhooks should be ignored if they do not change transactions or their item is unknown,
+          rejected if they are not signed by Plaid, and refused while webhooks are disabled
+        - an unsigned webhook should be rejected the same way whether its item is known or not
+        '''
+        self.webhooks.register('item_1', {'client': None}, self.data)
+        self.assertEqual(self.webhooks.notify(
+            {'webhook_type': 'ITEM', 'webhook_code': 'ERROR', 'item_id': 'item_1'}), (200, 'ignored'))
+        self.assertEqual(self.webhooks.notify(
+            {'webhook_type': 'TRANSACTIONS', 'webhook_code': 'DEFAULT_UPDATE', 'item_id': 'item_2'}), (200, 'unknown item'))
+        os.environ['PLAID_WEBHOOK_VERIFY'] = '1'
+        self.assertEqual(self.webhooks.notify(self.local.add('item_1', [])),
+                         (401, 'invalid Plaid-Verification'))
+        self.assertEqual(self.webhooks.notify(
+            {'webhook_type': 'TRANSACTIONS', 'webhook_code': 'DEFAULT_UPDATE', 'item_id': 'item_2'}),
+            (401, 'invalid Plaid-Verification'))
+        os.environ['PLAID_WEBHOOKS'] = '0'
+        self.assertEqual(self.webhooks.notify(self.local.add('item_1', []))[0], 404)
+        self.assertEqual(self.webhooks.snapshot()['events'], 0)
+
+    def test_shared_registry(self):
+        '''
+        - an item registered by one worker should be refreshed by another one sharing the cache backend
+        - the stored registration should be sealed, never holding credentials in clear
+        '''
+        self.webhooks.register('item_1', {'client': None, 'plaid_token': 'access-local-1'}, self.data)
+        self.assertNotIn(b'access-local-1', self.store.get('item_1'))
+
+        other = PlaidWebhooks(self.local.fetch, lambda registration, data: self.rescored.append(data),
+                              store=self.store)
+        event = self.local.add(
+            'item_1', [new_transaction(self.data['accounts'][0]['account_id'], 'new_1')])
+        self.assertEqual(other.notify(event), (200, 'queued'))
+        self.assertTrue(other.drain(5))
+        self.assertEqual(len(self.rescored[-1]['transactions']), 101)
+        self.assertEqual(len(self.webhooks.load('item_1')['data']['transactions']), 101)
+
+    def test_verification(self):
+        '''
+        - a webhook signed by Plaid should verify, and the signing key should be fetched once
+        - a tampered body, an old webhook, or another key should not verify
+        '''
+        key = ECC.generate(curve='P-256')
+        client = PlaidKeys(key)
+        body = json.dumps(self.local.add('item_1', [])).encode()
+        kid = 'kid-{}'.format(time.time())
+
+        self.assertTrue(plaid_verify_webhook(client, body, sign_webhook(key, kid, body)))
+        self.assertTrue(plaid_verify_webhook(client, body, sign_webhook(key, kid, body)))
+        self.assertEqual(client.calls, 1)
+        self.assertFalse(plaid_verify_webhook(client, body + b' ', sign_webhook(key, kid, body)))
+        self.assertFalse(plaid_verify_webhook(
+            client, body, sign_webhook(key, kid, body, time.time() - 600)))
+        self.assertFalse(plaid_verify_webhook(
+            client, body, sign_webhook(ECC.generate(curve='P-256'), kid, body)))
+        self.assertFalse(plaid_verify_webhook(client, body, 'not a jwt'))
+
+    def test_endpoint(self):
+        '''
+        - a webhook should re-score its item in the background and store the score,
+          and the next request of the user should be served from the precomputed response
+        '''
+        directory = tempfile.mkdtemp()
+        os.environ['SCORE_LEDGER_PATH'] = os.path.join(directory, 'ledger.db')
+        os.environ['SCORE_INDEX_PATH'] = os.path.join(directory, 'index.json')
+        os.environ['KEPLR_VERIFY'] = '0'
+        market_cache.set(('coinmarketcap_rate', 'USD', 'SCRT'), 0.25)
+        webhooks = app_route.plaid_webhooks
+        app_route.plaid_webhooks = PlaidWebhooks(
+            self.local.fetch, app_route.plaid_rescore)
+        try:
+            app_route.plaid_webhooks.register('item_1', {
+                'client': None, 'plaid_token': 'access-local-1', 'plaid_client_id': 'client-local', 'plaid_client_secret': 'secret-local',
+                'coinmarketcap_key': None, 'keplr_claim': 'secret1local', 'address': 'secret1local'}, self.data)
+            event = self.local.add(
+                'item_1', [new_transaction(self.data['accounts'][0]['account_id'], 'new_1')])
+
+            client = app_route.app.test_client()
+            response = client.post('/webhooks/plaid', json=event)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(app_route.plaid_webhooks.drain(30))
+            self.assertEqual(app_route.plaid_webhooks.snapshot()['rescored'], 1)
+
+            latest = score_ledger().latest('secret1local', 'plaid')
+            response = client.post('/credit_score/plaid', json={
+                'plaid_token': 'access-local-1', 'plaid_client_id': 'client-local', 'plaid_client_secret': 'secret-local',
+                'keplr_token': 'secret1local'})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json['score'], latest['score'])
+        finally:
+            app_route.plaid_webhooks = webhooks
+            market_cache.delete(('coinmarketcap_rate', 'USD', 'SCRT'))
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,13 @@
 import unittest
 from support.tests.test_coinbase import TestMetricsCoinbase
 from support.tests.test_plaid import *
+from support.tests.test_plaid_merge import *
+from support.tests.test_cache import *
+from support.tests.test_resilience import *
+from support.tests.test_score import *
+from support.tests.test_oracle import *
+from support.tests.test_webhooks import *
+from support.tests.test_routes import *
 from support.metrics_coinbase import *
 
 
@@ -15,11 +22,50 @@ def suite():
     suite.addTest(unittest.makeSuite(TestMetricDiversity))
     suite.addTest(unittest.makeSuite(TestHelperFunctions))
     suite.addTest(unittest.makeSuite(TestParametrizePlaid))
+    suite.addTest(unittest.makeSuite(TestPlaidMergeItems))
 
     # Coinbase
     suite.addTest(unittest.makeSuite(TestMetricsCoinbase))
     suite.addTest(unittest.makeSuite(TestParametrizeCoinbase))
 
+    # Score engine
+    suite.addTest(unittest.makeSuite(TestScoreAsOf))
+    suite.addTest(unittest.makeSuite(TestBlendScore))
+    suite.addTest(unittest.makeSuite(TestBacktest))
+    suite.addTest(unittest.makeSuite(TestCalibration))
+    suite.addTest(unittest.makeSuite(TestShadowScoring))
+    suite.addTest(unittest.makeSuite(TestWhatIf))
+    suite.addTest(unittest.makeSuite(TestScorePercentiles))
+    suite.addTest(unittest.makeSuite(TestDrift))
+
+    # Caches
+    suite.addTest(unittest.makeSuite(TestHashKey))
+    suite.addTest(unittest.makeSuite(TestTTLCache))
+    suite.addTest(unittest.makeSuite(TestCacheBackends))
+    suite.addTest(unittest.makeSuite(TestFeatureCache))
+    suite.addTest(unittest.makeSuite(TestSharedSnapshot))
+
+    # Upstream calls
+    suite.addTest(unittest.makeSuite(TestSingleFlight))
+    suite.addTest(unittest.makeSuite(TestHttpRetries))
+    suite.addTest(unittest.makeSuite(TestCircuitBreaker))
+    suite.addTest(unittest.makeSuite(TestDeadline))
+    suite.addTest(unittest.makeSuite(TestAdmissionControl))
+    suite.addTest(unittest.makeSuite(TestBulkhead))
+    suite.addTest(unittest.makeSuite(TestPlaidWebhooks))
+
+    # Endpoints
+    suite.addTest(unittest.makeSuite(TestStreamingEndpoints))
+    suite.addTest(unittest.makeSuite(TestCombinedEndpoint))
+    suite.addTest(unittest.makeSuite(TestScoreCache))
+    suite.addTest(unittest.makeSuite(TestWalletVerification))
+
+    # Oracle
+    suite.addTest(unittest.makeSuite(TestScoreLedger))
+    suite.addTest(unittest.makeSuite(TestPublicationQueue))
+    suite.addTest(unittest.makeSuite(TestAttestation))
+    suite.addTest(unittest.makeSuite(TestKeplr))
+
     return suite
 
 
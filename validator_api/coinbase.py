@@ -1,16 +1,29 @@
 from coinbase.wallet.error import CoinbaseError
 from coinbase.wallet.client import OAuthClient
+from coinbase.wallet.client import Client
 from datetime import datetime
 from icecream import ic
 
+from optimization.singleflight import single_flight
+from optimization.cache import cache_namespace
+from optimization.bulkhead import bulkhead
+
 import json
 
+# currencies are public: share them across users for an hour
+currencies_cache = cache_namespace('currencies', 3600)
+
 
 def coinbase_client(access_token, refresh_token):
     '''Connect to a client's Coinbase account using their tokens'''
     return OAuthClient(access_token, refresh_token)
 
 
+def coinbase_api_client(api_key, api_secret):
+    '''Connect to Coinbase using API keys, e.g. to read public data such as currencies'''
+    return Client(api_key, api_secret)
+
+
 def format_error(e):
     error = {'error': {
         'status_code': e.status_code,
@@ -27,11 +40,18 @@ def convert_to_json(obj):
     return json.loads(json.dumps(obj))
 
 
+# currencies are the same for every client: coalesce all concurrent calls.
+# An error is specific to the leader's credentials, so followers then make their own call
+@single_flight(lambda client: 'coinbase_currencies', share=lambda r: 'error' not in r)
+@bulkhead('coinbase')
 def coinbase_currencies(client):
     '''Get all Coinbase fiat currencies'''
     try:
-        r = client.get_currencies()
-        r = dict([(n['id'], float(n['min_size'])) for n in r['data']])
+        r = currencies_cache.get('coinbase_currencies')
+        if r is None:
+            r = client.get_currencies()
+            r = dict([(n['id'], float(n['min_size'])) for n in r['data']])
+            currencies_cache.set('coinbase_currencies', r)
 
     except CoinbaseError as e:
         r = format_error(e)
@@ -40,6 +60,7 @@ def coinbase_currencies(client):
         return r
 
 
+@bulkhead('coinbase')
 def coinbase_native_currency(client):
     '''Check what currency is currently set as default 'native currency' in the user's Coinbase account'''
     try:
@@ -52,6 +73,7 @@ def coinbase_native_currency(client):
         return r
 
 
+@bulkhead('coinbase')
 def coinbase_set_native_currency(client, symbol):
     '''Reset the currency of the user's Coinbase account to its initial default native currency'''
     try:
@@ -64,6 +86,7 @@ def coinbase_set_native_currency(client, symbol):
         return r
 
 
+@bulkhead('coinbase')
 def coinbase_accounts(client):
     '''Returns list of accounts with balance > $0. Current balances are reported both in native currency and in USD for each account.'''
     try:
@@ -86,6 +109,7 @@ def coinbase_accounts(client):
         return r
 
 
+@bulkhead('coinbase')
 def coinbase_transactions(client, account_id):
     '''Returns Coinbase data for all user's accounts'''
     try:
@@ -1,7 +1,45 @@
+from optimization.singleflight import single_flight
+from optimization.cache import cache_namespace
+from optimization.circuit import circuit_breaker, CircuitOpen
+from optimization.bulkhead import bulkhead, BulkheadFull
+from optimization.http import http_get, retry_status
+from os import getenv
+
 import requests
 
+# market data is public: share it across users for a minute
+market_cache = cache_namespace('market', 60)
+# last known good market data, served while coinmarketcap is unavailable
+market_fallback = cache_namespace('market_fallback', 86400)
+
+
+class CoinmarketcapUnavailable(Exception):
+    '''raised when coinmarketcap answers with a retryable status, or no market data can be served'''
+
+
+# failures of coinmarketcap itself, answered with the last known good value.
+# DeadlineExceeded is the caller's: it is never turned into a fallback
+upstream_errors = (requests.RequestException, CircuitOpen, BulkheadFull,
+                   CoinmarketcapUnavailable, KeyError, IndexError, TypeError, ValueError)
+
 
-def coinmarketcap_coins(api_key, limit):
+def coinmarketcap_url(path):
+    '''url of a coinmarketcap API path. Set COINMARKETCAP_URL to point the validator at a local stub, e.g. in tests'''
+    return getenv('COINMARKETCAP_URL', 'https://pro-api.coinmarketcap.com') + path
+
+
+@bulkhead('coinmarketcap')
+def coinmarketcap_get(url, headers, params, deadline=None):
+    '''GET a coinmarketcap API url through its circuit breaker. Fails fast while coinmarketcap is unavailable'''
+    with circuit_breaker('coinmarketcap'):
+        r = http_get(url, headers=headers, params=params, deadline=deadline)
+        if r.status_code in retry_status:
+            raise CoinmarketcapUnavailable('coinmarketcap unavailable ({})'.format(r.status_code))
+    return r.json()
+
+
+@single_flight(lambda api_key, limit, deadline=None: (api_key, limit))
+def coinmarketcap_coins(api_key, limit, deadline=None):
     '''
     Description:
         returns a dict of top-ranked cryptos on coinmarketcap
@@ -9,10 +47,15 @@ def coinmarketcap_coins(api_key, limit):
     Parameters:
         api_key (str): bearer token to authenticate into coinmarketcap API
         limit (float): number of top cryptos you want to keep
+        deadline (Deadline): deadline of the incoming request, if any
 
     Returns:
-        top_cryptos (dict): ticker-value pairs for top coinmarketcap cryptos
+        top_cryptos (dict): ticker-value pairs for top coinmarketcap cryptos. While coinmarketcap is unavailable, the last known good value, or an error string if there is none. Raises DeadlineExceeded if the deadline runs out
     '''
+    top_cryptos = market_cache.get(('coinmarketcap_coins', limit))
+    if top_cryptos is not None:
+        return top_cryptos
+
     try:
         headers = {
             'Accepts': 'application/json',
@@ -26,21 +69,24 @@ def coinmarketcap_coins(api_key, limit):
         }
 
         # Define url for coinmarketcap API
-        url = 'https://pro-api.coinmarketcap.com/v1/cryptocurrency/listings/latest'
+        url = coinmarketcap_url('/v1/cryptocurrency/listings/latest')
         # Run GET task to fetch best cryptos from coinmarketcap API
-        r = requests.get(url, headers=headers, params=params).json()
+        r = coinmarketcap_get(url, headers, params, deadline)
 
         # Keep only top cryptos (ticker and USD-value)
         top_cryptos = dict(
             [(n['symbol'], n['quote']['USD']['price']) for n in r['data']])
+        market_cache.set(('coinmarketcap_coins', limit), top_cryptos)
+        market_fallback.set(('coinmarketcap_coins', limit), top_cryptos)
 
-    except Exception as e:
-        top_cryptos = str(e)
+    except upstream_errors as e:
+        top_cryptos = market_fallback.get(('coinmarketcap_coins', limit), str(e))
 
     return top_cryptos
 
 
-def coinmarketcap_rate(api_key, coin_in, coin_out):
+@single_flight(lambda api_key, coin_in, coin_out, deadline=None: (api_key, coin_in, coin_out))
+def coinmarketcap_rate(api_key, coin_in, coin_out, deadline=None):
     '''
     Description:
         returns a conversion rate for the coin pair coin_in-coin_out
@@ -49,10 +95,15 @@ def coinmarketcap_rate(api_key, coin_in, coin_out):
         api_key (str): bearer token to authenticate into coinmarketcap API
         coin_in (str): ticker symbol for your base coin
         coin_out (str): ticker symbol for the coin to convert into
+        deadline (Deadline): deadline of the incoming request, if any
 
     Returns:
-        rate (float): rate you ought to multiply your base coin by, to obtain its coin_out equilavent
+        rate (float): rate you ought to multiply your base coin by, to obtain its coin_out equilavent. While coinmarketcap is unavailable, the last known good rate, or an error string if there is none. Raises DeadlineExceeded if the deadline runs out
     '''
+    rate = market_cache.get(('coinmarketcap_rate', coin_in, coin_out))
+    if rate is not None:
+        return rate
+
     try:
         headers = {
             'Accepts': 'application/json',
@@ -66,13 +117,15 @@ def coinmarketcap_rate(api_key, coin_in, coin_out):
         }
 
         # Define url for coinmarketcap API
-        url = 'https://pro-api.coinmarketcap.com/v2/tools/price-conversion'
+        url = coinmarketcap_url('/v2/tools/price-conversion')
 
         # Run GET task to fetch best cryptos from coinmarketcap API
-        r = requests.get(url, headers=headers, params=params).json()
+        r = coinmarketcap_get(url, headers, params, deadline)
         rate = r['data'][0]['quote'][coin_out]['price']
+        market_cache.set(('coinmarketcap_rate', coin_in, coin_out), rate)
+        market_fallback.set(('coinmarketcap_rate', coin_in, coin_out), rate)
 
-    except Exception as e:
-        rate = str(e)
+    except upstream_errors as e:
+        rate = market_fallback.get(('coinmarketcap_rate', coin_in, coin_out), str(e))
 
     return rate
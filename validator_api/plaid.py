@@ -2,14 +2,37 @@ from plaid.model.transactions_get_request_options import TransactionsGetRequestO
 from plaid.model.transactions_get_request import TransactionsGetRequest
 from plaid.model.institutions_get_by_id_request import InstitutionsGetByIdRequest
 from plaid.model.country_code import CountryCode
+from plaid.model.webhook_verification_key_get_request import WebhookVerificationKeyGetRequest
 
 from plaid.api import plaid_api
+from collections import defaultdict
 from datetime import timedelta
 from datetime import datetime
+from Crypto.PublicKey import ECC
+from Crypto.Signature import DSS
+from Crypto.Hash import SHA256
 from icecream import ic
 
+from optimization.singleflight import single_flight
+from optimization.cache import cache_namespace
+from optimization.circuit import circuit_breaker
+from optimization.bulkhead import bulkhead
+from optimization.deadline import DeadlineExceeded
+from os import getenv
+
+import urllib3
+import hashlib
+import base64
+import heapq
 import plaid
+import hmac
 import json
+import time
+
+# institution names rarely change: cache them for a day
+institutions_cache = cache_namespace('institutions', 86400)
+# keys Plaid signs its webhooks with, by key id
+webhook_keys_cache = cache_namespace('plaid_webhook_keys', 86400)
 
 
 def plaid_environment(plaid_env):
@@ -49,10 +72,13 @@ def format_error(e):
     return error
 
 
-def plaid_transactions(access_token, client, timeframe):
+@bulkhead('plaid', 8)
+def plaid_transactions(access_token, client, timeframe, deadline=None):
 
     start_date = (datetime.now() - timedelta(days=timeframe))
     end_date = datetime.now()
+    if deadline is not None:
+        deadline.check('fetching Plaid transactions')
 
     try:
         request = TransactionsGetRequest(
@@ -62,36 +88,72 @@ def plaid_transactions(access_token, client, timeframe):
             options=TransactionsGetRequestOptions()
         )
 
-        r = client.transactions_get(request).to_dict()
+        timeout = None if deadline is None else deadline.remaining()
+        r = client.transactions_get(
+            request, _request_timeout=timeout).to_dict()
 
     except plaid.ApiException as e:
         r = format_error(e)
 
+    # the call ran out of the request deadline
+    except urllib3.exceptions.HTTPError as e:
+        r = {'error': {'status_code': 504,
+                       'message': 'Plaid did not respond in time', 'error_type': 'TIMEOUT'}}
+
     finally:
         return r
 
 
-def plaid_bank_name(client, bank_id, feedback):
+@single_flight(lambda client, bank_id, deadline=None: bank_id)
+def plaid_institution_name(client, bank_id, deadline=None):
+    '''returns the name of a Plaid institution, from cache or from a single call shared by all concurrent callers'''
+    name = institutions_cache.get(bank_id)
+    if name is None:
+        request = InstitutionsGetByIdRequest(
+            institution_id=bank_id,
+            country_codes=list(map(lambda x: CountryCode(x), ['US']))
+        )  # hard code 'US' to be the country_code parameter
+
+        own = float(getenv('HTTP_READ_TIMEOUT', 10))
+        timeout = own if deadline is None else deadline.timeout(own)
+        capped = deadline is not None and deadline.caps(own)
+        with bulkhead('plaid', 8).slot(deadline), circuit_breaker('plaid_institutions'):
+            try:
+                r = client.institutions_get_by_id(
+                    request, _request_timeout=timeout)
+            except urllib3.exceptions.HTTPError as e:
+                # the caller's deadline set the timeout of the call: Plaid is not to blame
+                if capped and (isinstance(e, urllib3.exceptions.TimeoutError) or
+                               isinstance(getattr(e, 'reason', None), urllib3.exceptions.TimeoutError)):
+                    raise DeadlineExceeded(
+                        'Request deadline exceeded while fetching the bank name') from e
+                raise
+        name = r['institution']['name']
+        institutions_cache.set(bank_id, name)
+    return name
+
+
+def plaid_bank_name(client, bank_id, feedback, deadline=None):
     '''
         Description:
         returns the bank name where the user holds his bank account
 
     Parameters:
         client (plaid.api.plaid_api.PlaidApi): plaid client info (api key, secret key, palid environment)
-        bank_id (str): the Plaid ID of the institution to get details about 
+        bank_id (str or list): the Plaid ID of the institution(s) to get details about 
         feedback (dict): to write the bank name to
+        deadline (Deadline): deadline of the incoming request, if any. The bank name is optional: it is skipped when the deadline is nearly spent
 
     Returns:
         bank_name (str): name of the bank uwhere user holds their fundings
     '''
     try:
-        request = InstitutionsGetByIdRequest(
-            institution_id=bank_id,
-            country_codes=list(map(lambda x: CountryCode(x), ['US']))
-        )  # hard code 'US' to be the country_code parameter
-
-        r = client.institutions_get_by_id(request)
-        feedback['diversity']['bank_name'] = r['institution']['name']
+        if deadline is not None and not deadline.allows():
+            raise Exception('not enough time left to fetch the bank name')
+        deadline = None if deadline is None else deadline.optional()
+        names = [plaid_institution_name(client, id, deadline)
+                 for id in (bank_id if isinstance(bank_id, list) else [bank_id])]
+        feedback['diversity']['bank_name'] = ', '.join(names)
 
     # Always return a bank_name. If the name does not exist then return a None type
     except:
@@ -99,3 +161,167 @@ def plaid_bank_name(client, bank_id, feedback):
 
     finally:
         return feedback
+
+
+def plaid_merge_items(items):
+    '''
+    Description:
+        merge the data of several Plaid items (i.e., bank logins) into one normalized 'Transactions' product.
+        Duplicates are dropped in linear time using hash indexes:
+            - an account linked twice is kept once, and its transactions are deduplicated on (account, date, amount, counterparty)
+            - a transfer between two linked institutions is seen from both sides, as a debit in one item and a credit in the other.
+              Both legs are matched on (date, amount, 'transfer') and dropped, since money moving between the user's own accounts is neither income nor expense
+
+    Parameters:
+        items (list): Plaid 'Transactions' products (accounts, item, transactions), one per access token. Transactions are sorted by date, newest first
+
+    Returns:
+        merged (dict): accounts, item, and transactions across all items. Transactions are sorted by date, newest first
+    '''
+    accounts = list()
+    acc_index = dict()  # account key -> account_id of the account kept
+    acc_map = dict()  # account_id -> account_id of the account kept
+    institutions = list()
+
+    for it in items:
+        bank_id = it['item'].get('institution_id')
+        if bank_id not in institutions:
+            institutions.append(bank_id)
+        for a in it['accounts']:
+            key = (bank_id, a.get('mask'), str(a['type']),
+                   str(a['subtype']), a.get('name'))
+            if key not in acc_index:
+                acc_index[key] = a['account_id']
+                accounts.append(a)
+            acc_map[a['account_id']] = acc_index[key]
+
+    kept = [list() for it in items]
+    dropped = set()  # (item, position) of transfer legs matched across items
+    txn_count = defaultdict(int)  # txn key -> count kept so far
+    # (date, amount) -> item -> positions of its unmatched transfer legs
+    transfers = defaultdict(lambda: defaultdict(list))
+
+    for i, it in enumerate(items):
+        local_count = defaultdict(int)
+        for t in it['transactions']:
+            account_id = acc_map.get(t['account_id'], t['account_id'])
+
+            # the same account linked twice: keep as many copies of a txn as the item that shows it most often
+            counterparty = str(t.get('merchant_name') or t.get('name')).lower()
+            key = (account_id, t['date'], t['amount'], counterparty)
+            local_count[key] += 1
+            if local_count[key] <= txn_count[key]:
+                continue
+            txn_count[key] = local_count[key]
+
+            t = dict(t, account_id=account_id)
+
+            # the same transfer seen from both sides: match it against an opposite leg from another item
+            if t['category'] and 'Transfer' in t['category'] and t['amount'] != 0:
+                opposite = transfers.get((t['date'], -t['amount']), {})
+                match = next((j for j in opposite if j != i), None)
+                if match is not None:
+                    dropped.add((match, opposite[match].pop()))
+                    if not opposite[match]:
+                        del opposite[match]
+                    continue
+                transfers[(t['date'], t['amount'])][i].append(len(kept[i]))
+
+            kept[i].append(t)
+
+    # merge the per-item lists, each already sorted newest first
+    kept = [[t for j, t in enumerate(k) if (i, j) not in dropped]
+            for i, k in enumerate(kept)]
+    txn = list(heapq.merge(*kept, key=lambda t: t['date'], reverse=True))
+
+    merged = {
+        'accounts': accounts,
+        'item': dict(items[0]['item'], institution_id=institutions[0] if len(institutions) == 1 else institutions),
+        'transactions': txn
+    }
+    return merged
+
+
+def plaid_update_item(item, update, since, removed=(), oldest=None):
+    '''
+    Description:
+        apply an incremental fetch to the stored data of a Plaid item, instead of fetching its whole history again.
+        The fetched transactions replace the stored ones from `since` on, so that transactions that were modified,
+        posted, or dropped within the fetched window are accounted for
+
+    Parameters:
+        item (dict): stored 'Transactions' product of the item (accounts, item, and non-pending transactions)
+        update (dict): 'Transactions' product fetched from `since` on, or None if transactions were only removed
+        since (date): first date of the incremental fetch
+        removed (iterable): ids of the transactions Plaid reported as removed
+        oldest (date): transactions before this date are dropped, if given
+
+    Returns:
+        item (dict): accounts, item, and non-pending transactions of the item, sorted by date, newest first
+    '''
+    removed = set(removed)
+    txn = [t for t in item['transactions'] if t['transaction_id'] not in removed]
+    if update is not None:
+        fresh = [t for t in update['transactions']
+                 if not t['pending'] and t['transaction_id'] not in removed]
+        txn = fresh + [t for t in txn if t['date'] < since]
+        item = {'accounts': update['accounts'], 'item': update['item']}
+    if oldest is not None:
+        txn = [t for t in txn if t['date'] >= oldest]
+
+    return {
+        'accounts': item['accounts'],
+        'item': item['item'],
+        'transactions': sorted(txn, key=lambda t: t['date'], reverse=True)
+    }
+
+
+def b64url_decode(data):
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def plaid_webhook_key(client, key_id):
+    '''the public key (JWK) Plaid signs its webhooks with, from cache or from Plaid'''
+    key = webhook_keys_cache.get(key_id)
+    if key is None:
+        with bulkhead('plaid', 8), circuit_breaker('plaid_webhook_keys'):
+            r = client.webhook_verification_key_get(
+                WebhookVerificationKeyGetRequest(key_id=key_id)).to_dict()
+        key = r['key']
+        webhook_keys_cache.set(key_id, key)
+    return key
+
+
+def plaid_verify_webhook(client, body, token, max_age=300):
+    '''
+    Description:
+        verify that a webhook was sent by Plaid: the Plaid-Verification header is a JWT signed (ES256) by one of Plaid's keys,
+        issued less than `max_age` seconds ago, and carrying the SHA-256 of the request body
+
+    Parameters:
+        client (plaid.api.plaid_api.PlaidApi): Plaid client, to fetch the signing key
+        body (bytes): raw request body
+        token (str): Plaid-Verification header
+        max_age (int): maximum age of the webhook, in seconds
+
+    Returns:
+        valid (bool): True if the webhook was sent by Plaid
+    '''
+    try:
+        header, payload, signature = token.split('.')
+        if json.loads(b64url_decode(header)).get('alg') != 'ES256':
+            return False
+        key = plaid_webhook_key(client, json.loads(
+            b64url_decode(header))['kid'])
+        if key.get('expired_at'):
+            return False
+        public_key = ECC.construct(curve='P-256', point_x=int.from_bytes(b64url_decode(key['x']), 'big'),
+                                   point_y=int.from_bytes(b64url_decode(key['y']), 'big'))
+        DSS.new(public_key, 'fips-186-3').verify(SHA256.new((header + '.' + payload).encode()),
+                                                 b64url_decode(signature))
+        claims = json.loads(b64url_decode(payload))
+        if time.time() - claims['iat'] > max_age:
+            return False
+        return hmac.compare_digest(claims['request_body_sha256'], hashlib.sha256(body).hexdigest())
+    except Exception:
+        return False